@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+""" Measures start-up time of console scripts. Each script is run with '--help' in a fresh interpreter.
+
+Usage: python3 benchmarks/startup.py [runs]
+"""
+import sys
+import os
+import time
+import subprocess
+
+SCRIPTS = {
+    'mongo_check': 'MongoCheckerCli',
+    'mongo_set': 'MongoSetCli',
+    'mongo_clone': 'MongoCloneCli',
+    'mongo_upload': 'MongoUploadCli',
+}
+HEAVY_MODULES = ('iowmongotools.upload', 'iowmongotools.fs', 'iowmongotools.templates', 'mimetypes')
+CODE = '''
+import sys, atexit
+sys.argv = [{name!r}, '--help', '--config_file', '']
+atexit.register(lambda: sys.stderr.write(' '.join(m for m in {heavy!r} if m in sys.modules)))
+import iowmongotools
+iowmongotools.{klass}.entry()
+'''
+
+
+def measure(name, klass, runs):
+    timings = list()
+    loaded = ''
+    for _ in range(runs):
+        started_ts = time.time()
+        proc = subprocess.Popen([sys.executable, '-c', CODE.format(name=name, klass=klass, heavy=HEAVY_MODULES)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        stderr = proc.communicate()[1]
+        timings.append(time.time() - started_ts)
+        loaded = stderr.strip().split('\n')[-1]
+    timings.sort()
+    return timings[0], timings[len(timings) // 2], loaded
+
+
+def main(runs=10):
+    print('%-14s %10s %10s  %s' % ('script', 'min, ms', 'median, ms', 'heavy modules loaded'))
+    for name, klass in sorted(SCRIPTS.items()):
+        fastest, median, loaded = measure(name, klass, runs)
+        print('%-14s %10.1f %10.1f  %s' % (name, fastest * 1000, median * 1000, loaded or '-'))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -1,11 +1,12 @@
 """ Main module """
 __author__ = "Denis Ashcheulov"
-__version__ = "0.7.6"
+__version__ = "0.10.4"
 __status__ = "Alpha"
 
 import logging
+import time
 from multiprocessing.pool import ThreadPool
-from iowmongotools import app, cluster, upload
+from iowmongotools import app, cluster
 
 logger = logging.getLogger(__name__)
 
@@ -13,18 +14,85 @@ logger = logging.getLogger(__name__)
 class MongoCheckerCli(app.AppCli):
     SettingsClass = app.SettingCliCluster
 
+    @property
+    def default_config(self):
+        config = super().default_config
+        config.update({
+            'check_chunks': (False, 'Check distribution of chunks and data among shards of sharded collections.'),
+            'max_chunks_imbalance': (1.5, 'Maximum ratio of amount of chunks on the most loaded shard to average.'),
+            'max_size_imbalance': (1.5, 'Maximum ratio of size of data on the most loaded shard to average.'),
+            'max_jumbo_chunks': (0, 'Maximum amount of jumbo chunks in a collection.'),
+            'watch': (0, 'Re-run checks every given amount of seconds keeping connections. Run once if 0.'),
+            'concurrency': (0, 'Maximum amount of clusters checked simultaneously. All clusters if 0.')
+        })
+        return config
+
     def run(self):
         if not hasattr(self.config, 'clusters'):
             logger.error('Please provide cluster_config.yaml. See --help.')
             return 1
         errors = len(self.config.clusters) - cluster.create_objects(self.config.clusters, self.config.cluster_config)
-        pool = ThreadPool(processes=len(cluster.Cluster.objects))
-        results = [pool.apply_async(_cluster.check_config) for name, _cluster in cluster.Cluster.objects.items()]
+        if hasattr(self.config, 'metrics'):
+            if 'prefix' not in self.config.metrics or 'path' not in self.config.metrics:
+                raise AttributeError('Config of \'metrics\' must contain \'prefix\' and \'path\'')
+            metrics_file = open(self.config.metrics['path'], 'w', buffering=1)
+        else:
+            metrics_file = None
+        pool = ThreadPool(processes=int(self.config.concurrency) or len(cluster.Cluster.objects))
+        interval = float(self.config.watch)
+        try:
+            if not interval:
+                return errors + self.check(pool, metrics_file)
+            logger.info('Checking clusters every %s seconds.', interval)
+            while True:
+                started_ts = time.time()
+                self.check(pool, metrics_file)
+                time.sleep(max(0, interval - (time.time() - started_ts)))
+        finally:
+            if metrics_file:
+                metrics_file.close()
+
+    def check(self, pool, metrics_file=None):
+        """ Checks all clusters using connections created once
+        :returns amount of failed checks
+        """
+        errors = 0
+        metrics = list()
+        results = [pool.apply_async(self.check_cluster, (_cluster,)) for name, _cluster in
+                   cluster.Cluster.objects.items()]
         for result in results:
-            if not result.get():
-                errors += 1
+            failed, cluster_metrics = result.get()
+            errors += failed
+            metrics.extend(cluster_metrics)
+        if metrics_file:
+            ts = int(time.time())
+            logger.debug('Flushing %s metrics', len(metrics))
+            metrics_file.write(''.join(app.format_metric(self.config.metrics['prefix'], name, value, ts)
+                                       for name, value in metrics))
         return errors
 
+    def check_cluster(self, _cluster):
+        """ :returns tuple of amount of failed checks and list of metrics """
+        started_ts = time.time()
+        metrics = list()
+        failed = 0
+        try:
+            if not _cluster.check_config():
+                failed += 1
+            metrics.append(((_cluster.name, 'config_ok'), int(not failed)))
+            if self.config.check_chunks:
+                ok, distribution_metrics = _cluster.check_distribution(
+                    self.config.max_chunks_imbalance, self.config.max_size_imbalance, self.config.max_jumbo_chunks)
+                metrics.extend(distribution_metrics)
+                if not ok:
+                    failed += 1
+        except Exception as err:
+            logger.error('Cannot check cluster \'%s\': %s', _cluster.name, err)
+            failed += 1
+        metrics.append(((_cluster.name, 'check_failed'), failed))
+        metrics.append(((_cluster.name, 'check_latency_ms'), int((time.time() - started_ts) * 1000)))
+        return failed, metrics
+
 
 class MongoSetCli(app.AppCli):
     SettingsClass = app.SettingCliCluster
@@ -130,5 +198,19 @@ class MongoCloneCli(app.AppCli):
         return 0
 
 
-class MongoUploadCli(upload.Uploader, app.AppCli):
-    SettingsClass = app.SettingCliUploader
+class MongoUploadCli(object):
+    """ Entry point of mongo_upload. Module 'upload' is imported only when the tool is run. """
+
+    @staticmethod
+    def entry():
+        from iowmongotools import upload
+        return upload.MongoUploadCli.entry()
+
+
+class MongoCleanupCli(object):
+    """ Entry point of mongo_cleanup. Module 'cleanup' is imported only when the tool is run. """
+
+    @staticmethod
+    def entry():
+        from iowmongotools import cleanup
+        return cleanup.MongoCleanupCli.entry()
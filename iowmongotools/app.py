@@ -5,8 +5,8 @@ import logging
 import logging.config
 import time
 from abc import ABC, abstractmethod
-from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-import subprocess
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, SUPPRESS
+from copy import deepcopy
 import yaml
 import re
 from collections import OrderedDict
@@ -18,6 +18,7 @@ def run_ext_command(args, title=''):
     """ Runs external command
     :returns exit code
     """
+    import subprocess
     logger.info("Executing command: %s", " ".join(args))
     proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1,
                             universal_newlines=True)
@@ -71,6 +72,15 @@ def human_to_seconds(string):
     return seconds
 
 
+def format_metric(prefix, name, value, ts):
+    """ Formats line of metrics file in graphite format '<prefix>.<name> <value> <unix_timestamp>'
+
+    :type name: tuple
+    :param name: parts of name of metric. Dots inside of parts are replaced with underscores.
+    """
+    return '{}.{} {} {}\n'.format(prefix, '.'.join(str(part).replace('.', '_') for part in name), value, ts)
+
+
 def deep_merge(a, b, path=None):
     if path is None:
         path = []
@@ -168,19 +178,26 @@ class Settings(object):
 
 
 class SettingsCli(Settings):
+    preliminary_arguments = (('config_file', 'Path to yaml file containing settings'),)
 
     def load(self, argv=sys.argv[1:]):
         """ Loads setting from cli arguments and config_file if it is provided as cmd-argument.
         Settings are defined in the next order: defaults, config file, cmd-arguments.
         It means that defaults may be overwritten by config, which may be overwritten by cmd-args.
+        Arguments pointing to other files (preliminary_arguments) are parsed once before reading config file.
         """
         parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
-        parser.add_argument("--{}".format('config_file'), default=getattr(self, 'config_file', None),
-                            help='Path to yaml file containing settings')
-        parser.parse_known_args(args=[a for a in argv if a not in ['-h', '--help']], namespace=self)
-        config = self.read_config_file(self.config_file)
+        for name, description in self.preliminary_arguments:
+            parser.add_argument("--{}".format(name), default=SUPPRESS, help=description)
+        known_args = vars(parser.parse_known_args(args=[a for a in argv if a not in ['-h', '--help']])[0])
+        self.__dict__.update(known_args)
+        config = self.read_config_file(getattr(self, 'config_file', None))
         if config:
             self.__dict__.update(config)
+            self.__dict__.update(known_args)  # cmd-args overwrite config
+        for name, description in self.preliminary_arguments:
+            parser.set_defaults(**{name: getattr(self, name, None)})
+            setattr(self, name, getattr(self, name, None))
         exclusions = self.extra_run(parser, argv)
         for key, value in self.__dict__.items():
             if not self.description.get(key) or key in ('config_file', 'description') + exclusions:
@@ -208,6 +225,8 @@ class SettingsCli(Settings):
 
 
 class SettingCliCluster(SettingsCli):
+    preliminary_arguments = SettingsCli.preliminary_arguments + (
+        ('cluster_config', 'Path to yaml file containing description of clusters'),)
 
     def extra_run(self, parser, argv):
         return self.add_clusters(parser, argv)
@@ -221,9 +240,6 @@ class SettingCliCluster(SettingsCli):
             delattr(self, 'cluster_config')
 
     def add_clusters(self, parser, argv):
-        parser.add_argument("--{}".format('cluster_config'), default=getattr(self, 'cluster_config', None),
-                            help='Path to yaml file containing description of clusters')
-        parser.parse_known_args(args=[a for a in argv if a not in ['-h', '--help']], namespace=self)
         self.tmp['cluster_config'] = getattr(self, 'cluster_config')
         if os.path.isfile(str(self.tmp['cluster_config'])):
             self.tmp['cluster_config'] = self.read_config_file(self.cluster_config)
@@ -237,14 +253,18 @@ class SettingCliUploader(SettingCliCluster):
 
     def extra_run(self, parser, argv):
         exclusions = self.add_clusters(parser, argv)
-        parser.parse_known_args(args=[a for a in argv if a not in ['-h', '--help']], namespace=self)
-        parser.add_argument("--{}".format('workers'), default=len(self.clusters) if hasattr(self, 'clusters') else 1,
-                            help='Amount of workers', type=int)
+        parser.add_argument("--{}".format('workers'), default=0,
+                            help='Amount of workers. Equals to amount of clusters if 0.', type=int)
         if getattr(self, 'upload'):
             parser.add_argument("--{}".format('providers'), default=[p for p in self.upload.keys()],
                                 help='List of providers of segments for processing', nargs='*')
         return exclusions + ('workers', 'providers')
 
+    def cleanup(self):
+        super().cleanup()
+        if not self.workers:
+            self.workers = len(self.clusters) if hasattr(self, 'clusters') else 1
+
 
 class Command(object):
 
@@ -342,11 +362,12 @@ class App(ABC):
     SettingsClass = Settings
 
     def __init__(self):
-        if 'log_level' in self.default_config:
-            logging_config = self.default_config['logging'][0]
-            logging_config['root']['level'] = self.default_config['log_level'][0].upper()
+        default_config = self.default_config  # evaluate the property once
+        if 'log_level' in default_config:
+            logging_config = deepcopy(default_config['logging'][0])
+            logging_config['root']['level'] = default_config['log_level'][0].upper()
             logging.config.dictConfig(logging_config)
-        self.config = self.SettingsClass(self.default_config)
+        self.config = self.SettingsClass(default_config)
 
 
 class AppCli(App):
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+""" Removes expired segments from mongo """
+import logging
+import threading
+import time
+from copy import deepcopy
+from multiprocessing import Value
+from multiprocessing.pool import ThreadPool
+from pymongo.errors import PyMongoError
+from pymongo.operations import UpdateOne, DeleteOne
+from bson import json_util
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from iowmongotools import app, cluster
+from iowmongotools.stats import Inhibitor, ServerStatsCollector
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+COUNTERS = ('scanned', 'unset', 'updated', 'deleted')
+
+
+class Job(object):
+    """ Removal of expired segments from one collection. Segments are maps of name to expiry timestamp,
+    e.g. written by template 'hash_of_segments'
+    """
+
+    def __init__(self, name, config):
+        if 'collection' not in config or not config.get('fields'):
+            raise AttributeError('Config of cleanup job \'%s\' must contain \'collection\' and \'fields\'' % name)
+        self.name = name
+        self.namespace = config['collection']
+        self.database, self.collection = self.namespace.split('.', 1)
+        self.fields = config['fields']  # dotted paths of maps of segments, '' is the document itself
+        self.batch_size = config.get('batch_size', 1000)
+        self.delete_empty = config.get('delete_empty', True)
+        self.write_concern = config.get('write_concern')
+        if self.delete_empty or '' in self.fields:
+            self.projection = None  # the whole document is needed to find out whether it becomes empty
+        else:
+            self.projection = dict((field.split('.')[0], 1) for field in self.fields)
+
+    @staticmethod
+    def _get(doc, path):
+        for key in path.split('.') if path else ():
+            if not isinstance(doc, dict):
+                return None
+            doc = doc.get(key)
+        return doc
+
+    @classmethod
+    def _is_empty(cls, value):
+        return isinstance(value, dict) and all(cls._is_empty(item) for item in value.values())
+
+    def expired(self, doc, now):
+        """ :returns dict of dotted paths of expired segments to their expiry timestamps """
+        out = dict()
+        for field in self.fields:
+            segments = self._get(doc, field)
+            if not isinstance(segments, dict):
+                continue
+            for segment, ts in segments.items():
+                if field == '' and segment == '_id':
+                    continue
+                if isinstance(ts, (int, float)) and not isinstance(ts, bool) and ts <= now:
+                    out['.'.join((field, segment)) if field else segment] = ts
+        return out
+
+    def get_request(self, doc, now):
+        """ The request matches the document only if its expired segments haven't been refreshed since reading.
+        DeleteOne matches only the whole document as read, so segments written after reading aren't deleted.
+        :returns tuple of request and amount of expired segments. The request is DeleteOne if nothing but expired
+        segments is left in the document, UpdateOne unsetting them otherwise, None if nothing has expired
+        """
+        expired = self.expired(doc, now)
+        if not expired:
+            return None, 0
+        if self.delete_empty:
+            left = deepcopy(doc)
+            left.pop('_id')
+            for path in expired:
+                keys = path.split('.')
+                self._get(left, '.'.join(keys[:-1])).pop(keys[-1])
+            if self._is_empty(left):
+                doc_filter = dict(doc)
+                doc_filter['$expr'] = {'$eq': [{'$size': {'$objectToArray': '$$ROOT'}}, len(doc)]}
+                return DeleteOne(doc_filter), len(expired)
+        doc_filter = {'_id': doc['_id']}
+        doc_filter.update(expired)
+        return UpdateOne(doc_filter, {'$unset': dict((path, '') for path in expired)}), len(expired)
+
+
+class Range(object):
+    """ Documents of a job between bounds of a chunk. Ranges are cleaned in parallel, progress of the pass is kept
+    by Progress
+    """
+
+    def __init__(self, job, key, bounds, cluster_name, dry=False):
+        """
+        :type job: Job
+        :param key: shard key of the collection or None if it isn't sharded
+        :param bounds: tuple of min and max of the chunk, (None, None) for the whole collection
+        """
+        self.job = job
+        self.key = key
+        self.bounds = bounds
+        self.cluster = cluster_name
+        self.dry = dry
+        self.counts = dict.fromkeys(COUNTERS, 0)
+
+    @property
+    def id(self):
+        """ Name of the range in logs """
+        return '{}:{}'.format(self.job.name, json_util.dumps(self.bounds[0]) if self.bounds[0] else '')
+
+    def find(self, collection):
+        """ :returns cursor over documents of the range """
+        lower, upper = self.bounds
+        if lower is None:
+            return collection.find({}, self.job.projection)
+        fields = list(self.key.keys())
+        if len(fields) == 1 and self.key[fields[0]] != 'hashed':
+            condition = dict()
+            if not isinstance(lower[fields[0]], MinKey):
+                condition['$gte'] = lower[fields[0]]
+            if not isinstance(upper[fields[0]], MaxKey):
+                condition['$lt'] = upper[fields[0]]
+            return collection.find({fields[0]: condition} if condition else {}, self.job.projection)
+        # ranges of hashed and compound keys are scanned by bounds of the shard key index
+        return collection.find({}, self.job.projection).hint(list(self.key.items())).min(
+            list(lower.items())).max(list(upper.items()))
+
+    def get_batch(self, collection):
+        """ :returns generator of lists of requests removing expired segments """
+        now = time.time()
+        batch = list()
+        for doc in self.find(collection):
+            self.counts['scanned'] += 1
+            request, expired = self.job.get_request(doc, now)
+            if request:
+                batch.append(request)
+                self.counts['unset'] += expired
+                if len(batch) >= self.job.batch_size:
+                    yield batch
+                    batch = list()
+        if batch:
+            yield batch
+
+    def count_bulk_write_result(self, result):
+        if result.acknowledged:
+            self.counts['updated'] += result.modified_count
+            self.counts['deleted'] += result.deleted_count
+
+
+class Progress(object):
+    """ High-water mark of shard key of a job at a cluster, everything below it has been cleaned by the current pass.
+    The mark doesn't depend on chunks, so a pass is resumed after chunks have been split or merged. Ranges are
+    cleaned in parallel, the mark moves over ranges cleaned one after another from the first pending one
+    """
+
+    def __init__(self, ranges):
+        """ :param ranges: pending ranges of the job sorted by bounds """
+        self.ranges = ranges
+        self.cleaned = 0  # amount of leading ranges which have been cleaned
+        self._done = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sortable(key, bound):
+        return tuple(cluster.sortable(bound[field]) for field in key)
+
+    @classmethod
+    def pending(cls, key, bounds, mark):
+        """ :returns bounds left after the mark. A chunk containing the mark is cleaned from the mark """
+        if mark is None or key is None or list(mark) != list(key):
+            return bounds
+        mark_value = cls.sortable(key, mark)
+        out = list()
+        for lower, upper in bounds:
+            if cls.sortable(key, upper) <= mark_value:
+                continue
+            out.append((mark, upper) if cls.sortable(key, lower) < mark_value else (lower, upper))
+        return out
+
+    def advance(self, obj):
+        """ Must be called under lock
+        :returns list of ranges the mark has moved over after obj has been cleaned
+        """
+        self._done.add(id(obj))
+        moved = list()
+        while self.cleaned < len(self.ranges) and id(self.ranges[self.cleaned]) in self._done:
+            moved.append(self.ranges[self.cleaned])
+            self.cleaned += 1
+        return moved
+
+
+class Cleaner(app.App):
+    def __init__(self):
+        super().__init__()
+        self.ranges = list()
+        self.flushed = dict()  # (job, cluster) -> counts written to metrics file previously
+        self.metrics_lock = threading.Lock()
+
+    @property
+    def default_config(self):
+        config = super().default_config
+        config.update({
+            'cleanup_jobs': (dict(),),
+            'jobs': ([], 'Names of cleanup jobs to run. All jobs if empty.'),
+            'workers': (4, 'Amount of ranges cleaned simultaneously at each cluster.'),
+            'restart': (False, 'Clean all ranges again instead of resuming the interrupted pass.'),
+            'dry': (False, 'Count expired segments without removing them.')
+        })
+        return config
+
+    def run(self):
+        timer = app.Timer()
+        timer.start()
+        if not hasattr(self.config, 'clusters'):
+            logger.error('Please provide cluster_config.yaml. See --help.')
+            return 1
+        if not self.config.cleanup_jobs:
+            logger.error('Cleanup isn\'t configured. Fill in section \'cleanup_jobs\' in config.')
+            return 1
+        for name in self.config.jobs:
+            if name not in self.config.cleanup_jobs:
+                logger.error('Unknown job %s. Fill in section \'cleanup_jobs\' in config.', name)
+                return 1
+        jobs = [Job(name, params) for name, params in self.config.cleanup_jobs.items()
+                if not self.config.jobs or name in self.config.jobs]
+        if hasattr(self.config, 'metrics'):
+            if 'prefix' not in self.config.metrics or 'path' not in self.config.metrics:
+                raise AttributeError('Config of \'metrics\' must contain \'prefix\' and \'path\'')
+            if 'flush_interval' not in self.config.metrics:
+                self.config.metrics['flush_interval'] = 60
+        for key in self.config.cluster_config.keys():
+            if 'mongo_client_settings' not in self.config.cluster_config[key] and hasattr(self.config,
+                                                                                          'mongo_client_settings'):
+                self.config.cluster_config[key]['mongo_client_settings'] = self.config.mongo_client_settings
+        errors = len(self.config.clusters) - cluster.create_objects(self.config.clusters, self.config.cluster_config)
+        if hasattr(self.config, 'redis'):
+            delays = dict()
+            for cl in cluster.Cluster.objects.values():
+                cl.uploading_delay = Value('d', 0.0)
+                delays.update({cl.name: cl.uploading_delay})
+            Inhibitor(self.config.redis, delays, getattr(self.config, 'delay_coefficient', None))
+        metrics_file = open(self.config.metrics['path'], 'w', buffering=1) if hasattr(self.config,
+                                                                                      'metrics') else None
+        if metrics_file and self.config.metrics.get('server_stats_interval'):
+            ServerStatsCollector(cluster.Cluster.objects.values(), self.config.metrics['prefix'], metrics_file,
+                                 self.metrics_lock, self.config.metrics['server_stats_interval'])
+        tasks = list()
+        for cl in cluster.Cluster.objects.values():
+            pool = ThreadPool(processes=int(self.config.workers))
+            for job in jobs:
+                try:
+                    ranges = self.plan(cl, job)
+                except PyMongoError as err:
+                    logger.error('Cannot read ranges of \'%s\' at \'%s\': %s', job.namespace, cl.name, err)
+                    errors += 1
+                    continue
+                self.ranges.extend(ranges)
+                progress = Progress(ranges)
+                tasks.append((job, cl, [pool.apply_async(self.clean, (cl, obj, progress)) for obj in ranges]))
+        try:
+            while not all(result.ready() for job, cl, results in tasks for result in results):
+                time.sleep(0.1)
+                if metrics_file:
+                    timer.execute(self.flush_metrics, (self.config.metrics['prefix'], metrics_file),
+                                  self.config.metrics['flush_interval'])
+            for job, cl, results in tasks:
+                failed = sum(result.get() for result in results)
+                if failed:
+                    logger.warning('%s ranges of \'%s\' at \'%s\' have failed. They will be cleaned by the next run.',
+                                   failed, job.name, cl.name)
+                    errors += failed
+                elif not self.config.dry:  # the pass is complete, the next one starts from the first range
+                    cl.reset_cleanup_mark(job.database, job.name)
+                logger.info('Finished \'%s\' at \'%s\'. %s', job.name, cl.name, ', '.join(
+                    '{} - {}'.format(name, value) for name, value in sorted(self.sum_counts(job.name, cl.name).items())))
+        finally:
+            timer.stop()
+            if metrics_file:
+                self.flush_metrics(self.config.metrics['prefix'], metrics_file)
+                metrics_file.close()
+        logger.info('%s', timer)
+        return errors
+
+    def plan(self, cl, job):
+        """ :returns list of ranges of the job which haven't been cleaned by the current pass """
+        key, bounds = cl.get_chunk_ranges(job.namespace)
+        if self.config.restart and not self.config.dry:
+            cl.reset_cleanup_mark(job.database, job.name)
+        pending = Progress.pending(key, bounds, cl.read_cleanup_mark(job.database, job.name))
+        logger.info('Cleaning %s of %s ranges of \'%s\' at \'%s\'.', len(pending), len(bounds), job.namespace,
+                    cl.name)
+        return [Range(job, key, item, cl.name, self.config.dry) for item in pending]
+
+    def clean(self, cl, obj, progress):
+        """ :type progress: Progress
+        :returns 0 if the range has been cleaned, 1 otherwise
+        """
+        try:
+            cl.clean_range(obj)
+            if not obj.dry:
+                with progress.lock:  # marks are saved in order
+                    moved = progress.advance(obj)
+                    if moved:
+                        counts = dict((name, sum(item.counts[name] for item in moved)) for name in COUNTERS)
+                        cl.save_cleanup_mark(obj.job.database, obj.job.name, moved[-1].bounds[1], counts)
+        except PyMongoError as err:
+            logger.error('Cannot clean range %s at \'%s\': %s', obj.id, cl.name, err)
+            return 1
+        return 0
+
+    def sum_counts(self, job, cluster_name):
+        out = dict.fromkeys(COUNTERS, 0)
+        for obj in self.ranges:
+            if obj.job.name == job and obj.cluster == cluster_name:
+                for name in COUNTERS:
+                    out[name] += obj.counts[name]
+        return out
+
+    def flush_metrics(self, prefix, metrics_file):
+        """ Writes amounts counted since the previous flush """
+        out = []
+        ts = int(time.time())
+        for job, cluster_name in sorted(set((obj.job.name, obj.cluster) for obj in self.ranges)):
+            counts = self.sum_counts(job, cluster_name)
+            previous = self.flushed.get((job, cluster_name), dict.fromkeys(COUNTERS, 0))
+            for name in COUNTERS:
+                out.append(app.format_metric(prefix, (job, cluster_name, name), counts[name] - previous[name], ts))
+            self.flushed[(job, cluster_name)] = counts
+        logger.debug('Flushing %s metrics', len(out))
+        with self.metrics_lock:
+            metrics_file.write(''.join(out))
+
+
+class MongoCleanupCli(Cleaner, app.AppCli):
+    SettingsClass = app.SettingCliCluster
@@ -1,10 +1,20 @@
 """ Manages mongo cluster """
 from iowmongotools import app
 import logging
+import hashlib
+import struct
+import time
+from bisect import bisect_right
 from time import sleep
 from multiprocessing.pool import ThreadPool
 import pymongo
+from pymongo.operations import ReplaceOne
+from pymongo.errors import OperationFailure, BulkWriteError, DuplicateKeyError
 import yaml
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from bson.objectid import ObjectId
+from bson.son import SON
 
 logger = logging.getLogger(__name__)
 
@@ -28,10 +38,185 @@ def create_objects(clusters, cluster_config):
     return counter
 
 
+def mongo_hash(value):
+    """ Computes value of hashed index for the value in the same way as mongod does (BSONElementHasher::hash64).
+    Supported types are str, int, bool and ObjectId.
+
+    :returns signed 64-bit integer
+    """
+    md5 = hashlib.md5(struct.pack('<i', 0))  # default seed of hashed indexes
+    if isinstance(value, bool):
+        md5.update(struct.pack('<i', 40))
+        md5.update(struct.pack('<?', value))
+    elif isinstance(value, int):
+        md5.update(struct.pack('<i', 10))
+        md5.update(struct.pack('<q', value))
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8') + b'\x00'
+        md5.update(struct.pack('<i', 15))
+        md5.update(struct.pack('<i', len(encoded)))
+        md5.update(encoded)
+    elif isinstance(value, ObjectId):
+        md5.update(struct.pack('<i', 35))
+        md5.update(value.binary)
+    else:
+        raise ValueError('Cannot compute hash of %s' % type(value).__name__)
+    return struct.unpack('<q', md5.digest()[:8])[0]
+
+
+def sortable(value):
+    """ :returns tuple which is compared in the same order as mongo compares values of different types """
+    if isinstance(value, MinKey):
+        return -1, 0
+    if isinstance(value, MaxKey):
+        return 127, 0
+    if isinstance(value, bool):
+        return 40, value
+    if isinstance(value, (int, float)):
+        return 10, value
+    if isinstance(value, str):
+        return 15, value
+    if isinstance(value, ObjectId):
+        return 35, value.binary
+    raise ValueError('Cannot compare values of type %s' % type(value).__name__)
+
+
+class LeaseLost(Exception):
+    def __init__(self, name, cluster_name):
+        super().__init__('Lease of file \'%s\' at \'%s\' has been taken over by another uploader.' % (
+            name, cluster_name))
+
+
+class ChunkMap(object):
+    """ Routing table of sharded collection. Built from documents of config.chunks """
+
+    def __init__(self, key, chunks):
+        """
+        :type key: dict
+        :param key: shard key, e.g. {'_id': 'hashed'}
+        :type chunks: iterable
+        :param chunks: documents from config.chunks
+        """
+        self.fields = list(key.keys())
+        self.hashed = [key[field] == 'hashed' for field in self.fields]
+        bounds = sorted((self._bound(chunk['min']), chunk['shard']) for chunk in chunks)
+        self._bounds = [bound[0] for bound in bounds]
+        self.shards = [bound[1] for bound in bounds]
+
+    def _bound(self, doc):
+        return tuple(sortable(doc[field]) for field in self.fields)
+
+    def get_key(self, doc_filter):
+        """ :returns sortable value of shard key extracted from filter of a query """
+        key = list()
+        for field, hashed in zip(self.fields, self.hashed):
+            value = doc_filter[field]
+            key.append(sortable(mongo_hash(value) if hashed else value))
+        return tuple(key)
+
+    def route(self, doc_filter):
+        """ :returns tuple of name of shard and shard key. Name is None if the filter cannot be routed """
+        try:
+            key = self.get_key(doc_filter)
+        except (KeyError, ValueError):
+            return None, ()
+        index = bisect_right(self._bounds, key) - 1
+        return (self.shards[index] if index >= 0 else None), key
+
+
+class BalancerLease(object):
+    """ Keeps balancer of a cluster stopped while at least one holder renews its lease.
+    Leases are stored in config.settings, so the balancer is started by any other holder or, after a holder crashed
+    and its lease expired, by any uploader managing the balancer of the cluster.
+    """
+    LEASE_ID = 'iowBalancerLease'
+
+    def __init__(self, cluster, owner, config=None):
+        """
+        :type cluster: Cluster
+        :type owner: str
+        :param owner: unique name of the holder, e.g. hostname and pid
+        :type config: dict
+        :param config: may contain 'lease' and 'migration_timeout' as interval strings like 10m, 1h
+        """
+        if not config:
+            config = dict()
+        self.cluster = cluster
+        self.owner = owner.replace('.', '_')
+        self.lease = app.human_to_seconds(config.get('lease', '10m'))
+        self.migration_timeout = app.human_to_seconds(config.get('migration_timeout', '30m'))
+        if self.lease <= Cluster.MIGRATION_POLL_INTERVAL * 2:  # the lease is renewed after each poll of migrations
+            raise AttributeError('Lease of balancer must be longer than {} seconds'.format(
+                Cluster.MIGRATION_POLL_INTERVAL * 2))
+        self.held = False
+
+    @property
+    def _collection(self):
+        return self.cluster._api.config['settings']
+
+    def expire(self):
+        """ Removes expired leases. Starts balancer if the last lease has expired and it was running before.
+        :returns dict of active leases
+        """
+        doc = self._collection.find_one({'_id': self.LEASE_ID})
+        if not doc:
+            return dict()
+        now = time.time()
+        owners = dict((owner, ts) for owner, ts in doc.get('owners', dict()).items() if ts > now)
+        for owner in set(doc.get('owners', dict())) - set(owners):
+            logger.warning('Lease of balancer of \'%s\' held by \'%s\' has expired.', self.cluster.name, owner)
+        if not owners:
+            self._collection.delete_one({'_id': self.LEASE_ID})
+            if doc.get('restore'):
+                logger.info('Starting balancer of \'%s\' left stopped by expired lease.', self.cluster.name)
+                self.cluster.start_balancer()
+        return owners
+
+    def acquire(self, on_wait=None):
+        """ :param on_wait: callable renewing leases while waiting for migrations, renews this lease by default
+        :returns True if the balancer is stopped and there are no migrations in progress. Otherwise the lease is
+        released
+        """
+        self.expire()
+        # only the holder creating the lease decides whether the balancer is started after the last release
+        self._collection.update_one({'_id': self.LEASE_ID},
+                                    {'$setOnInsert': {'restore': not self.cluster.is_balancer_stopped()},
+                                     '$set': {'owners.%s' % self.owner: time.time() + self.lease}}, upsert=True)
+        self.held = True
+        logger.info('Stopping balancer of \'%s\' while uploading.', self.cluster.name)
+        stopped = self.cluster.stop_balancer(self.migration_timeout, on_wait or self.renew)
+        if stopped and self.owner not in self.expire():
+            logger.error('Lease of balancer of \'%s\' has expired while waiting for migrations.', self.cluster.name)
+            stopped = False
+        if not stopped:
+            self.release()
+        return stopped
+
+    def renew(self):
+        self._collection.update_one({'_id': self.LEASE_ID},
+                                    {'$set': {'owners.%s' % self.owner: time.time() + self.lease}}, upsert=True)
+
+    def release(self):
+        if not self.held:
+            return
+        self._collection.update_one({'_id': self.LEASE_ID}, {'$unset': {'owners.%s' % self.owner: ''}})
+        self.held = False
+        doc = self._collection.find_one({'_id': self.LEASE_ID}) or dict()
+        if not doc.get('owners'):
+            self._collection.delete_one({'_id': self.LEASE_ID})
+            if doc.get('restore'):
+                logger.info('Starting balancer of \'%s\'.', self.cluster.name)
+                self.cluster.start_balancer()
+        else:
+            self.expire()
+
+
 class Cluster(object):
     """ Represents mongo cluster """
     objects = dict()
     SEGFILE_INFO_COLLECTION = 'segment_files'
+    CLEANUP_PROGRESS_COLLECTION = 'cleanup_progress'
+    MIGRATION_POLL_INTERVAL = 5
 
     def __new__(cls, name, cluster_config):
         if name not in cls.objects:
@@ -65,6 +250,8 @@ class Cluster(object):
                                         **mongo_client_settings)
         self.name = name
         self.uploading_delay = None
+        self._nodes = dict()
+        self._write_limits = None
 
     def generate_commands(self, pre_remove_dbs=(), force=False):
         """ :returns dict of lists of commands """
@@ -161,27 +348,439 @@ class Cluster(object):
                 yaml.safe_dump(actual_config, default_flow_style=False))
             return False
 
+    def get_chunk_map(self, namespace):
+        """ :returns ChunkMap of sharded collection or None if the collection isn't sharded """
+        config_db = self._api.config
+        collection = config_db['collections'].find_one({'_id': namespace})
+        if not collection or collection.get('dropped'):
+            return None
+        return ChunkMap(collection['key'], config_db['chunks'].find(self._chunks_query(collection),
+                                                                    {'min': 1, 'shard': 1}))
+
+    def get_chunk_ranges(self, namespace):
+        """ :returns tuple of shard key and list of (min, max) bounds of chunks sorted by min.
+        Shard key is None and the only range is (None, None) if the collection isn't sharded
+        """
+        config_db = self._api.config
+        collection = config_db['collections'].find_one({'_id': namespace})
+        if not collection or collection.get('dropped'):
+            return None, [(None, None)]
+        fields = list(collection['key'].keys())
+        chunks = config_db['chunks'].find(self._chunks_query(collection), {'min': 1, 'max': 1})
+        ranges = sorted(((chunk['min'], chunk['max']) for chunk in chunks),
+                        key=lambda bounds: tuple(sortable(bounds[0][field]) for field in fields))
+        return collection['key'], ranges
+
+    def _sharded_collections(self):
+        for col in self._api.config['collections'].find():
+            if not col.get('dropped'):
+                yield col
+
+    @staticmethod
+    def _chunks_query(collection):
+        """ Chunks refer to collection by uuid since mongo 5.0 """
+        return {'uuid': collection['uuid']} if 'uuid' in collection else {'ns': collection['_id']}
+
+    def _coll_stats(self, namespace):
+        database, collection = namespace.split('.', 1)
+        return self._api[database].command('collStats', collection)
+
+    @property
+    def distribution(self):
+        """ Reads distribution of chunks and data among shards of every sharded collection
+
+        :returns dict of namespaces. Values are dicts of shards with amount of 'chunks', 'jumbo' chunks,
+                 'size' of data and 'count' of documents.
+        """
+        logger.debug('Reading distribution of chunks of cluster %s', self.name)
+        shards = [shard['_id'] for shard in self._api.config['shards'].find()]
+        out = dict()
+        for collection in self._sharded_collections():
+            namespace = collection['_id']
+            out[namespace] = dict((shard, {'chunks': 0, 'jumbo': 0, 'size': 0, 'count': 0}) for shard in shards)
+            for item in self._api.config['chunks'].aggregate([
+                {'$match': self._chunks_query(collection)},
+                {'$group': {'_id': '$shard', 'chunks': {'$sum': 1},
+                            'jumbo': {'$sum': {'$cond': [{'$eq': ['$jumbo', True]}, 1, 0]}}}}]):
+                out[namespace].setdefault(item['_id'], {'chunks': 0, 'jumbo': 0, 'size': 0, 'count': 0})
+                out[namespace][item['_id']].update({'chunks': item['chunks'], 'jumbo': item['jumbo']})
+            try:
+                stats = self._coll_stats(namespace).get('shards', dict())
+            except OperationFailure as err:
+                logger.warning('Cannot get stats of %s at cluster \'%s\': %s', namespace, self.name, err)
+                stats = dict()
+            for shard, shard_stats in stats.items():
+                out[namespace].setdefault(shard, {'chunks': 0, 'jumbo': 0, 'size': 0, 'count': 0})
+                out[namespace][shard].update({'size': shard_stats.get('size', 0), 'count': shard_stats.get('count', 0)})
+        return out
+
+    @staticmethod
+    def imbalance(values):
+        """ :returns ratio of maximum to mean value """
+        values = list(values)
+        if not values or not sum(values):
+            return 1.0
+        return max(values) * len(values) / sum(values)
+
+    def check_distribution(self, max_chunks_imbalance=1.5, max_size_imbalance=1.5, max_jumbo_chunks=0):
+        """ Checks skew of sharded collections.
+
+        :returns tuple of result of check and list of metrics. Metric is a pair of tuple of name parts and value.
+        """
+        ok = True
+        metrics = list()
+        for namespace, shards in self.distribution.items():
+            ratios = (('chunks_imbalance', self.imbalance(shard['chunks'] for shard in shards.values()),
+                       float(max_chunks_imbalance)),
+                      ('size_imbalance', self.imbalance(shard['size'] for shard in shards.values()),
+                       float(max_size_imbalance)),
+                      ('jumbo_chunks', sum(shard['jumbo'] for shard in shards.values()), int(max_jumbo_chunks)))
+            for shard, values in shards.items():
+                for name, value in sorted(values.items()):
+                    metrics.append(((self.name, namespace, shard, name), value))
+            for name, value, threshold in ratios:
+                metrics.append(((self.name, namespace, name), round(value, 3)))
+                if value > threshold:
+                    ok = False
+                    logger.warning('Collection %s at cluster \'%s\' has %s %s above threshold %s.\n%s', namespace,
+                                   self.name, name, round(value, 3), threshold,
+                                   yaml.safe_dump(shards, default_flow_style=False))
+        if ok:
+            logger.info('Distribution of chunks of cluster \'%s\' is balanced.', self.name)
+        return ok, metrics
+
+    @property
+    def nodes(self):
+        """ :returns dict of names of mongos and shards declared in config and MongoClient to each of them """
+        if not self._nodes:
+            for host in self._declared_config.get('mongos', []) + self._declared_config.get('shards', []):
+                if '/' in host:  # replica set, e.g. 'rs0/host1:27019,host2:27019'
+                    replica_set, hosts = host.split('/', 1)
+                    uri = 'mongodb://%s/?replicaSet=%s' % (hosts, replica_set)
+                else:
+                    uri = 'mongodb://%s' % host
+                self._nodes[host] = pymongo.MongoClient(uri, connect=False, serverSelectionTimeoutMS=5000)
+        return self._nodes
+
+    def server_stats(self, node):
+        """ Reads serverStatus and replSetGetStatus of a mongos or a shard
+
+        :returns dict of metrics. Keys are tuples of parts of names.
+        """
+        api = self.nodes[node]
+        status = api.admin.command('serverStatus')
+        out = dict()
+        for name, value in status.get('opcounters', dict()).items():
+            out[('opcounters', name)] = value
+        for name in ('reads', 'writes', 'commands'):
+            latencies = status.get('opLatencies', dict()).get(name, dict())
+            if 'ops' in latencies:
+                out[('latency', name, 'ops')] = latencies['ops']
+                out[('latency', name, 'micros')] = latencies['latency']
+        global_lock = status.get('globalLock', dict())
+        for section in ('currentQueue', 'activeClients'):
+            for name in ('total', 'readers', 'writers'):
+                if name in global_lock.get(section, dict()):
+                    out[(section, name)] = global_lock[section][name]
+        cache = status.get('wiredTiger', dict()).get('cache', dict())
+        if cache.get('maximum bytes configured'):
+            out[('cache', 'used_ratio')] = round(
+                cache.get('bytes currently in the cache', 0) / cache['maximum bytes configured'], 4)
+            out[('cache', 'dirty_ratio')] = round(
+                cache.get('tracked dirty bytes in the cache', 0) / cache['maximum bytes configured'], 4)
+        if status.get('process') == 'mongod' and 'repl' in status:
+            out[('replication', 'lag')] = self.replication_lag(api.admin.command('replSetGetStatus'))
+        return out
+
+    @staticmethod
+    def replication_lag(repl_status):
+        """ :returns the biggest lag of secondary members behind primary in seconds """
+        members = repl_status.get('members', [])
+        primary = [m['optimeDate'] for m in members if m.get('stateStr') == 'PRIMARY']
+        secondaries = [m['optimeDate'] for m in members if m.get('stateStr') == 'SECONDARY']
+        if not primary or not secondaries:
+            return 0
+        return max(0, max((primary[0] - optime).total_seconds() for optime in secondaries))
+
+    def is_balancer_running(self):
+        """ :returns True if the balancer is in the middle of a round, i.e. chunks may be being migrated """
+        try:
+            return bool(self._api.admin.command('balancerStatus').get('inBalancerRound'))
+        except OperationFailure:  # mongo < 3.4
+            lock = self._api.config['locks'].find_one({'_id': 'balancer'})
+            return bool(lock and lock.get('state', 0) > 0)
+
+    def is_balancer_stopped(self):
+        settings = self._api.config['settings'].find_one({'_id': 'balancer'}) or dict()
+        return bool(settings.get('stopped')) or settings.get('mode') == 'off'
+
+    def stop_balancer(self, timeout=1800, on_wait=None):
+        """ Stops the balancer and waits until active migrations are finished
+        :param on_wait: callable called after each poll of migrations
+        :returns True if there are no migrations in progress
+        """
+        self._api.config['settings'].update_one({'_id': 'balancer'}, {'$set': {'stopped': True}}, upsert=True)
+        started_ts = time.time()
+        while self.is_balancer_running():
+            if time.time() - started_ts > timeout:
+                logger.error('Balancer of \'%s\' hasn\'t finished migration in %s seconds.', self.name, timeout)
+                return False
+            logger.info('Waiting for balancer of \'%s\' to finish migration.', self.name)
+            sleep(self.MIGRATION_POLL_INTERVAL)
+            if on_wait:
+                on_wait()
+        return True
+
+    def start_balancer(self):
+        self._api.config['settings'].update_one({'_id': 'balancer'}, {'$set': {'stopped': False}}, upsert=True)
+
     def read_segfile_info(self, obj):
         collection = self._api[obj.strategy.database][self.SEGFILE_INFO_COLLECTION]
         obj.load_metadata(collection.find_one(obj.name))
 
     def save_segfile_info(self, obj):
         collection = self._api[obj.strategy.database][self.SEGFILE_INFO_COLLECTION]
-        collection.replace_one({'_id': obj.name}, obj.dump_metadata(), upsert=True)
+        if obj.claim:  # the lease is released by replacing. Nothing is saved if the lease has been lost
+            collection.replace_one({'_id': obj.name, 'lease.owner': obj.claim['owner']}, obj.dump_metadata())
+        else:
+            collection.replace_one({'_id': obj.name}, obj.dump_metadata(), upsert=True)
+
+    def read_segfiles_info(self, objects):
+        """ Reads metadata of files of one strategy by one query
+        :returns dict of name of file to its metadata
+        """
+        collection = self._api[objects[0].strategy.database][self.SEGFILE_INFO_COLLECTION]
+        return dict((doc['_id'], doc) for doc in collection.find({'_id': {'$in': [obj.name for obj in objects]}}))
+
+    def save_segfiles_info(self, objects, pack=None):
+        """ Saves metadata of files of one strategy by one bulk write the same way as save_segfile_info()
+        :param pack: SegmentPack whose record is saved along with its files
+        """
+        collection = self._api[objects[0].strategy.database][self.SEGFILE_INFO_COLLECTION]
+        requests = list()
+        if pack:
+            requests.append(ReplaceOne({'_id': pack.name}, pack.dump_metadata(), upsert=True))
+        for obj in objects:
+            if obj.claim:
+                requests.append(ReplaceOne({'_id': obj.name, 'lease.owner': obj.claim['owner']}, obj.dump_metadata()))
+            else:
+                requests.append(ReplaceOne({'_id': obj.name}, obj.dump_metadata(), upsert=True))
+        collection.bulk_write(requests, ordered=False)
+
+    def claim_segfile(self, obj):
+        """ Takes lease of the file at the cluster for obj.claim['owner']. Expired lease of dead uploader is taken over
+        :returns True if the file is claimed, False if it's being uploaded by another uploader
+        """
+        collection = self._api[obj.strategy.database][self.SEGFILE_INFO_COLLECTION]
+        now = time.time()
+        try:
+            collection.find_one_and_update(
+                {'_id': obj.name, '$or': [{'lease': {'$exists': False}}, {'lease.expires_ts': {'$lt': now}},
+                                          {'lease.owner': obj.claim['owner']}]},
+                {'$set': {'lease': {'owner': obj.claim['owner'], 'expires_ts': now + obj.claim['lease']}}},
+                upsert=True)
+        except DuplicateKeyError:  # the document exists and it's leased by another uploader
+            return False
+        return True
+
+    def renew_segfile_claim(self, obj):
+        """ :param obj: SegmentFile or SegmentPack whose files are renewed at once """
+        collection = self._api[obj.strategy.database][self.SEGFILE_INFO_COLLECTION]
+        names = [segfile.name for segfile in getattr(obj, 'segfiles', [obj])]
+        result = collection.update_many({'_id': {'$in': names}, 'lease.owner': obj.claim['owner']},
+                                        {'$set': {'lease.expires_ts': time.time() + obj.claim['lease']}})
+        if result.matched_count < len(names):
+            raise LeaseLost(obj.name, self.name)
+
+    def release_segfile_claim(self, obj):
+        if not obj.claim:
+            return
+        collection = self._api[obj.strategy.database][self.SEGFILE_INFO_COLLECTION]
+        collection.update_one({'_id': obj.name, 'lease.owner': obj.claim['owner']}, {'$unset': {'lease': ''}})
+
+    def save_stream_checkpoint(self, obj):
+        """ Counts segments and lines of a stream which have been uploaded """
+        collection = self._api[obj.strategy.database][self.SEGFILE_INFO_COLLECTION]
+        collection.update_one({'_id': obj.source.stream},
+                              {'$set': {'stream': True, 'provider': obj.provider, 'last_segment': obj.name,
+                                        'updated_ts': time.time()},
+                               '$inc': {'segments': 1, 'lines': obj.counter.line_total}}, upsert=True)
+
+    def read_cleanup_mark(self, database, job):
+        """ :returns bound of shard key below which the current pass of the job has cleaned everything, or None """
+        doc = self._api[database][self.CLEANUP_PROGRESS_COLLECTION].find_one({'_id': job})
+        return doc['mark'] if doc else None
+
+    def save_cleanup_mark(self, database, job, mark, counts):
+        """ Moves the mark of the job and adds counts of ranges it has moved over """
+        collection = self._api[database][self.CLEANUP_PROGRESS_COLLECTION]
+        collection.update_one({'_id': job}, {'$set': {'mark': mark, 'updated_ts': time.time()}, '$inc': counts},
+                              upsert=True)
+
+    def reset_cleanup_mark(self, database, job):
+        """ Forgets the mark, so the next pass of the job starts from the first range """
+        self._api[database][self.CLEANUP_PROGRESS_COLLECTION].delete_one({'_id': job})
+
+    def throttle(self, timer, mutable_var):
+        """ Suspends writing for delay which is adjusted according to mongo timeouts """
+        if self.uploading_delay:
+            if self.uploading_delay.value > 0:
+                mutable_var[2] += self.uploading_delay.value
+                sleep(self.uploading_delay.value)
+                timer.execute(self.flush_delay_to_log, (mutable_var,), 60)
 
     def upload_segfile(self, obj):
         wc = obj.strategy.write_concern or dict()
         collection = self._api[obj.strategy.database].get_collection(obj.strategy.collection,
                                                                      write_concern=pymongo.WriteConcern(**wc))
+        if obj.strategy.load_mode == 'staging':
+            return self.stage_segfile(obj, collection)
+        timer = app.Timer()
+        mutable_var = [self.name, obj.provider, 0.0]
+        batches = obj.get_batch()
+        if obj.strategy.shard_aware_window:
+            chunk_map = self.get_chunk_map('.'.join((obj.strategy.database, obj.strategy.collection)))
+            if chunk_map:
+                batches = obj.get_sorted_batch(chunk_map)
+            else:
+                obj.log('warning', 'Collection isn\'t sharded. Requests won\'t be grouped by shards.')
+        for batch in batches:
+            if obj.claim:
+                timer.execute(self.renew_segfile_claim, (obj,), obj.claim['lease'] / 3)
+            if obj.strategy.skip_unchanged is not None:
+                batch = self.drop_unchanged(collection, batch, obj)
+                if not batch:
+                    continue
+            self.throttle(timer, mutable_var)
+            if obj.strategy.write_mode == 'raw':
+                obj.shared_metrics[2] += self.write_raw_batch(collection, batch, wc, obj.counter,
+                                                              self.get_write_limits())
+            else:
+                obj.shared_metrics[2] += obj.counter.count_bulk_write_result(
+                    collection.bulk_write(batch, ordered=False))
+
+    def stage_segfile(self, obj, collection):
+        """ Inserts documents of the file to staging collection without secondary indexes by unordered batches,
+        then the server merges them into the target collection
+        """
+        staging = collection.database.get_collection('{}.staging.{}'.format(collection.name, obj.name),
+                                                     write_concern=collection.write_concern)
+        staging.drop()  # left by interrupted upload
         timer = app.Timer()
         mutable_var = [self.name, obj.provider, 0.0]
         for batch in obj.get_batch():
-            if self.uploading_delay:
-                if self.uploading_delay.value > 0:
-                    mutable_var[2] += self.uploading_delay.value
-                    sleep(self.uploading_delay.value)
-                    timer.execute(self.flush_delay_to_log, (mutable_var,), 60)
-            obj.shared_metrics[2] += obj.counter.count_bulk_write_result(collection.bulk_write(batch, ordered=False))
+            if obj.claim:
+                timer.execute(self.renew_segfile_claim, (obj,), obj.claim['lease'] / 3)
+            self.throttle(timer, mutable_var)
+            staging.insert_many(batch, ordered=False)
+            obj.counter.staged += len(batch)
+            obj.shared_metrics[2] += len(batch)
+        obj.log('info', 'Merging {} staged documents into {}.'.format(obj.counter.staged, collection.name))
+        staging.aggregate(obj.strategy.get_merge_pipeline(collection.name), allowDiskUse=True)
+        staging.drop()
+
+    def create_indexes(self, strategy):
+        """ Builds indexes listed in 'staging_indexes' of strategy """
+        collection = self._api[strategy.database][strategy.collection]
+        for index in strategy.staging_indexes:
+            logger.info('Building index %s of %s.%s at \'%s\'.', index, strategy.database, strategy.collection,
+                        self.name)
+            collection.create_index(list(index.items()))
+
+    def clean_range(self, obj):
+        """ Removes expired segments from documents of a range of shard key
+        :param obj: cleanup.Range
+        """
+        wc = obj.job.write_concern or dict()
+        collection = self._api[obj.job.database].get_collection(obj.job.collection,
+                                                                write_concern=pymongo.WriteConcern(**wc))
+        timer = app.Timer()
+        mutable_var = [self.name, obj.job.name, 0.0]
+        for batch in obj.get_batch(collection):
+            self.throttle(timer, mutable_var)
+            if not obj.dry:
+                obj.count_bulk_write_result(collection.bulk_write(batch, ordered=False))
+
+    @staticmethod
+    def drop_unchanged(collection, batch, obj):
+        """ Reads documents touched by the batch in one query
+        :returns list of requests which change something
+        """
+        strategy = obj.strategy
+        key = strategy.skip_unchanged['key']
+        parts = [strategy.decode_request(request) for request in batch]
+        projection = set([key.split('.')[0]])
+        for doc_filter, update in parts:
+            projection.update(path.split('.')[0] for path in doc_filter)
+            for statement in update.values():
+                projection.update(path.split('.')[0] for path in statement)
+        values = [doc_filter[key] for doc_filter, update in parts if not isinstance(doc_filter.get(key, {}), dict)]
+        current = dict((strategy.get_value(doc, key), doc) for doc in collection.find(
+            {key: {'$in': values}}, dict((field, 1) for field in projection)))
+        out = list()
+        for request, (doc_filter, update) in zip(batch, parts):
+            doc = None if isinstance(doc_filter.get(key, {}), dict) else current.get(doc_filter[key])
+            if doc is None or strategy.is_changing(doc, doc_filter, update):
+                out.append(request)
+                if doc is not None:  # later requests of the batch are compared with the document as updated
+                    current[doc_filter[key]] = strategy.apply_update(doc, update)
+        obj.counter.unchanged += len(batch) - len(out)
+        return out
+
+    def get_write_limits(self):
+        """ :returns maxBsonObjectSize and maxWriteBatchSize of the cluster taken from reply of 'hello' """
+        if self._write_limits is None:
+            try:
+                reply = self._api.admin.command('hello')
+            except OperationFailure:  # before 4.4.2
+                reply = self._api.admin.command('isMaster')
+            self._write_limits = reply.get('maxBsonObjectSize', 16777216), reply.get('maxWriteBatchSize', 100000)
+        return self._write_limits
+
+    @staticmethod
+    def split_raw_batch(batch, limits):
+        """ Splits pre-encoded statements into parts fitting one 'update' command
+        :param limits: maxBsonObjectSize and maxWriteBatchSize
+        :returns list of (offset of the part in batch, statements)
+        """
+        max_size = limits[0] - 16384  # room for other fields of the command
+        out = list()
+        start = 0
+        size = 0
+        for i, statement in enumerate(batch):
+            statement_size = len(statement.raw) + len(str(i - start)) + 2  # type and index of array element
+            if i > start and (size + statement_size > max_size or i - start >= limits[1]):
+                out.append((start, batch[start:i]))
+                start = i
+                statement_size = len(statement.raw) + 3
+                size = 0
+            size += statement_size
+        if start < len(batch):
+            out.append((start, batch[start:]))
+        return out
+
+    @staticmethod
+    def write_raw_batch(collection, batch, write_concern, counter, limits=(16777216, 100000)):
+        """ Sends pre-encoded update statements by unordered 'update' commands, as few as limits of the server allow
+        :param limits: maxBsonObjectSize and maxWriteBatchSize
+        :returns amount of matched and upserted documents
+        """
+        total = 0
+        for offset, statements in Cluster.split_raw_batch(batch, limits):
+            command = SON([('update', collection.name), ('updates', statements), ('ordered', False)])
+            if write_concern:
+                command['writeConcern'] = write_concern
+            reply = collection.database.command(command)
+            if reply.get('writeErrors') or reply.get('writeConcernError'):
+                errors = [dict(error, index=error['index'] + offset) for error in reply.get('writeErrors', [])]
+                raise BulkWriteError({'writeErrors': errors,
+                                      'writeConcernErrors': [reply['writeConcernError']] if reply.get(
+                                          'writeConcernError') else [],
+                                      'nMatched': reply.get('n', 0), 'nModified': reply.get('nModified', 0),
+                                      'upserted': reply.get('upserted', [])})
+            if write_concern.get('w') != 0:
+                total += counter.count_update_reply(reply)
+        return total
 
     @staticmethod
     def flush_delay_to_log(mutable_var):
@@ -1,43 +1,136 @@
 #!/usr/bin/env python3
 """ Filesystem helpers """
 import os
+import io
 import logging
 import re
+import select
+import sqlite3
+import stat
+import sys
+import tempfile
 import time
 from abc import ABC, abstractmethod
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from multiprocessing import Process, Event, SimpleQueue
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 NAMES_MAP = {
-    'local': 'LocalFilesObserver'
+    'local': 'LocalFilesObserver',
+    's3': 'S3FilesObserver',
+    'stream': 'StreamObserver'
 }
 
 
+class DiscoveryIndex(object):
+    """ On-disk index of files of a delivery. Keeps size, mtime and inode of every dispatched file
+    and clusters the file has been uploaded to. The sqlite connection is opened lazily by each process
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._pid = os.getpid()
+            self._connection.execute('CREATE TABLE IF NOT EXISTS files '
+                                     '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS completed '
+                                     '(path TEXT, cluster TEXT, PRIMARY KEY (path, cluster))')
+        return self._connection
+
+    @staticmethod
+    def signature(path, stat=None):
+        """ :param stat: result of stat of the file if it's known, e.g. by os.DirEntry.stat()
+        :returns tuple of size, mtime in nanoseconds and inode of the file
+        """
+        stat = stat or os.stat(path)
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def load(self, clusters):
+        """ :returns map of path to signature of files which have been uploaded to all given clusters """
+        completed = dict()
+        for path, cluster in self.connection.execute('SELECT path, cluster FROM completed'):
+            completed.setdefault(path, set()).add(cluster)
+        out = dict()
+        for path, size, mtime, inode in self.connection.execute('SELECT path, size, mtime, inode FROM files'):
+            if path in completed and completed[path].issuperset(clusters):
+                out[path] = (size, mtime, inode)
+        return out
+
+    def add(self, path, signature):
+        """ Registers dispatched file. Completion state is reset if the file has changed """
+        self.add_many([(path, signature)])
+
+    def add_many(self, files):
+        """ Registers dispatched files by one transaction
+        :param files: list of path and signature
+        """
+        with self.connection:
+            for path, signature in files:
+                row = self.connection.execute('SELECT size, mtime, inode FROM files WHERE path = ?',
+                                              (path,)).fetchone()
+                if row is not None and tuple(row) == tuple(signature):
+                    continue
+                self.connection.execute('DELETE FROM completed WHERE path = ?', (path,))
+                self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                        (path,) + tuple(signature))
+
+    def mark_done(self, path, cluster):
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO completed VALUES (?, ?)', (path, cluster))
+
+    def prune(self, paths):
+        """ Removes files absent from given paths """
+        absent = [(row[0],) for row in self.connection.execute('SELECT path FROM files') if row[0] not in paths]
+        with self.connection:
+            self.connection.executemany('DELETE FROM files WHERE path = ?', absent)
+            self.connection.executemany('DELETE FROM completed WHERE path = ?', absent)
+        return len(absent)
+
+
 class EventHandler(object):
 
     def __init__(self):
         self.items_ready = Event()
         self.queue = SimpleQueue()
+        self.clusters = list()  # clusters the files are uploaded to
 
     def on_modify(self, path):
         logger.warning('Size of %s is changing (%s). Probably file is being uploaded now. Waiting for it.',
                        path, os.path.getsize(path))
         self.items_ready.clear()
 
-    def on_file_discovered(self, path):
+    def on_file_discovered(self, path, size=None, fresh=False, index=None, source=None):
+        """
+        :param size: size of the file, if it is known by observer
+        :param fresh: False if the file is found by the first scan of delivery, i.e. it is backlog
+        :param index: DiscoveryIndex of the delivery, if it is set
+        :param source: S3Source if the file is remote, None if it is local
+        """
         self.items_ready.set()
 
     def sort(self, files):
         return sorted(list(files))
 
-    def dispatch(self, path, type_name):
+    def dispatch(self, path, type_name, **kwargs):
         method_map = {
             'IN_CLOSE_WRITE': 'on_file_discovered',
             'IN_MODIFY': 'on_modify',
         }
-        getattr(self, method_map[type_name])(path)
+        getattr(self, method_map[type_name])(path, **kwargs)
 
 
 class Observer(Process, ABC):
@@ -49,6 +142,7 @@ class Observer(Process, ABC):
             raise TypeError("Only instances of '%s' class are allowed" % EventHandler.__name__)
         self.observable = handler
         self._files_prev = set()
+        self.scanned = False  # whether the first scan is done
         # Automatically starting
         self.start()
 
@@ -77,37 +171,336 @@ class LocalFilesObserver(Observer):
         self.filename = re.compile(config.get('filename', '.*'))
         self.recursive = config.get('recursive', False)
         self.polling_interval = config.get('polling_interval', 5)
+        self.index = DiscoveryIndex(config['index']) if config.get('index') else None
+        self.completed = dict()  # files uploaded to all clusters before start according to index, until first scan
+        self._entries = dict()  # path to os.DirEntry of files found by the last scan, their stat is cached by entry
         super().__init__(handler)
 
+    def _scan(self, path):
+        """ :returns generator of entries of files of the directory, of subdirectories too if 'recursive' is set """
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                if self.recursive:
+                    yield from self._scan(entry.path)
+            elif self.filename.match(entry.name):
+                yield entry
+
     @property
     def files(self):
-        matches = set()
-        for root, dirnames, filenames in os.walk(self.path):
-            if root != self.path and not self.recursive:
-                continue
-            for filename in filenames:
-                if self.filename.match(filename):
-                    matches.add(os.path.join(root, filename))
+        self._entries = dict((entry.path, entry) for entry in self._scan(self.path))
+        matches = set(self._entries)
+        if self.index and not self.scanned:
+            pruned = self.index.prune(matches)
+            if pruned:
+                logger.info('%s files have disappeared from %s since the last run', pruned, self.path)
+        if self.completed and not self.scanned:
+            # completed files are taken as seen by the previous scan, so they aren't checked by later ones
+            self._files_prev.update(fl for fl in matches if self.is_completed(fl))
+            self.completed = dict()
         return matches
 
+    def is_completed(self, path):
+        """ Whether the file has been uploaded to all clusters and hasn't changed since """
+        if path not in self.completed:
+            return False
+        try:
+            return self.completed[path] == self.signature(path)
+        except FileNotFoundError:
+            return False
+
+    def signature(self, path):
+        """ Signature of the file by stat of its entry, which is taken once per scan """
+        entry = self._entries.get(path)
+        return DiscoveryIndex.signature(path, entry.stat() if entry else None)
+
     def run(self):
+        if self.index:
+            self.completed = self.index.load(self.observable.clusters)
+            logger.info('%s files of %s are already uploaded according to index', len(self.completed), self.path)
         while True:
             self.observable.items_ready.clear()
-            for path in self.get_ready_file(self.get_new_files()):
-                self.observable.dispatch(path, 'IN_CLOSE_WRITE')
+            for ready in self.get_ready_files(self.get_new_files()):
+                if self.index:  # files are registered before dispatching, so workers can mark them done
+                    self.index.add_many([(path, self.signature(path)) for path, size in ready])
+                for path, size in ready:
+                    self.observable.dispatch(path, 'IN_CLOSE_WRITE', size=size, fresh=self.scanned, index=self.index)
+            self.scanned = True
             self.observable.items_ready.set()
             time.sleep(self.polling_interval)
 
-    def get_ready_file(self, new_files):
+    def get_ready_files(self, new_files):
+        """ :returns generator of lists of files and their sizes which haven't changed since the previous check.
+        Usually all new files of a scan are ready by the first check
+        """
         files = OrderedDict()
         for fl in new_files:
             files[fl] = os.path.getsize(fl)
         while files:
             time.sleep(self.polling_interval / 2)
+            ready = list()
             for fl, size in files.copy().items():
                 if os.path.getsize(fl) == size:
                     del (files[fl])
-                    yield fl
+                    ready.append((fl, size))
                 else:
                     files[fl] = os.path.getsize(fl)
                     self.observable.dispatch(fl, 'IN_MODIFY')
+            if ready:
+                yield ready
+
+
+class S3Source(object):
+    """ S3-compatible storage which files are streamed from. boto3 client is created lazily by each process,
+    so the object is passed to workers instead of the client
+    """
+    client_factory = None  # callable receiving client settings. Allows using stand-ins of S3
+
+    def __init__(self, config):
+        if 'bucket' not in config:
+            raise AttributeError('Delivery \'s3\' must have \'bucket\'')
+        self.bucket = config['bucket']
+        self.client_settings = config.get('client_settings', dict())
+        self.part_size = config.get('part_size', 8388608)
+        self.parallel_parts = config.get('parallel_parts', 4)
+        self._client = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_client'] = None
+        return state
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            if self.client_factory:
+                self._client = self.client_factory(self.client_settings)
+            else:
+                import boto3  # optional dependency
+                self._client = boto3.client('s3', **self.client_settings)
+            self._pid = os.getpid()
+        return self._client
+
+    def get_path(self, key):
+        return 's3://{}/{}'.format(self.bucket, key)
+
+    def get_key(self, path):
+        return path[len(self.get_path('')):]
+
+    def list(self, prefix='', start_after=''):
+        """ Lists objects with keys greater than 'start_after'
+        :return: generator of key and size
+        """
+        params = {'Bucket': self.bucket, 'Prefix': prefix}
+        if start_after:
+            params['StartAfter'] = start_after
+        while True:
+            response = self.client.list_objects_v2(**params)
+            for item in response.get('Contents', ()):
+                yield item['Key'], item['Size']
+            if not response.get('IsTruncated'):
+                break
+            params['ContinuationToken'] = response['NextContinuationToken']
+
+    def get_size(self, path):
+        return self.client.head_object(Bucket=self.bucket, Key=self.get_key(path))['ContentLength']
+
+    def open(self, path, size=None):
+        """ :return: binary stream of the object read by ranged requests in parallel """
+        if size is None:
+            size = self.get_size(path)
+        return io.BufferedReader(RangedReader(self, self.get_key(path), size), buffer_size=self.part_size)
+
+
+class RangedReader(io.RawIOBase):
+    """ Reads object sequentially, while next parts are being downloaded by parallel ranged GETs """
+
+    def __init__(self, source, key, size):
+        super().__init__()
+        self.source = source
+        self.key = key
+        self.size = size
+        self._offset = 0  # offset of the next part to request
+        self._parts = deque()
+        self._buffer = b''
+        self._pool = ThreadPool(processes=source.parallel_parts)
+        self._request_parts()
+
+    def readable(self):
+        return True
+
+    def _get_part(self, start, end):
+        response = self.source.client.get_object(Bucket=self.source.bucket, Key=self.key,
+                                                 Range='bytes={}-{}'.format(start, end))
+        return response['Body'].read()
+
+    def _request_parts(self):
+        while len(self._parts) < self.source.parallel_parts and self._offset < self.size:
+            end = min(self._offset + self.source.part_size, self.size) - 1
+            self._parts.append(self._pool.apply_async(self._get_part, (self._offset, end)))
+            self._offset = end + 1
+
+    def readinto(self, b):
+        if not self._buffer:
+            if not self._parts:
+                return 0
+            self._buffer = self._parts.popleft().get()
+            self._request_parts()
+        length = min(len(b), len(self._buffer))
+        b[:length] = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        return length
+
+    def close(self):
+        if not self.closed:
+            self._pool.terminate()
+        super().close()
+
+
+class S3FilesObserver(Observer):
+    """ Lists objects of S3-compatible storage by prefix. Only keys greater than the last seen one are requested,
+    so keys of new objects must grow, e.g. contain date
+    """
+
+    def __init__(self, handler, config):
+        self.source = S3Source(config)
+        self.prefix = config.get('prefix', '')
+        self.filename = re.compile(config.get('filename', '.*'))
+        self.polling_interval = config.get('polling_interval', 60)
+        self.last_key = config.get('start_after', '')
+        self.sizes = dict()
+        super().__init__(handler)
+
+    @property
+    def files(self):
+        self.sizes = dict()
+        for key, size in self.source.list(self.prefix, self.last_key):
+            self.last_key = max(self.last_key, key)
+            if self.filename.match(key.rsplit('/', 1)[-1]):
+                self.sizes[self.source.get_path(key)] = size
+        return set(self.sizes.keys())
+
+    def run(self):
+        while True:
+            self.observable.items_ready.clear()
+            for path in self.get_new_files():
+                self.observable.dispatch(path, 'IN_CLOSE_WRITE', size=self.sizes[path], fresh=self.scanned,
+                                         source=self.source)
+            self.scanned = True
+            self.observable.items_ready.set()
+            time.sleep(self.polling_interval)
+
+
+class StreamSegment(object):
+    """ Lines read from stdin or named pipe. They are spooled to a file, so only its path is passed to workers """
+
+    def __init__(self, stream, spool_path):
+        self.stream = stream  # name of stream
+        self.spool_path = spool_path
+        self.pending = 0  # clusters which haven't finished the segment yet. Counted by the main process
+
+    def get_size(self, path):
+        return os.path.getsize(self.spool_path)
+
+    def open(self, path, size=None):
+        return open(self.spool_path, 'rb')
+
+    def finish(self):
+        """ Removes the spool file after the segment is finished by all clusters """
+        self.pending -= 1
+        if self.pending <= 0:
+            try:
+                os.remove(self.spool_path)
+            except FileNotFoundError:
+                pass
+
+
+class StreamObserver(Observer):
+    """ Reads lines from stdin or named pipe and cuts them into segments by amount of lines or time """
+
+    def __init__(self, handler, config):
+        if 'name' not in config:
+            raise AttributeError('Delivery \'stream\' must have \'name\'')
+        self.stream = config['name']  # not 'name', which is name of the process
+        self.path = config.get('path', '-')
+        self.segment_lines = config.get('segment_lines', 100000)
+        self.segment_interval = config.get('segment_interval', 60)
+        self.suffix = config.get('suffix', '.tsv')
+        self.spool = config.get('spool', tempfile.gettempdir())
+        self.max_segments = config.get('max_segments', 10)
+        self.started = int(time.time())  # makes names of segments unique among runs
+        self.sequence = 0
+        self._stdin = os.dup(sys.stdin.fileno()) if self.path == '-' else None  # child process gets devnull as stdin
+        super().__init__(handler)
+
+    @property
+    def files(self):
+        return set()
+
+    def run(self):
+        self.observable.items_ready.clear()
+        while True:
+            fd = self._stdin if self._stdin is not None else os.open(self.path, os.O_RDONLY)
+            self.read(fd)
+            os.close(fd)
+            if self._stdin is not None or not stat.S_ISFIFO(os.stat(self.path).st_mode):
+                break
+            logger.info('Writer of %s has closed the pipe. Waiting for the next one.', self.path)
+        logger.info('Stream %s has ended', self.stream)
+        self.observable.items_ready.set()
+
+    def read(self, fd):
+        pending = bytearray()
+        lines = 0
+        started = time.time()
+        while True:
+            timeout = max(0, self.segment_interval - (time.time() - started))
+            if select.select([fd], [], [], timeout)[0]:
+                chunk = os.read(fd, 1048576)
+                if not chunk:
+                    break
+                pending.extend(chunk)
+                lines += chunk.count(b'\n')
+                while lines >= self.segment_lines:
+                    end = self.find_line_end(pending, self.segment_lines)
+                    self.emit(bytes(pending[:end]))
+                    del pending[:end]
+                    lines -= self.segment_lines
+                    started = time.time()
+            if time.time() - started >= self.segment_interval:
+                end = pending.rfind(b'\n') + 1
+                if end:
+                    self.emit(bytes(pending[:end]))
+                    del pending[:end]
+                    lines = 0
+                started = time.time()
+        if pending:
+            self.emit(bytes(pending))
+
+    @staticmethod
+    def find_line_end(data, lines):
+        """ :returns position after the given amount of lines """
+        end = -1
+        for _ in range(lines):
+            end = data.find(b'\n', end + 1)
+        return end + 1
+
+    def emit(self, data):
+        if self.spooled() >= self.max_segments:
+            logger.info('%s segments of %s are being uploaded. Stop reading the stream.', self.max_segments,
+                        self.stream)
+            while self.spooled() >= self.max_segments:
+                time.sleep(1)
+        self.sequence += 1
+        name = '{}_{}_{:06d}{}'.format(self.stream, self.started, self.sequence, self.suffix)
+        spool_path = os.path.join(self.spool, name)
+        with open(spool_path, 'wb') as f_out:
+            f_out.write(data)
+        self.observable.dispatch('stream://{}/{}'.format(self.stream, name), 'IN_CLOSE_WRITE', size=len(data),
+                                 fresh=True, source=StreamSegment(self.stream, spool_path))
+        self.observable.items_ready.clear()  # the stream isn't over. Items are ready only when queue isn't empty
+
+    def spooled(self):
+        """ :returns amount of segments of this run which haven't been uploaded to all clusters yet """
+        prefix = '{}_{}_'.format(self.stream, self.started)
+        return len([name for name in os.listdir(self.spool) if name.startswith(prefix)])
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+""" Schedulers deciding which segment file is uploaded to which cluster next """
+import heapq
+import itertools
+import time
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+NAMES_MAP = {
+    'fifo': 'FifoScheduler',
+    'fair': 'FairScheduler'
+}
+
+
+def create(config, providers, clusters, workers):
+    """ :returns instance of scheduler described in config, FifoScheduler by default """
+    config = dict(config or {})
+    name = config.pop('name', 'fifo')
+    if name not in NAMES_MAP:
+        raise AttributeError('Unknown scheduler \'%s\'. Choose one of %s' % (name, ', '.join(NAMES_MAP.keys())))
+    return globals()[NAMES_MAP[name]](providers, clusters, workers, config)
+
+
+class Item(object):
+    """ Task of segment file queued for uploading to a cluster """
+    __slots__ = ('task', 'cluster', 'queued_ts')
+
+    def __init__(self, task, cluster):
+        self.task = task
+        self.cluster = cluster
+        self.queued_ts = time.time()
+
+    @property
+    def provider(self):
+        return self.task.provider
+
+    @property
+    def ordering_key(self):
+        """ Files of a provider having equal ordering keys are uploaded to a cluster one by one.
+        None means the file doesn't depend on other files
+        """
+        return getattr(self.task, 'ordering_key', None)
+
+    @property
+    def max_parallel(self):
+        """ :returns amount of files of the provider which may be uploaded to one cluster simultaneously """
+        return getattr(self.task, 'max_parallel', 1)
+
+    @property
+    def wait_time(self):
+        """ :returns seconds spent in queue """
+        return time.time() - self.queued_ts
+
+
+class Lane(object):
+    """ Files of a provider queued for and being uploaded to a cluster. Only the first queued file of each chain is
+    kept in the heap, the following ones wait aside until the previous file of the chain is done. So the head of the
+    heap is always runnable unless the lane is full
+    """
+    __slots__ = ('heap', 'chains', 'in_flight')
+
+    def __init__(self):
+        self.heap = list()  # entries (priority, sequence number, item)
+        self.chains = dict()  # chain key -> deque of entries waiting for the file of the chain in heap or in flight
+        self.in_flight = dict()  # name of file -> chain key
+
+    @property
+    def head(self):
+        """ :returns item which may be uploaded right now or None """
+        if self.heap and len(self.in_flight) < self.heap[0][2].max_parallel:
+            return self.heap[0][2]
+        return None
+
+
+class Scheduler(ABC):
+    """ Keeps queued files and files being uploaded per provider and cluster """
+
+    def __init__(self, providers, clusters, workers, config=None):
+        self.config = config or dict()
+        self.workers = workers
+        self.lanes = dict()
+        for provider in providers:
+            self.lanes[provider] = dict((cl, Lane()) for cl in clusters)
+        self.sequence = itertools.count()
+        self.queued = 0
+        self.in_flight = 0
+        self.in_flight_per_provider = dict((provider, 0) for provider in providers)
+        self.in_flight_per_cluster = dict((cl, 0) for cl in clusters)
+
+    def priority(self, item):
+        """ :returns key of order of runnable files of a lane, files are taken in order of queueing by default """
+        return ()
+
+    @staticmethod
+    def chain_key(item):
+        """ Files of a provider having equal ordering keys are uploaded to a cluster one by one in order of queueing.
+        A file without ordering key only waits for a file of the same name
+        """
+        return ('name', item.task.name) if item.ordering_key is None else ('key', item.ordering_key)
+
+    def put(self, task, cluster):
+        item = Item(task, cluster)
+        lane = self.lanes[task.provider][cluster]
+        entry = (self.priority(item), next(self.sequence), item)
+        key = self.chain_key(item)
+        if key in lane.chains:
+            lane.chains[key].append(entry)
+        else:
+            lane.chains[key] = deque()
+            heapq.heappush(lane.heap, entry)
+        self.queued += 1
+
+    @abstractmethod
+    def get(self):
+        """ Takes items which may be uploaded right now from queue and counts them as being uploaded
+        :returns list of items
+        """
+        raise NotImplementedError('You should implement this!')
+
+    def done(self, provider, cluster, name):
+        lane = self.lanes[provider][cluster]
+        if name not in lane.in_flight:
+            return
+        key = lane.in_flight.pop(name)
+        self.in_flight -= 1
+        self.in_flight_per_provider[provider] -= 1
+        self.in_flight_per_cluster[cluster] -= 1
+        if lane.chains[key]:
+            heapq.heappush(lane.heap, lane.chains[key].popleft())
+        else:
+            del lane.chains[key]
+
+    def is_idle(self, cluster):
+        """ :returns True if there are neither queued nor being uploaded files for the cluster """
+        for lanes in self.lanes.values():
+            if lanes[cluster].chains:
+                return False
+        return True
+
+    def _take(self, lane):
+        item = heapq.heappop(lane.heap)[2]
+        lane.in_flight[item.task.name] = self.chain_key(item)
+        self.queued -= 1
+        self.in_flight += 1
+        self.in_flight_per_provider[item.provider] += 1
+        self.in_flight_per_cluster[item.cluster] += 1
+        return item
+
+    def __len__(self):
+        return self.queued
+
+
+class FifoScheduler(Scheduler):
+    """ Uploads files of each provider to each cluster in order of discovery """
+
+    def get(self):
+        out = list()
+        for lanes in self.lanes.values():
+            for lane in lanes.values():
+                while lane.head is not None:
+                    out.append(self._take(lane))
+        return out
+
+
+class FairScheduler(Scheduler):
+    """ Shares workers among providers according to their weights.
+    Restricts amount of simultaneous uploads to a cluster. Fresh files are uploaded before backlog.
+    Optionally the shortest file of a provider goes first.
+    """
+
+    def __init__(self, providers, clusters, workers, config=None):
+        super().__init__(providers, clusters, workers, config)
+        self.weights = self.config.get('weights', dict())
+        self.cluster_limits = self.config.get('cluster_limits', dict())
+        self.max_per_cluster = self.config.get('max_per_cluster', 0)
+        self.fresh_priority = self.config.get('fresh_priority', True)
+        self.shortest_first = self.config.get('shortest_first', False)
+        self.served = dict((provider, 0) for provider in providers)
+
+    def weight(self, provider):
+        return float(self.weights.get(provider, 1))
+
+    def cluster_limit(self, cluster):
+        return self.cluster_limits.get(cluster, self.max_per_cluster) or self.workers
+
+    @staticmethod
+    def is_fresh(item):
+        """ Files discovered after the first scan of delivery are fresh, other ones are backlog """
+        return getattr(item.task, 'fresh', False)
+
+    def priority(self, item):
+        return (not self.is_fresh(item) if self.fresh_priority else False,
+                getattr(item.task, 'size', 0) if self.shortest_first else 0)
+
+    def get(self):
+        out = list()
+        while self.in_flight < self.workers:
+            candidates = list()  # the most preferable runnable item of each provider for each cluster
+            for lanes in self.lanes.values():
+                for cl, lane in lanes.items():
+                    if lane.head is not None and self.in_flight_per_cluster[cl] < self.cluster_limit(cl):
+                        candidates.append(lane.head)
+            if not candidates:
+                break
+            # fresh files first, then provider with the least weighted share of workers
+            item = min(candidates, key=lambda i: (not self.is_fresh(i) if self.fresh_priority else False,
+                                                  self.in_flight_per_provider[i.provider] / self.weight(i.provider),
+                                                  self.served[i.provider] / self.weight(i.provider),
+                                                  i.queued_ts))
+            self.served[item.provider] += 1
+            out.append(self._take(self.lanes[item.provider][item.cluster]))
+        return out
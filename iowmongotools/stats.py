@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+""" Background collectors of load of clusters shared by uploader and cleanup """
+import logging
+import threading
+import time
+from functools import reduce
+from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
+from iowmongotools import app
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class Inhibitor(Process):
+
+    def __init__(self, redis_conf, delays, delay_coefficient):
+        super().__init__()
+        self.daemon = True
+        import redis
+        redis_conf['decode_responses'] = True
+        self._api = redis.Redis(**redis_conf)
+        self.delays = delays
+        self.delay_coefficient = delay_coefficient or 100
+        # Automatically starting
+        self.start()
+
+    def run(self):
+        pipe = self._api.pipeline()
+        while True:
+            for name, val in self.delays.items():
+                time.sleep(5)
+                for key in [x for x in self._api.scan_iter(match='*:{}'.format(name))]:
+                    pipe.hmget(key, 'failed_requests.timeout', 'find_queries')
+                data = pipe.execute()  # e.g. [['0.0', '45078.0'], ['0.0', '45598.0']]
+                try:
+                    val.value = self.get_timeout_avg_fraction(data) * self.delay_coefficient
+                except TypeError as err:
+                    logger.error('%s. Wrong data from redis: %s', err, data)
+
+    @staticmethod
+    def get_timeout_avg_fraction(data):
+        return reduce(lambda a, b: a + float(b[0]) / float(b[1]) if float(b[1]) > 0 else a, data, 0) / len(
+            data) if data else 0
+
+
+class ServerStatsCollector(threading.Thread):
+    """ Polls serverStatus of every mongos and shard of clusters and writes metrics to the file of uploader """
+
+    def __init__(self, clusters, prefix, metrics_file, lock, interval=60):
+        super().__init__()
+        self.daemon = True
+        self.nodes = [(cl, node) for cl in clusters for node in cl.nodes]
+        self.prefix = prefix
+        self.metrics_file = metrics_file
+        self.lock = lock
+        self.interval = interval
+        self._previous = dict()
+        # Automatically starting
+        self.start()
+
+    def run(self):
+        if not self.nodes:
+            return
+        pool = ThreadPool(processes=min(len(self.nodes), 10))
+        while True:
+            started_ts = time.time()
+            out = list()
+            ts = int(started_ts)
+            for (cl, node), stats in zip(self.nodes, pool.map(self.collect, self.nodes)):
+                for name, value in sorted(self.derive(node, stats).items()):
+                    out.append(app.format_metric(self.prefix, (cl.name, node) + name, value, ts))
+            logger.debug('Flushing %s metrics of servers', len(out))
+            with self.lock:
+                self.metrics_file.write(''.join(out))
+            time.sleep(max(0, self.interval - (time.time() - started_ts)))
+
+    @staticmethod
+    def collect(item):
+        cl, node = item
+        try:
+            return cl.server_stats(node)
+        except Exception as err:
+            logger.warning('Cannot get stats of %s at \'%s\': %s', node, cl.name, err)
+            return dict()
+
+    def derive(self, node, stats):
+        """ Replaces cumulative latencies with average latency over the interval in microseconds """
+        out = dict()
+        previous = self._previous.get(node, dict())
+        for name, value in stats.items():
+            if name[0] != 'latency':
+                out[name] = value
+            elif name[2] == 'micros':
+                ops_name = name[:2] + ('ops',)
+                ops = stats[ops_name] - previous.get(ops_name, stats[ops_name])
+                micros = value - previous.get(name, value)
+                out[name[:2]] = int(micros / ops) if ops > 0 else 0
+        self._previous[node] = stats
+        return out
@@ -49,6 +49,15 @@ class HashOfSegments(Template):
         return output
 
 
+class SegmentsMax(HashOfSegments):
+    """ Section '$max' of update setting expiry of each segment by its own dotted path inside 'path'. Only touched
+    segments are written, an expiry older than the stored one changes nothing
+    """
+
+    def apply(self, dict_line):
+        return {'$max': super().apply(dict_line)}
+
+
 class SegmentsWithTimestamp(Template):
     def __init__(self, config=None):
         if not config:
@@ -78,6 +87,7 @@ class Timestamp(Template):
 
 MAP = {
     'hash_of_segments': HashOfSegments,
+    'segments_max': SegmentsMax,
     'segments_str': SegmentsWithTimestamp,
     'timestamp': Timestamp
 }
@@ -2,23 +2,62 @@
 # pylint: disable=line-too-long
 """ Imports segments to mongo """
 import os
+import io
+import socket
 import logging
 import re
 import gzip
+import bz2
+import lzma
+import struct
 import time
-from collections import deque
-from functools import reduce
-from copy import copy
+import hashlib
+import heapq
+import threading
+from collections import OrderedDict, deque
+from copy import deepcopy
 import mimetypes
-from multiprocessing import Pool, Event, Array, Process, Value
+from multiprocessing import Pool, Event, Array, Value, cpu_count
 from pymongo.operations import UpdateOne
-from iowmongotools import app, cluster, fs, templates
+from bson.raw_bson import RawBSONDocument
+try:
+    from bson import encode as bson_encode, decode as bson_decode
+except ImportError:  # pymongo < 3.9
+    from bson import BSON
+    bson_encode = BSON.encode
+    bson_decode = lambda data: BSON(data).decode()
+from iowmongotools import app, cluster, fs, templates, scheduler
+from iowmongotools.stats import Inhibitor, ServerStatsCollector
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+PARQUET_TYPE = 'application/parquet'
+POSTPONED = 2  # error code of file which is being uploaded to the cluster by another uploader
+PACKED = 3  # error code of pack, results of its files are returned instead of counter
+READ_BUFFER_SIZE = 1048576  # bytes read from segment file at once
+ENCODINGS_MAP = {
+    '.zst': 'zstd',
+    '.lz4': 'lz4'
+}
+
+
+def register_types():
+    """ Adds types and encodings which aren't known by mimetypes """
+    mimetypes.add_type(PARQUET_TYPE, '.parquet')
+    mimetypes.encodings_map.update(ENCODINGS_MAP)
+
+
+register_types()
+
 
 class BadLine(ValueError):
-    pass
+    def __init__(self, message='', column=None):
+        super().__init__(message)
+        self.column = column  # title of column which failed validation. None if amount of columns is wrong
+
+    @property
+    def reason(self):
+        return 'column {}'.format(self.column) if self.column else 'amount of columns'
 
 
 class InvalidSegmentFile(Exception):
@@ -40,6 +79,32 @@ class WrongFileType(ValueError):
         super().__init__('Type of file \'%s\' is \'%s\', expected %s' % (name, type, ' or '.join(allowed_types)))
 
 
+def open_zstd(stream):
+    try:
+        import zstandard  # optional dependency
+    except ImportError:
+        raise InvalidSegmentFile('Decoding of zstd requires package zstandard')
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(stream, read_size=READ_BUFFER_SIZE),
+                             READ_BUFFER_SIZE)
+
+
+def open_lz4(stream):
+    try:
+        import lz4.frame  # optional dependency
+    except ImportError:
+        raise InvalidSegmentFile('Decoding of lz4 requires package lz4')
+    return lz4.frame.LZ4FrameFile(stream, 'rb')
+
+
+DECODERS = {
+    'gzip': lambda stream: gzip.GzipFile(fileobj=stream, mode='rb'),
+    'bzip2': lambda stream: bz2.BZ2File(stream, 'rb'),
+    'xz': lambda stream: lzma.LZMAFile(stream, 'rb'),
+    'zstd': open_zstd,
+    'lz4': open_lz4
+}
+
+
 class SegfileCounter(object):
     def __init__(self, line_total=0):
         self.matched = 0
@@ -48,6 +113,8 @@ class SegfileCounter(object):
         self.line_cur = 0
         self.line_invalid = 0
         self.line_total = line_total
+        self.unchanged = 0  # requests which haven't been sent since they change nothing
+        self.staged = 0  # documents inserted to staging collection
 
     def __add__(self, other):
         obj = SegfileCounter()
@@ -56,7 +123,7 @@ class SegfileCounter(object):
         return obj
 
     def __and__(self, other):
-        for key in ('matched', 'modified', 'upserted'):
+        for key in ('matched', 'modified', 'upserted', 'unchanged', 'staged'):
             self.__dict__[key] += other.__dict__[key]
         return self
 
@@ -78,6 +145,157 @@ class SegfileCounter(object):
             return result.matched_count + result.upserted_count
         return 0
 
+    def count_update_reply(self, reply):
+        """ Counts reply of raw 'update' command the same way as result of bulk_write() """
+        upserted = len(reply.get('upserted', ()))
+        self.matched += reply.get('n', 0) - upserted
+        self.modified += reply.get('nModified', 0)
+        self.upserted += upserted
+        return reply.get('n', 0)
+
+
+class ProgressReader(io.RawIOBase):
+    """ Counts bytes read from underlying binary stream, i.e. compressed bytes consumed by decoder """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.consumed = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = self.stream.readinto(b)
+        self.consumed += size or 0
+        return size
+
+
+class Quarantine(object):
+    """ Gzipped file of invalid lines written through a large buffer. Lines are written to a temporary file which
+    replaces the target one on close, so workers processing the same file for different clusters don't mix lines
+    """
+
+    def __init__(self, path, buffer_size=4194304):
+        self.path = path
+        self.tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        self.lines = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._raw = open(self.tmp_path, 'wb', buffering=buffer_size)
+        self._file = io.TextIOWrapper(gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=1), encoding='utf-8')
+
+    def write(self, line_number, column, line):
+        self.lines += 1
+        self._file.write('{}\t{}\t{}\n'.format(line_number, column or '', line))
+
+    def close(self):
+        """ :return: path of quarantine file or None if there are no invalid lines """
+        self._file.close()
+        self._raw.close()
+        if not self.lines:  # the previous quarantine of the file is outdated as well
+            os.remove(self.tmp_path)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return None
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+
+class SnapshotDiff(object):
+    """ Sorted digest of the previous snapshot of a provider: key and hash of every line.
+    A new snapshot is sorted by key externally, by runs of 'memory_lines' lines, and merged with the digest.
+    The new digest is written to a temporary file which replaces the previous one on commit
+    """
+    KEY_SEPARATOR = '\x1f'
+
+    def __init__(self, path, memory_lines=1000000):
+        self.path = path
+        self.tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        self.memory_lines = memory_lines
+        self.counts = dict.fromkeys(('added', 'changed', 'removed', 'unchanged'), 0)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @staticmethod
+    def _open(path, mode):
+        return open(path, mode, buffering=READ_BUFFER_SIZE, encoding='utf-8', errors='surrogateescape',
+                    newline='\n')
+
+    @staticmethod
+    def hash(line):
+        return hashlib.md5(line.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+
+    def _read(self, path):
+        """ :returns generator of pairs of key and value from digest or sorted run """
+        if not os.path.exists(path):
+            return
+        with self._open(path, 'r') as f_in:
+            for line in f_in:
+                key, value = line[:-1].split('\x00', 1)
+                yield key, value
+
+    def _dump_run(self, items, number):
+        path = '{}.run{}'.format(self.tmp_path, number)
+        with self._open(path, 'w') as f_out:
+            for key, line in sorted(items):
+                f_out.write('{}\x00{}\n'.format(key, line))
+        return path
+
+    def diff(self, lines, get_key):
+        """ :param lines: iterable of lines of the new snapshot
+        :param get_key: function returning key of line or raising BadLine
+        :returns generator of tuples of line, key and state. State is 'added', 'changed', 'removed' (line is None)
+        or BadLine if key of the line cannot be taken
+        """
+        runs = list()
+        items = list()
+        try:
+            for line in lines:
+                try:
+                    key = get_key(line)
+                except BadLine as err:
+                    yield line, None, err
+                    continue
+                items.append((key, line))
+                if len(items) >= self.memory_lines:
+                    runs.append(self._dump_run(items, len(runs)))
+                    items = list()
+            items.sort()
+            new = heapq.merge(iter(items), *[self._read(path) for path in runs])
+            with self._open(self.tmp_path, 'w') as digest:
+                for item in self._merge(new, self._read(self.path), digest):
+                    yield item
+        finally:
+            for path in runs:
+                os.remove(path)
+
+    def _merge(self, new, old, digest):
+        old_item = next(old, None)
+        for key, line in new:
+            line_hash = self.hash(line)
+            while old_item is not None and old_item[0] < key:
+                self.counts['removed'] += 1
+                yield None, old_item[0], 'removed'
+                old_item = next(old, None)
+            if old_item is not None and old_item[0] == key:
+                state = 'unchanged' if old_item[1] == line_hash else 'changed'
+                old_item = next(old, None)
+            else:
+                state = 'added'
+            digest.write('{}\x00{}\n'.format(key, line_hash))
+            self.counts[state] += 1
+            if state != 'unchanged':
+                yield line, key, state
+        while old_item is not None:
+            self.counts['removed'] += 1
+            yield None, old_item[0], 'removed'
+            old_item = next(old, None)
+
+    def close(self, commit=False):
+        """ Replaces the previous digest with the new one if commit is True """
+        if commit and os.path.exists(self.tmp_path):
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
 
 class SegmentFile(object):
     """ Represents file containing segments """
@@ -86,42 +304,77 @@ class SegmentFile(object):
         'text/csv': ',',
         'text/space-separated-values': ' '
     }
+    COLUMNAR_TYPES = (PARQUET_TYPE,)  # read only by engine 'arrow'
 
-    def __init__(self, path, provider, strategy):
+    def __init__(self, path, provider, strategy, size=None, source=None):
         if not isinstance(strategy, Strategy):
             raise TypeError('strategy should be an instance of class Strategy')
-        if not os.path.isfile(path):
+        if not source and not os.path.isfile(path):
             raise FileNotFoundError('File {} doesn\'t exist.'.format(path))
         self.logger = None
         self.shared_index = None
         self.shared_metrics = [0, 0, 0]  # array of current_line, invalid_lines, updated docs
         self.path = path
+        self.source = source  # fs.S3Source of remote file
+        if size is None:
+            size = source.get_size(path) if source else os.path.getsize(path)
+        self.size = size
         self.provider = provider
         self.strategy = strategy
-        if self.strategy.override_filename_from_path:
-            regexp, replacement = self.strategy.override_filename_from_path
-            self.name = regexp.sub(replacement, self.path)
-        else:
-            self.name = os.path.basename(self.path).split('.')[0]
+        self.name = strategy.get_file_name(path)
         self.type = strategy.get_file_type(path)
         if self.type[0] not in strategy.allowed_types:
             raise WrongFileType(self.name, self.type[0], strategy.allowed_types)
         self.invalid = False
         self.processed = False
+        self.quarantine = None  # path of file with invalid lines
+        self.cluster = None  # name of cluster the file is uploaded to
+        self.snapshot = None  # SnapshotDiff of the file
+        self.claim = None  # owner and lease in seconds if files are claimed in segment_files
+        self.progress = None  # ProgressReader of the file being read
+        self.pack = None  # name of pack the file is uploaded with
         self.timer = app.Timer()
         self.counter = SegfileCounter()
+        self._invalid_log_ts = 0
+        self._invalid_log_suppressed = 0
+
+    @classmethod
+    def from_task(cls, task, strategy):
+        segfile = cls(task.path, task.provider, strategy, task.size, task.source)
+        segfile.shared_index = task.shared_index
+        return segfile
 
     def __gt__(self, other):
         return os.stat(self.path).st_mtime > os.stat(other.path).st_mtime
 
-    def get_line(self):
-        if self.type[1] == 'gzip':
-            open_func = gzip.open
-            self.log('debug', 'The file is type of {}. Opening with gzip.'.format(self.type))
+    def open(self, stream):
+        """ :param stream: binary stream of the file
+        :return: text stream of the file decoded according to its encoding
+        """
+        self.progress = ProgressReader(stream)
+        stream = io.BufferedReader(self.progress, READ_BUFFER_SIZE)
+        if self.type[1]:
+            if self.type[1] not in DECODERS:
+                raise InvalidSegmentFile('Encoding {} of the file isn\'t supported'.format(self.type[1]))
+            self.log('debug', 'The file is type of {}. Opening with {}.'.format(self.type, self.type[1]))
+            stream = DECODERS[self.type[1]](stream)
         else:
-            open_func = open
             self.log('debug', 'The file is type of {}. Opening.'.format(self.type))
-        with open_func(self.path, 'rt') as f_in:
+        return io.TextIOWrapper(stream)
+
+    def get_line(self):
+        if self.source:
+            stream = self.source.open(self.path, self.size)
+        else:
+            stream = open(self.path, 'rb', buffering=READ_BUFFER_SIZE)
+        try:
+            for line in self._get_line(stream):
+                yield line
+        finally:
+            stream.close()
+
+    def _get_line(self, stream):
+        with self.open(stream) as f_in:
             line = f_in.readline()
             if self.type[0] == 'text/csv':
                 try:
@@ -135,18 +388,178 @@ class SegmentFile(object):
             self.log('debug', 'Closing the file')
 
     def get_setter(self, line_str):
-        out = list()
         try:
             setter = self.strategy.get_setter(line_str.split(self.SEPARATORS_MAP[self.type[0]]),
                                               self.strategy.input[self.type[0]])
-        except BadLine:
-            raise BadLine('Line \'{}\' is invalid.'.format(line_str))
-        for key in ('$set', '$unset'):  # divide to 2 query because of https://jira.mongodb.org/browse/SERVER-11285
-            if key in setter['update']:
-                out.append(UpdateOne(setter['filter'], {key: setter['update'][key]}, upsert=self.strategy.upsert))
+        except BadLine as err:
+            raise BadLine('Line \'{}\' is invalid: {}.'.format(line_str, err.reason), err.column)
+        return self.get_requests(setter)
+
+    def get_requests(self, setter):
+        if self.strategy.load_mode == 'staging':
+            return [self.strategy.get_staging_document(setter)]
+        out = list()
+        # $unset goes to separate query because of https://jira.mongodb.org/browse/SERVER-11285
+        for update in (dict((key, value) for key, value in setter['update'].items() if key != '$unset'),
+                       dict((key, value) for key, value in setter['update'].items() if key == '$unset')):
+            if update:
+                if self.strategy.write_mode == 'raw':
+                    out.append(self.strategy.encode_statement(setter['filter'], update))
+                else:
+                    out.append(UpdateOne(setter['filter'], update, upsert=self.strategy.upsert))
         return out
 
+    def iter_requests(self):
+        """ :returns generator of tuples of line and list of requests or BadLine if the line is invalid """
+        if self.strategy.engine == 'arrow' or self.type[0] in self.COLUMNAR_TYPES:
+            for item in self._iter_requests_arrow():
+                yield item
+            return
+        if self.strategy.snapshot_diff is not None and self.cluster:
+            for item in self._iter_requests_diff():
+                yield item
+            return
+        for line in self.get_line():
+            try:
+                yield line, self.get_setter(line)
+            except BadLine as err:
+                yield line, err
+
+    def _iter_requests_diff(self):
+        """ Only added and changed lines of a snapshot are rendered. Keys which have disappeared since the previous
+        snapshot get update 'removed'
+        """
+        config = self.strategy.input[self.type[0]]
+        separator = self.SEPARATORS_MAP[self.type[0]]
+        key_titles = self.strategy.snapshot_diff.get('key') or config['titles'][:1]
+        indices = [config['titles'].index(title) for title in key_titles]
+        removed = self.strategy.snapshot_diff.get('removed')
+
+        def get_key(line):
+            values = line.split(separator)
+            if len(values) <= max(indices) or self.strategy.fixed_line_size and len(values) != len(config['titles']):
+                raise BadLine('Line \'{}\' is invalid: amount of columns.'.format(line))
+            return SnapshotDiff.KEY_SEPARATOR.join(values[index].strip() for index in indices)
+
+        self.snapshot = SnapshotDiff(os.path.join(self.strategy.snapshot_diff['path'], '{}.{}.digest'.format(
+            self.provider, self.cluster)), self.strategy.snapshot_diff.get('memory_lines', 1000000))
+        for line, key, state in self.snapshot.diff(self.get_line(), get_key):
+            if isinstance(state, BadLine):
+                yield line, state
+            elif state == 'removed':
+                if removed:
+                    values = key.split(SnapshotDiff.KEY_SEPARATOR)
+                    yield separator.join(values), self.get_requests(
+                        self.strategy.render(dict(zip(key_titles, values)), removed))
+            else:
+                try:
+                    yield line, self.get_setter(line)
+                except BadLine as err:
+                    yield line, err
+        self.log('info', 'Snapshot diff: {}.'.format(', '.join(
+            '{} - {}'.format(name, value) for name, value in sorted(self.snapshot.counts.items()))))
+
+    def _iter_requests_arrow(self):
+        """ Reads file by batches of columns. Each column is validated by its pattern at once """
+        import pyarrow  # optional dependency
+        import pyarrow.compute
+        config = self.strategy.input[self.type[0]]
+        separator = self.SEPARATORS_MAP.get(self.type[0], '\t')
+        stream = self.source.open(self.path, self.size) if self.source else None
+        bad_rows = deque()  # rows skipped by pyarrow: (line number, text, whether columns are missing)
+        try:
+            if self.type[0] == PARQUET_TYPE:
+                import pyarrow.parquet
+                if stream:  # parquet isn't read sequentially
+                    stream = pyarrow.BufferReader(stream.read())
+                batches = pyarrow.parquet.ParquetFile(stream or self.path).iter_batches(
+                    batch_size=self.strategy.batch_size, columns=config['titles'])
+            else:
+                import pyarrow.csv
+
+                def on_invalid_row(row):
+                    bad_rows.append((row.number, row.text, row.actual_columns < row.expected_columns))
+                    return 'skip'
+
+                if stream and self.type[1]:
+                    stream = pyarrow.CompressedInputStream(stream, {'bzip2': 'bz2'}.get(self.type[1], self.type[1]))
+                batches = pyarrow.csv.open_csv(
+                    stream or self.path,
+                    read_options=pyarrow.csv.ReadOptions(column_names=config['titles']),
+                    parse_options=pyarrow.csv.ParseOptions(delimiter=separator, quote_char=False,
+                                                           ignore_empty_lines=False,
+                                                           invalid_row_handler=on_invalid_row),
+                    convert_options=pyarrow.csv.ConvertOptions(
+                        column_types=dict((title, pyarrow.string()) for title in config['titles'])))
+
+            def get_bad_row(text, short):
+                if short and not self.strategy.fixed_line_size:  # validated by the python engine
+                    try:
+                        return text, self.get_setter(text)
+                    except BadLine as err:
+                        return text, err
+                return text, BadLine('Line \'{}\' is invalid: amount of columns.'.format(text))
+
+            header = self.type[0] == 'text/csv'  # the first line of csv may be header
+            line_number = 0  # rows skipped by pyarrow are put back in place by their numbers
+            for record_batch in batches:
+                columns = list()
+                masks = list()
+                for index, title in enumerate(config['titles']):
+                    column = pyarrow.compute.utf8_trim_whitespace(pyarrow.compute.fill_null(
+                        record_batch.column(index).cast(pyarrow.string()), ''))
+                    columns.append(column.to_pylist())
+                    masks.append(self._match_column(column, config['patterns'][index]))
+                for row in range(record_batch.num_rows):
+                    line_number += 1
+                    while bad_rows and bad_rows[0][0] == line_number:
+                        line, requests = get_bad_row(*bad_rows.popleft()[1:])
+                        if not (header and line_number == 1 and isinstance(requests, BadLine)):
+                            yield line, requests
+                        line_number += 1
+                    values = [column[row] for column in columns]
+                    failed = next((index for index, mask in enumerate(masks) if not mask[row]), None)
+                    if failed is not None:
+                        if not (header and line_number == 1):
+                            yield separator.join(values), BadLine('Line \'{}\' is invalid: column {}.'.format(
+                                separator.join(values), config['titles'][failed]), config['titles'][failed])
+                    else:
+                        yield separator.join(values), self.get_requests(
+                            self.strategy.render(dict(zip(config['titles'], values))))
+            while bad_rows:  # trailing ones
+                number, text, short = bad_rows.popleft()
+                line, requests = get_bad_row(text, short)
+                if not (header and number == 1 and isinstance(requests, BadLine)):
+                    yield line, requests
+        finally:
+            if stream:
+                stream.close()
+
+    @staticmethod
+    def _match_column(column, pattern):
+        """ :returns list of flags whether values match the pattern as re.match() does """
+        import pyarrow
+        import pyarrow.compute
+        try:
+            return pyarrow.compute.match_substring_regex(column, '^(?:{})'.format(pattern.pattern)).to_pylist()
+        except pyarrow.ArrowInvalid:  # syntax of pattern isn't supported by RE2
+            return [bool(pattern.match(value)) for value in column.to_pylist()]
+
     def get_batch(self):
+        quarantine = None
+        if self.strategy.quarantine:
+            quarantine = Quarantine(os.path.join(self.strategy.quarantine['path'], '{}.{}.invalid.gz'.format(
+                self.provider, self.name.replace(os.sep, '_'))), self.strategy.quarantine.get('buffer_size', 4194304))
+        try:
+            for batch in self._get_batch(quarantine):
+                yield batch
+        finally:
+            if quarantine:
+                self.quarantine = quarantine.close()
+                if self.quarantine:
+                    self.log('info', '{} invalid lines are written to {}'.format(quarantine.lines, self.quarantine))
+
+    def _get_batch(self, quarantine):
         ilc = 0  # counter of invalid lines in a batch
         batch = list()
         self.populate_templates_with_filename()
@@ -155,15 +568,20 @@ class SegmentFile(object):
         self.timer.__init__()
         self.timer.start()
         self.processed = False
+        self._invalid_log_ts = 0
+        self._invalid_log_suppressed = 0
         last_log_ts = time.time()
         last_line_cnt = 0
-        for line in self.get_line():
+        for line, requests in self.iter_requests():
             self.counter.line_cur += 1
-            try:
-                batch.extend(self.get_setter(line))
-            except BadLine as err:
+            if not isinstance(requests, BadLine):
+                batch.extend(requests)
+            else:
+                err = requests
+                if quarantine:
+                    quarantine.write(self.counter.line_cur, err.column, line)
                 if self.strategy.log_invalid_lines:
-                    self.log('warning', '#{}. {}'.format(self.counter.line_cur, err))
+                    self.log_invalid_line('#{}. {}'.format(self.counter.line_cur, err))
                 ilc += 1
             if self.counter.line_cur % self.strategy.batch_size == 0:
                 self.counter.line_invalid += ilc
@@ -176,9 +594,7 @@ class SegmentFile(object):
                     if not self.strategy.process_invalid_file_to_end:
                         self.timer.stop()
                         raise InvalidSegmentFile('Stop processing the file')
-                    self.log('info',
-                             'Option \'process_invalid_file_to_end\' is enabled. Switching off logging of invalid lines and going on processing the file.')
-                    self.strategy.log_invalid_lines = False
+                    self.log('info', 'Option \'process_invalid_file_to_end\' is enabled. Going on processing the file.')
                 if time.time() - last_log_ts > 30:
                     speed = int((self.counter.line_cur - last_line_cnt) / (time.time() - last_log_ts))
                     last_line_cnt = self.counter.line_cur
@@ -186,8 +602,12 @@ class SegmentFile(object):
                     if self.shared_index and not self.counter.line_total:
                         if Uploader.shared_array[self.shared_index]:
                             self.counter.line_total = Uploader.shared_array[self.shared_index]
-                    percent = '{:.0f}%'.format(
-                        self.counter.line_cur * 100 / self.counter.line_total) if self.counter.line_total else ''
+                    if self.counter.line_total:
+                        percent = '{:.0f}%'.format(self.counter.line_cur * 100 / self.counter.line_total)
+                    elif self.progress and self.size:  # compressed bytes consumed
+                        percent = '{:.0f}%'.format(min(self.progress.consumed * 100 / self.size, 100))
+                    else:
+                        percent = ''
                     self.log('info',
                              'Processing line #%-15s %-4s %10d lines/s' % (self.counter.line_cur, percent, speed))
                 if batch:
@@ -200,16 +620,49 @@ class SegmentFile(object):
         if batch:
             self.log('debug', 'Line {}: {}'.format(self.counter.line_cur, batch[-1]))
             yield batch
+        if self._invalid_log_suppressed:
+            self.log('warning', '{} more invalid lines aren\'t logged.'.format(self._invalid_log_suppressed))
         if self.strategy.process_invalid_file_to_end or not self.invalid:
             self.counter.line_total = self.counter.line_cur
             if self.shared_index:
                 Uploader.shared_array[self.shared_index] = self.counter.line_total
         self.timer.stop()
 
+    def get_sorted_batch(self, chunk_map):
+        """ Regroups requests from get_batch() within window of 'shard_aware_window' requests.
+        Requests are ordered by target shard and shard key, so each batch mostly targets one shard.
+        Sorting is stable, therefore requests with the same filter keep order of the file.
+        """
+        window = list()
+        for batch in self.get_batch():
+            window.extend(batch)
+            if len(window) >= self.strategy.shard_aware_window:
+                for sorted_batch in self._regroup(window, chunk_map):
+                    yield sorted_batch
+                window = list()
+        for sorted_batch in self._regroup(window, chunk_map):
+            yield sorted_batch
+
+    def _regroup(self, requests, chunk_map):
+        routes = [chunk_map.route(request['q'] if isinstance(request, RawBSONDocument) else request._filter)
+                  for request in requests]
+        order = sorted(range(len(requests)), key=lambda i: (routes[i][0] or '', routes[i][1]))
+        batch = list()
+        shard = None
+        for index in order:
+            if batch and (len(batch) >= self.strategy.batch_size or routes[index][0] != shard):
+                yield batch
+                batch = list()
+            shard = routes[index][0]
+            batch.append(requests[index])
+        if batch:
+            yield batch
+
     def load_metadata(self, data):
         if data:
             self.invalid = data.get('invalid', self.invalid)
             self.processed = data.get('processed', self.processed)
+            self.quarantine = data.get('quarantine', self.quarantine)
             self.timer.__dict__.update(data.get('timer', {}))
             self.counter.__dict__.update(data.get('counter', {}))
             if not self.processed or self.invalid:
@@ -224,26 +677,118 @@ class SegmentFile(object):
     def dump_metadata(self):
         timer = self.timer.__dict__.copy()
         timer.pop('_Timer__scheduler_ts')
-        return {
+        out = {
             '_id': self.name,
             'path': self.path,
             'provider': self.provider,
             'type': self.type,
             'invalid': self.invalid,
             'processed': self.processed,
+            'quarantine': self.quarantine,
             'timer': timer,
             'counter': self.counter.__dict__
         }
+        if self.pack:
+            out['pack'] = self.pack
+        return out
+
+    def log_invalid_line(self, message):
+        """ Logs at most one invalid line per 'invalid_lines_log_interval' seconds """
+        now = time.time()
+        if now - self._invalid_log_ts < self.strategy.invalid_lines_log_interval:
+            self._invalid_log_suppressed += 1
+            return
+        if self._invalid_log_suppressed:
+            message = '{} ({} more invalid lines aren\'t logged)'.format(message, self._invalid_log_suppressed)
+        self.log('warning', message)
+        self._invalid_log_ts = now
+        self._invalid_log_suppressed = 0
 
     def log(self, severity, message):
         """ factory method using local or global logger. need in order not to pickle logger object to a processes """
         getattr(self.logger or logger, severity)(message)
 
+    def validate(self, samples=0):
+        """ Parses, validates and renders every line of the file without uploading
+        :param samples: amount of rendered requests to return
+        :return: tuple of amount of lines, map of reason to amount of invalid lines, list of rendered requests
+        """
+        lines = 0
+        reasons = dict()
+        rendered = list()
+        self.populate_templates_with_filename()
+        for line, requests in self.iter_requests():
+            lines += 1
+            if isinstance(requests, BadLine):
+                reasons[requests.reason] = reasons.get(requests.reason, 0) + 1
+                continue
+            for request in requests[:samples - len(rendered)]:
+                if isinstance(request, RawBSONDocument):
+                    rendered.append(str(dict(request)))
+                elif isinstance(request, dict):  # document of staging collection
+                    rendered.append(str(request))
+                else:
+                    rendered.append('filter: {}, update: {}'.format(request._filter, request._doc))
+        return lines, reasons, rendered
+
     def populate_templates_with_filename(self):
         for template in self.strategy.templates.values():
             template.push_filename(self.name)
 
 
+class SegmentPack(object):
+    """ Small files of a provider streamed through one pipeline of batches, so a batch may contain requests of
+    several files. Lines are counted by the files themselves, replies of mongo are counted by the pack
+    """
+
+    def __init__(self, name, segfiles, logger=None):
+        self.name = name
+        self.segfiles = segfiles
+        self.provider = segfiles[0].provider
+        self.strategy = segfiles[0].strategy
+        self.claim = segfiles[0].claim
+        self.shared_metrics = segfiles[0].shared_metrics
+        self.logger = logger
+        self.counter = SegfileCounter()
+        self.stopped = list()  # invalid files whose processing has been stopped
+
+    def get_batch(self):
+        batch = list()
+        for segfile in self.segfiles:
+            if self.logger:
+                self.logger.extra['segfile'] = segfile.name
+            try:
+                for requests in segfile.get_batch():
+                    batch.extend(requests)
+                    if len(batch) >= self.strategy.batch_size:
+                        yield batch
+                        batch = list()
+            except InvalidSegmentFile as err:  # the rest of the file is dropped, other files go on
+                segfile.log('error', err)
+                self.stopped.append(segfile)
+            finally:
+                if self.logger:
+                    self.logger.extra['segfile'] = self.name
+        if batch:
+            yield batch
+
+    get_sorted_batch = SegmentFile.get_sorted_batch
+    _regroup = SegmentFile._regroup
+
+    def dump_metadata(self):
+        """ Record of the pack in segment_files, files of the pack refer to it by 'pack' """
+        return {
+            '_id': self.name,
+            'provider': self.provider,
+            'files': [segfile.name for segfile in self.segfiles],
+            'stopped': [segfile.name for segfile in self.stopped],
+            'counter': self.counter.__dict__
+        }
+
+    def log(self, severity, message):
+        getattr(self.logger or logger, severity)(message)
+
+
 class Strategy(object):
 
     def __init__(self, config):
@@ -251,10 +796,10 @@ class Strategy(object):
             raise AttributeError('Uploading strategy must have both sections \'input\' and \'update_one\'')
         if 'collection' not in config or len(config.get('collection', '').split('.')) != 2:
             raise AttributeError('Parameter \'collection\' is mandatory. Set as \'database.collection\'')
-        self.allowed_types = frozenset(ft for ft in SegmentFile.SEPARATORS_MAP.keys() if ft in config['input'])
+        input_types = tuple(SegmentFile.SEPARATORS_MAP.keys()) + SegmentFile.COLUMNAR_TYPES
+        self.allowed_types = frozenset(ft for ft in input_types if ft in config['input'])
         if not self.allowed_types:
-            raise AttributeError(
-                'Input must have at least one of type: %s' % ', '.join(SegmentFile.SEPARATORS_MAP.keys()))
+            raise AttributeError('Input must have at least one of type: %s' % ', '.join(input_types))
         self.input = dict()
         for file_type in self.allowed_types:
             self.input[file_type] = {'titles': [], 'patterns': []}
@@ -268,7 +813,11 @@ class Strategy(object):
         self.database, self.collection = config['collection'].split('.')
         templates_params = config.get('templates', dict())
         self.templates = dict()
-        for name in set(templates.MAP.keys()).intersection(self.set_of_used_templates(self.output)):
+        self.snapshot_diff = config.get('snapshot_diff')
+        used_templates = self.set_of_used_templates(self.output)
+        if self.snapshot_diff is not None:
+            used_templates.update(self.set_of_used_templates(self.snapshot_diff.get('removed')))
+        for name in set(templates.MAP.keys()).intersection(used_templates):
             self.templates[name] = templates.MAP[name](templates_params.get(name))
         self.batch_size = config.get('batch_size', 1000)
         self.reprocess_invalid = config.get('reprocess_invalid', False)
@@ -278,6 +827,10 @@ class Strategy(object):
         self.upsert = config.get('upsert', False)
         self.__file_type_override = config.get('file_type_override', None)
         self.log_invalid_lines = config.get('log_invalid_lines', True)
+        self.invalid_lines_log_interval = config.get('invalid_lines_log_interval', 1)
+        self.quarantine = config.get('quarantine')
+        if self.quarantine is not None and 'path' not in self.quarantine:
+            raise AttributeError('Section \'quarantine\' must have \'path\'')
         self.clusters = [cl for cl in config.get('clusters', []) if
                          cl in cluster.Cluster.objects.keys()] or list(cluster.Cluster.objects.keys())
         self.threshold_percent_invalid_lines_in_batch = config.get('threshold_percent_invalid_lines_in_batch', 80)
@@ -286,6 +839,177 @@ class Strategy(object):
             pattern, replacement = next(iter(self.override_filename_from_path.items()))
             self.override_filename_from_path = re.compile(pattern), replacement
         self.write_concern = config.get('write_concern')
+        self.shard_aware_window = config.get('shard_aware_window', 0)
+        self.max_parallel_files_per_cluster = config.get('max_parallel_files_per_cluster', 1)
+        self.engine = config.get('engine', 'python')
+        if self.engine not in ('python', 'arrow'):
+            raise AttributeError('Parameter \'engine\' must be \'python\' or \'arrow\'')
+        if self.engine == 'arrow' or PARQUET_TYPE in self.allowed_types:
+            try:
+                import pyarrow  # pylint: disable=unused-import
+            except ImportError:
+                raise AttributeError('Engine \'arrow\' and type \'{}\' require pyarrow'.format(PARQUET_TYPE))
+        self.write_mode = config.get('write_mode', 'bulk')
+        if self.write_mode not in ('bulk', 'raw'):
+            raise AttributeError('Parameter \'write_mode\' must be \'bulk\' or \'raw\'')
+        # constant parts of encoded update statement
+        self._raw_q = b'\x03q\x00'
+        self._raw_u = b'\x03u\x00'
+        self._raw_tail = b'\x08upsert\x00' + (b'\x01' if self.upsert else b'\x00') + b'\x00'
+        if self.snapshot_diff is not None:
+            if 'path' not in self.snapshot_diff:
+                raise AttributeError('Section \'snapshot_diff\' must have \'path\'')
+            if self.engine != 'python' or PARQUET_TYPE in self.allowed_types or \
+                    self.max_parallel_files_per_cluster != 1:
+                raise AttributeError('Section \'snapshot_diff\' requires engine \'python\', text input and '
+                                     '\'max_parallel_files_per_cluster\' 1')
+            for file_type in self.allowed_types:
+                if set(self.snapshot_diff.get('key', [])) - set(self.input[file_type]['titles']):
+                    raise AttributeError('Titles of \'key\' of \'snapshot_diff\' must be titles of input')
+        self.load_mode = config.get('load_mode', 'update')
+        if self.load_mode not in ('update', 'staging'):
+            raise AttributeError('Parameter \'load_mode\' must be \'update\' or \'staging\'')
+        if self.load_mode == 'staging' and (self.write_mode != 'bulk' or 'skip_unchanged' in config):
+            raise AttributeError('Load mode \'staging\' requires write_mode \'bulk\' and no \'skip_unchanged\'')
+        if self.load_mode == 'staging' and not self.is_plain_setter(self.output['update']):
+            # the server merges staged documents by top-level fields, nested ones would be replaced as a whole
+            raise AttributeError('Load mode \'staging\' requires \'update\' to be only $set of top-level fields')
+        self.staging_indexes = config.get('staging_indexes', [])
+        self.packing = config.get('packing')
+        if self.packing is not None:
+            self.packing = dict(self.packing or {})
+            if self.snapshot_diff is not None:
+                raise AttributeError('Section \'packing\' cannot be used with \'snapshot_diff\'')
+        self.skip_unchanged = config.get('skip_unchanged')
+        if self.skip_unchanged is not None:
+            self.skip_unchanged = dict(self.skip_unchanged or {})
+            tolerance = self.skip_unchanged.get('tolerance', 0)
+            self.skip_unchanged['tolerance'] = app.human_to_seconds(tolerance) if isinstance(tolerance,
+                                                                                             str) else tolerance
+            self.skip_unchanged['tolerant_fields'] = list(self.skip_unchanged.get('tolerant_fields', []))
+            if self.skip_unchanged['tolerance'] and not self.skip_unchanged['tolerant_fields']:
+                raise AttributeError('Parameter \'tolerance\' of \'skip_unchanged\' requires \'tolerant_fields\'')
+            if 'key' not in self.skip_unchanged:  # field of filter documents are read by
+                fields = list(self.output['filter'].keys())
+                self.skip_unchanged['key'] = '_id' if '_id' in fields or not fields else fields[0]
+
+    def encode_statement(self, query, update):
+        """ :returns statement of 'update' command encoded to BSON: {q: query, u: update, upsert: upsert} """
+        body = b''.join((self._raw_q, bson_encode(query), self._raw_u, bson_encode(update), self._raw_tail))
+        return RawBSONDocument(struct.pack('<i', len(body) + 4) + body)
+
+    @staticmethod
+    def is_plain_setter(update):
+        """ :returns True if update only sets top-level fields """
+        if not isinstance(update, dict) or set(update.keys()) - {'$set'}:
+            return False
+        setter = update.get('$set', {})
+        return isinstance(setter, dict) and not any('.' in key for key in setter.keys())
+
+    @staticmethod
+    def get_staging_document(setter):
+        """ :returns document of staging collection: filter as 'k' and fields set by the update as 'd' """
+        return {'k': setter['filter'], 'd': dict(setter['update'].get('$set', {}))}
+
+    def get_merge_pipeline(self, target):
+        """ Documents of equal filters are merged in order of insertion, then merged into target collection.
+        New documents are inserted only if 'upsert' is set, as by update requests
+        """
+        return [{'$sort': {'_id': 1}},
+                {'$group': {'_id': '$k', 'd': {'$mergeObjects': '$d'}}},
+                {'$replaceRoot': {'newRoot': {'$mergeObjects': ['$d', '$_id']}}},
+                {'$merge': {'into': target, 'on': list(self.output['filter'].keys()), 'whenMatched': 'merge',
+                            'whenNotMatched': 'insert' if self.upsert else 'discard'}}]
+
+    @staticmethod
+    def decode_request(request):
+        """ :returns filter and update of request of any write mode """
+        if isinstance(request, RawBSONDocument):
+            statement = bson_decode(request.raw)
+            return statement['q'], statement['u']
+        return request._filter, request._doc
+
+    @staticmethod
+    def get_value(doc, path, default=None):
+        """ :returns value of document by dotted path """
+        for key in path.split('.'):
+            if not isinstance(doc, dict) or key not in doc:
+                return default
+            doc = doc[key]
+        return doc
+
+    @staticmethod
+    def is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    def is_tolerant(self, path):
+        """ :returns True if the field is listed in 'tolerant_fields' of 'skip_unchanged' or is nested in one """
+        return any(path == field or path.startswith(field + '.') for field in self.skip_unchanged['tolerant_fields'])
+
+    def is_close(self, current, value, path):
+        """ Numbers of tolerant fields, e.g. expiry timestamps, are close if they differ by at most 'tolerance' of
+        'skip_unchanged'. Other values must be equal
+        """
+        if isinstance(current, dict) and isinstance(value, dict):
+            return current.keys() == value.keys() and all(
+                self.is_close(current[key], value[key], '{}.{}'.format(path, key)) for key in value)
+        if self.is_number(current) and self.is_number(value) and self.is_tolerant(path):
+            return abs(current - value) <= self.skip_unchanged['tolerance']
+        return current == value
+
+    def is_changing(self, doc, doc_filter, update):
+        """ :returns False if the document matches the filter and the update changes nothing in it """
+        missing = object()
+        if set(update.keys()) - {'$set', '$unset', '$max'}:
+            return True
+        for path, value in doc_filter.items():
+            if isinstance(value, dict) or self.get_value(doc, path, missing) != value:
+                return True
+        for path, value in update.get('$set', {}).items():
+            if not self.is_close(self.get_value(doc, path, missing), value, path):
+                return True
+        for path in update.get('$unset', {}):
+            if self.get_value(doc, path, missing) is not missing:
+                return True
+        for path, value in update.get('$max', {}).items():  # a greater or close value is kept by $max
+            current = self.get_value(doc, path, missing)
+            if not self.is_close(current, value, path) and not (self.is_number(current) and self.is_number(value) and
+                                                          current > value):
+                return True
+        return False
+
+    def apply_update(self, doc, update):
+        """ :returns copy of the document as the update leaves it or None if the result can't be predicted """
+        if set(update.keys()) - {'$set', '$unset', '$max'}:
+            return None
+        doc = deepcopy(doc)
+        missing = object()
+        for path, value in update.get('$set', {}).items():
+            if not self.set_value(doc, path, value):
+                return None
+        for path in update.get('$unset', {}):
+            parent = self.get_value(doc, path.rpartition('.')[0]) if '.' in path else doc
+            if isinstance(parent, dict):
+                parent.pop(path.rpartition('.')[2], None)
+        for path, value in update.get('$max', {}).items():
+            current = self.get_value(doc, path, missing)
+            if current is missing or self.is_number(current) and self.is_number(value) and value > current:
+                if not self.set_value(doc, path, value):
+                    return None
+            elif not (self.is_number(current) and self.is_number(value)):  # values of different types
+                return None
+        return doc
+
+    @staticmethod
+    def set_value(doc, path, value):
+        """ Sets value by dotted path creating missing maps. :returns False if the path goes through a scalar """
+        keys = path.split('.')
+        for key in keys[:-1]:
+            doc = doc.setdefault(key, dict())
+            if not isinstance(doc, dict):
+                return False
+        doc[keys[-1]] = value
+        return True
 
     def get_setter(self, line, config):
         if self.fixed_line_size and len(config['titles']) != len(line):
@@ -293,9 +1017,29 @@ class Strategy(object):
         dict_line = dict()
         for index in range(len(line)):
             if not config['patterns'][index].match(line[index].strip()):  # validation
-                raise BadLine
+                raise BadLine(column=config['titles'][index])
             dict_line[config['titles'][index]] = line[index].strip()
-        return self._parse_output(self.output, dict_line)
+        return self.render(dict_line)
+
+    def render(self, dict_line, output=None):
+        """ :param output: section like 'update_one', 'update_one' of the strategy by default
+        :returns filter and update of validated line
+        """
+        setter = self._parse_output(output or self.output, dict_line)
+        if isinstance(setter['update'], list):
+            setter['update'] = self.merge_sections(setter['update'])
+        return setter
+
+    @staticmethod
+    def merge_sections(sections):
+        """ :param sections: list of maps of operator to fields, given in config or rendered by templates
+        :returns update merging fields of equal operators in order of sections
+        """
+        update = dict()
+        for section in sections:
+            for operator, fields in section.items():
+                update.setdefault(operator, dict()).update(fields)
+        return update
 
     def _parse_output(self, item, dict_line):
         if isinstance(item, dict):
@@ -303,6 +1047,8 @@ class Strategy(object):
             for key, value in item.items():
                 item[key] = self._parse_output(value, dict_line)
             return item
+        if isinstance(item, list):
+            return [self._parse_output(value, dict_line) for value in item]
         if isinstance(item, str):
             matched = templates.REGEXP.match(item)
             if matched:
@@ -315,9 +1061,9 @@ class Strategy(object):
         return self.templates[name].apply(dict_line)
 
     def set_of_used_templates(self, item):
-        if isinstance(item, dict):
+        if isinstance(item, (dict, list)):
             out = set()
-            for value in item.values():
+            for value in item.values() if isinstance(item, dict) else item:
                 out.update(self.set_of_used_templates(value))
             return out
         if isinstance(item, str):
@@ -326,11 +1072,81 @@ class Strategy(object):
                 return {matched.group(1)}
         return set()
 
+    def get_file_name(self, path):
+        """ File name is internal identifier of file """
+        if self.override_filename_from_path:
+            regexp, replacement = self.override_filename_from_path
+            return regexp.sub(replacement, path)
+        return os.path.basename(path).split('.')[0]
+
     def get_file_type(self, path):
         rtype = mimetypes.guess_type(path)
         return (self.__file_type_override, rtype[1]) if self.__file_type_override else rtype
 
 
+class FileTask(object):
+    """ Compact descriptor of discovered segment file. It is passed between processes instead of SegmentFile,
+    strategies are shipped to workers once at start
+    """
+    __slots__ = ('path', 'provider', 'name', 'size', 'fresh', 'ordering_key', 'max_parallel', 'index',
+                 'shared_index', 'source')
+
+    def __init__(self, path, provider, strategy, size=None, source=None):
+        if not source and not os.path.isfile(path):
+            raise FileNotFoundError('File {} doesn\'t exist.'.format(path))
+        self.path = path
+        self.provider = provider
+        self.name = strategy.get_file_name(path)
+        file_type = strategy.get_file_type(path)[0]
+        if file_type not in strategy.allowed_types:
+            raise WrongFileType(self.name, file_type, strategy.allowed_types)
+        if size is None:
+            size = source.get_size(path) if source else os.path.getsize(path)
+        self.size = size
+        self.fresh = False  # whether the file is discovered after the first scan of delivery
+        self.ordering_key = None  # files of a provider with equal keys are uploaded to a cluster one by one
+        self.max_parallel = strategy.max_parallel_files_per_cluster
+        self.index = None  # fs.DiscoveryIndex of delivery the file comes from
+        self.shared_index = None
+        self.source = source  # fs.S3Source of remote file
+
+
+class PackTask(object):
+    """ Consecutive small files of a provider which are uploaded by one worker as one stream of batches """
+    __slots__ = ('tasks', 'provider', 'name', 'size', 'fresh', 'ordering_key', 'max_parallel')
+
+    def __init__(self, tasks):
+        self.tasks = tasks  # list of FileTask
+        self.provider = tasks[0].provider
+        self.name = '{}+{}'.format(tasks[0].name, len(tasks) - 1)
+        self.size = sum(task.size for task in tasks)
+        self.fresh = all(task.fresh for task in tasks)
+        self.ordering_key = tasks[0].ordering_key
+        self.max_parallel = tasks[0].max_parallel
+
+    @staticmethod
+    def pack(tasks, config):
+        """ Groups consecutive files not larger than 'max_bytes' into packs of at most 'max_bytes' and 'max_files'.
+        Files of a pack have equal ordering keys
+        :returns list of FileTask and PackTask in order of tasks
+        """
+        max_bytes = config.get('max_bytes', 1048576)
+        max_files = config.get('max_files', 100)
+        out = list()
+        group = list()
+        for task in tasks + [None]:
+            small = task is not None and task.size <= max_bytes and not isinstance(task.source, fs.StreamSegment)
+            if group and (not small or len(group) >= max_files or task.ordering_key != group[0].ordering_key or
+                          sum(item.size for item in group) + task.size > max_bytes):
+                out.append(PackTask(group) if len(group) > 1 else group[0])
+                group = list()
+            if small:
+                group.append(task)
+            elif task is not None:
+                out.append(task)
+        return out
+
+
 class FileEmitter(fs.EventHandler):
     class Sorter(object):
         def __init__(self, config):
@@ -338,12 +1154,20 @@ class FileEmitter(fs.EventHandler):
                 raise AttributeError('Section \'sorting\' must have \'file_path_regexp\' and \'order\'')
             self.file_path_regexp = re.compile(config['file_path_regexp'])
             self.order = config['order']
+            self.ordering_key = list()
+            for field in config.get('ordering_key', []):
+                try:
+                    self.ordering_key.append(int(field.split('.')[1]) if field.startswith('path.') else None)
+                except (IndexError, ValueError):
+                    self.ordering_key.append(None)
+                if self.ordering_key[-1] is None:
+                    raise AttributeError('Items of \'ordering_key\' must be groups of path such as \'path.0\'')
 
         def _get_variables(self, path):
-            stat = os.stat(path)
+            stat = os.stat(path) if '://' not in path else None  # stat of remote files isn't available
             stat_dict = dict()
             for field in ('st_size', 'st_atime', 'st_mtime', 'st_ctime'):
-                stat_dict[field] = getattr(stat, field)
+                stat_dict[field] = getattr(stat, field, 0)
             try:
                 matched = self.file_path_regexp.match(path).groups()
             except AttributeError:
@@ -364,6 +1188,13 @@ class FileEmitter(fs.EventHandler):
                     lst.sort(key=lambda x: x[field[0]][field[1]], reverse=(True if order == 'desc' else False))
             return [f['origin'] for f in lst]
 
+        def get_ordering_key(self, path):
+            """ :returns tuple of groups of path listed in 'ordering_key' or None if it isn't set """
+            if not self.ordering_key:
+                return None
+            matched = self._get_variables(path)['path']
+            return tuple(matched[index] for index in self.ordering_key)
+
     def __init__(self, provider, upload_config):
         super().__init__()
         self.provider = provider
@@ -372,14 +1203,20 @@ class FileEmitter(fs.EventHandler):
         self.sorting = self.Sorter(upload_config['sorting']) if 'sorting' in upload_config else None
         self.sort = self.sorting.sort if self.sorting else lambda x: x
         self.strategy = Strategy(upload_config)
+        self.clusters = self.strategy.clusters
         logger.debug('Loaded strategy for %s', provider)
 
-    def on_file_discovered(self, path):
+    def on_file_discovered(self, path, size=None, fresh=False, index=None, source=None):
         logger.debug('%s is discovered. Put in queue', path)
         try:
-            self.queue.put(SegmentFile(path, self.provider, self.strategy))
+            task = FileTask(path, self.provider, self.strategy, size, source)
+            task.fresh = fresh
+            task.index = index
+            if self.sorting:
+                task.ordering_key = self.sorting.get_ordering_key(path)
+            self.queue.put(task)
             self.items_ready.set()
-        except WrongFileType as err:
+        except (WrongFileType, InvalidSegmentFile) as err:
             logger.error(err)
             self.errors.set()
 
@@ -397,80 +1234,102 @@ class FileEmitter(fs.EventHandler):
 
 
 class Counter(object):
+    """ Running totals of results of files per provider and cluster. Only a window of recently finished files is
+    kept in order to count each file once, so memory doesn't grow however many files are uploaded
+    """
+    LINE_KEYS = ('line_cur', 'line_invalid', 'line_total')
 
-    def __init__(self):
-        self._segfile_counters = dict()
-        self._invalid_files = set()
-        self._skipped_files = set()
+    def __init__(self, window=10000):
+        self.window = window
+        self._recent = OrderedDict()  # name of file -> state, the least recently finished files are forgotten
+        self._totals = dict()  # (provider, cluster) -> SegfileCounter summed over files
+        self._lines = dict()  # provider -> SegfileCounter of lines of files counted once over clusters
+        self._processed = 0
+        self._invalid = 0
+        self._skipped = 0
 
     @property
     def invalid(self):
-        return len(self._invalid_files)
+        return self._invalid
 
     @property
     def skipped(self):
-        return len(self._skipped_files)
+        return self._skipped
 
     @property
     def processed(self):
-        processed = set()
-        for item in self._segfile_counters.keys():
-            processed.add(item[0])
-        return len(processed)
+        return self._processed
 
     @property
     def known_providers(self):
-        known_providers = set()
-        for item in self._segfile_counters.keys():
-            known_providers.add(item[1])
-        return known_providers
+        return set(key[0] for key in self._totals.keys())
 
     @property
     def known_clusters(self):
-        known_clusters = set()
-        for item in self._segfile_counters.keys():
-            known_clusters.add(item[2])
-        return known_clusters
+        return set(key[1] for key in self._totals.keys())
 
     def _aggregate_counters(self, providers=None, clusters=None):
         """
-        Sum all _segfile_counters by providers or/and clusters
+        Sum running totals by providers or/and clusters. Lines of a file are counted once over clusters. If only a
+        part of clusters of a provider is chosen, lines of the provider are the most of lines of chosen clusters
         :return: united object of SegfileCounter or empty str
         """
-        if not self._segfile_counters:
+        if not self._totals:
             return ''
         if not providers:
             providers = self.known_providers
         if not clusters:
             clusters = self.known_clusters
-        filtered_keys = set()
-        known_files = set()
-        out = list()
-        for key in self._segfile_counters.keys():
-            if key[1] in providers and key[2] in clusters:
-                filtered_keys.add(key)
-        for key in filtered_keys:
-            if key[0] in known_files:
-                out[-1] &= self._segfile_counters[key]
+        out = None
+        for provider in providers:
+            keys = [key for key in self._totals.keys() if key[0] == provider and key[1] in clusters]
+            if not keys:
                 continue
-            out.append(copy(self._segfile_counters[key]))
-            known_files.add(key[0])
-        if len(out) >= 2:
-            return sum(out[:-1], out[-1])
-        if not out:
-            return None
-        return out[0]
+            counter = SegfileCounter()
+            for key in keys:
+                counter &= self._totals[key]
+            if all(key[1] in clusters for key in self._totals.keys() if key[0] == provider):
+                lines = self._lines[provider]
+            else:
+                lines = max((self._totals[key] for key in keys), key=lambda item: item.line_total)
+            for name in self.LINE_KEYS:
+                setattr(counter, name, getattr(lines, name))
+            out = counter if out is None else out + counter
+        return out
+
+    def _get_state(self, name):
+        state = self._recent.pop(name, None) or {'signatures': set(), 'invalid': False, 'skipped': False}
+        self._recent[name] = state
+        while len(self._recent) > self.window:
+            self._recent.popitem(last=False)
+        return state
 
     def count_result(self, item):
-        signature = item[0], item[3], item[4]  # slice of filename, provider, cluster_name
-        if item[1] == 1:
-            self._invalid_files.add(item[0])
-        if item[1:3] == (0, None) and signature not in self._segfile_counters:
-            self._skipped_files.add(item[0])
+        signature = item[3], item[4]  # slice of provider, cluster_name
+        state = self._get_state(item[0])
+        if item[1] == 1 and not state['invalid']:
+            state['invalid'] = True
+            self._invalid += 1
+        if item[1:3] == (0, None) and signature not in state['signatures'] and not state['skipped']:
+            state['skipped'] = True
+            self._skipped += 1
         if isinstance(item[2], SegfileCounter):
-            if signature not in self._segfile_counters:
-                self._segfile_counters[signature] = item[2]
-            self._skipped_files.discard(item[0])
+            if signature not in state['signatures']:
+                if not state['signatures']:
+                    self._processed += 1
+                    lines = self._lines.setdefault(item[3], SegfileCounter())
+                    for name in self.LINE_KEYS:
+                        setattr(lines, name, getattr(lines, name) + getattr(item[2], name))
+                state['signatures'].add(signature)
+                self._totals[signature] = self._totals.get(signature, SegfileCounter()) + item[2]
+            if state['skipped']:
+                state['skipped'] = False
+                self._skipped -= 1
+
+    def count_pack(self, provider, cluster_name, counter):
+        """ Adds replies to requests of a pack, its files are counted by count_result() """
+        signature = provider, cluster_name
+        self._totals[signature] = self._totals.get(signature, SegfileCounter()) + counter
 
     def __str__(self):
         out = list()
@@ -481,49 +1340,27 @@ class Counter(object):
         return 'Total files: {}. {}'.format(', '.join(out), self._aggregate_counters())
 
 
-class Inhibitor(Process):
-
-    def __init__(self, redis_conf, delays, delay_coefficient):
-        super().__init__()
-        self.daemon = True
-        import redis
-        redis_conf['decode_responses'] = True
-        self._api = redis.Redis(**redis_conf)
-        self.delays = delays
-        self.delay_coefficient = delay_coefficient or 100
-        # Automatically starting
-        self.start()
-
-    def run(self):
-        pipe = self._api.pipeline()
-        while True:
-            for name, val in self.delays.items():
-                time.sleep(5)
-                for key in [x for x in self._api.scan_iter(match='*:{}'.format(name))]:
-                    pipe.hmget(key, 'failed_requests.timeout', 'find_queries')
-                data = pipe.execute()  # e.g. [['0.0', '45078.0'], ['0.0', '45598.0']]
-                try:
-                    val.value = self.get_timeout_avg_fraction(data) * self.delay_coefficient
-                except TypeError as err:
-                    logger.error('%s. Wrong data from redis: %s', err, data)
-
-    @staticmethod
-    def get_timeout_avg_fraction(data):
-        return reduce(lambda a, b: a + float(b[0]) / float(b[1]) if float(b[1]) > 0 else a, data, 0) / len(
-            data) if data else 0
-
-
 class Uploader(app.App):
-    shared_array = Array('i', 1000)
+    shared_array = None  # created at start of run() in order not to allocate shared memory during import
     shared_metrics = dict()
+    strategies = dict()  # provider -> Strategy, passed to workers once by initializer of pool
+    coordination = None  # owner and lease of claims of files if several uploaders share deliveries
 
     def __init__(self):
         super().__init__()
         self.pool = None
         self.results = []
-        self.buffer = dict()
+        self.scheduler = None
+        self.balancer_leases = dict()
+        self.dispatched = dict()  # (provider, cluster, name) -> task being processed by pool
+        self.staged = set()  # (provider, cluster) whose indexes are built when nothing is queued for the cluster
+        self.index_builders = list()
+        self.postponed = list()  # tasks claimed by other uploaders: (retry_ts, task, cluster)
+        self.retry_interval = 60
+        self.metrics_lock = threading.Lock()
         self.counter = Counter()
         mimetypes.init()
+        register_types()
 
     @property
     def default_config(self):
@@ -533,6 +1370,8 @@ class Uploader(app.App):
             'reprocess_invalid': (False, 'Whether reprocess files were not uploaded previously'),
             'reprocess_file': ([], 'Paths of files which will be reprocessed.'),
             'force': (False, 'Process files even if they have been processed successfully previously'),
+            'validate_only': ([], 'Paths of files which will be parsed and validated without uploading.'),
+            'validation_samples': (3, 'Amount of rendered requests shown per file in validation mode'),
             'segments_collection': ('', 'Full name of collection (\'database.collection\') for uploading segments')
         })
         config['logging'] = (app.deep_merge(config['logging'][0], {'formatters': {
@@ -554,7 +1393,7 @@ class Uploader(app.App):
     def run(self):
         timer = app.Timer()
         timer.start()
-        if not hasattr(self.config, 'clusters'):
+        if not hasattr(self.config, 'clusters') and not self.config.validate_only:
             logger.error('Please provide cluster_config.yaml. See --help.')
             return 1
         if hasattr(self.config, 'mime_types_map'):
@@ -584,6 +1423,12 @@ class Uploader(app.App):
                 self.config.upload[key]['force_reprocess'] = self.config.force
             self.config.upload[key]['collection'] = self.config.upload[key].get(
                 'collection') or self.config.segments_collection
+        if self.config.validate_only:  # mongo isn't touched
+            if len(self.config.providers) != 1:
+                logger.error('You\'re using --validate_only, please set only one of \'%s\' provider with --providers',
+                             ', '.join(self.config.upload.keys()))
+                return 1
+            return self.validate(self.config.providers[0], self.config.validate_only, timer)
         for key in self.config.cluster_config.keys():
             if 'mongo_client_settings' not in self.config.cluster_config[key] and hasattr(self.config,
                                                                                           'mongo_client_settings'):
@@ -595,30 +1440,48 @@ class Uploader(app.App):
                 cl.uploading_delay = Value('d', 0.0)
                 delays.update({cl.name: cl.uploading_delay})
             Inhibitor(self.config.redis, delays, getattr(self.config, 'delay_coefficient', None))
-        for provider in self.config.providers:  # init buffer
-            self.buffer[provider] = dict()
-        for provider in self.config.providers:  # files of one provider can't be uploaded to a cluster simultaneously
+        if hasattr(self.config, 'manage_balancer'):
+            owner = '%s:%s' % (socket.gethostname(), os.getpid())
+            for name in self.config.manage_balancer:
+                if name in cluster.Cluster.objects:
+                    params = self.config.manage_balancer[name] if isinstance(self.config.manage_balancer,
+                                                                             dict) else None
+                    self.balancer_leases[name] = cluster.BalancerLease(cluster.Cluster.objects[name], owner, params)
+            self.renew_balancer_leases()  # balancer left stopped by a crashed uploader is started
+        if hasattr(self.config, 'coordination'):
+            params = self.config.coordination or dict()
+            Uploader.coordination = {'owner': '%s:%s' % (socket.gethostname(), os.getpid()),
+                                     'lease': app.human_to_seconds(params.get('lease', '5m'))}
+            self.retry_interval = app.human_to_seconds(params.get('retry_interval', '1m'))
+        self.scheduler = scheduler.create(getattr(self.config, 'scheduler', None), self.config.providers,
+                                          self.config.clusters, self.config.workers)
+        for provider in self.config.providers:
             self.shared_metrics[provider] = dict()
             for cl in self.config.clusters:
-                self.buffer[provider][cl] = [True, deque()]
-                self.shared_metrics[provider][cl] = Array('i', 3)  # array of current_line, invalid_lines, updated docs
+                # array of current_line, invalid_lines, updated docs, max time of waiting in queue
+                self.shared_metrics[provider][cl] = Array('i', 4)
+
+        if self.config.reprocess_file and len(self.config.providers) != 1:
+            logger.error('You\'re using --reprocess_file, please set only one of \'%s\' provider with --providers',
+                         ', '.join(self.config.upload.keys()))
+            return 1
+        file_emitters = [FileEmitter(provider, config) for provider, config in self.config.upload.items()]
+        Uploader.strategies = dict((obj.provider, obj.strategy) for obj in file_emitters)
+        Uploader.shared_array = Array('i', 1000)
 
-        def init(shared_array, shared_metrics):
+        def init(shared_array, shared_metrics, strategies, coordination):
             Uploader.shared_array = shared_array
             Uploader.shared_metrics = shared_metrics
+            Uploader.strategies = strategies
+            Uploader.coordination = coordination
 
         self.pool = Pool(processes=self.config.workers, initializer=init,
-                         initargs=(self.shared_array, self.shared_metrics))  # forking
+                         initargs=(self.shared_array, self.shared_metrics, self.strategies,
+                                   self.coordination))  # forking
         if self.config.reprocess_file:  # reprocessing given paths. We don't need to discover files
-            if len(self.config.providers) != 1:
-                logger.error('You\'re using --reprocess_file, please set only one of \'%s\' provider with --providers',
-                             ', '.join(self.config.upload.keys()))
-                return 1
-            file_emitter = FileEmitter(self.config.providers[0], self.config.upload[self.config.providers[0]])
             for path in self.config.reprocess_file:
-                file_emitter.on_file_discovered(path)
-            return self.main(errors, (file_emitter,), timer)  # end of reprocessing paths.
-        file_emitters = [FileEmitter(provider, config) for provider, config in self.config.upload.items()]
+                file_emitters[0].on_file_discovered(path)
+            return self.main(errors, file_emitters, timer)  # end of reprocessing paths.
         for file_emitter in file_emitters:
             file_emitter.start_observers()
         self.wait_for_items(file_emitters)
@@ -626,8 +1489,11 @@ class Uploader(app.App):
 
     def main(self, errors, file_emitters, timer):
         metrics_file = open(self.config.metrics['path'], 'w', buffering=1)
+        if hasattr(self.config, 'metrics') and self.config.metrics.get('server_stats_interval'):
+            ServerStatsCollector(cluster.Cluster.objects.values(), self.config.metrics['prefix'], metrics_file,
+                                 self.metrics_lock, self.config.metrics['server_stats_interval'])
         self.consume_queue(file_emitters)
-        while self.results:
+        while self.results or self.postponed:
             result_ready = False
             while not result_ready:  # polling of results
                 time.sleep(0.01)
@@ -637,93 +1503,350 @@ class Uploader(app.App):
                         self.results.remove(result)
                         result_ready = True
                         self.consume_queue(file_emitters)
+                if self.postponed and min(item[0] for item in self.postponed) <= time.time():
+                    result_ready = True
                 if hasattr(self.config, 'metrics'):
-                    timer.execute(self.flush_metrics, (self.config.metrics['prefix'], metrics_file),
+                    timer.execute(self.flush_metrics, (self.config.metrics['prefix'], metrics_file, self.metrics_lock),
                                   self.config.metrics['flush_interval'])
-            if not self.results:
+                if self.balancer_leases:
+                    timer.execute(self.renew_balancer_leases, (),
+                                  min(lease.lease for lease in self.balancer_leases.values()) / 3)
+            if not self.results and not self.postponed:
                 self.wait_for_items(file_emitters)
             self.consume_queue(file_emitters)
+        for lease in self.balancer_leases.values():
+            lease.release()
+        for thread in self.index_builders:
+            thread.join()
         for file_emitter in file_emitters:
             if file_emitter.errors.is_set():
                 errors += 1
         timer.stop()
         if hasattr(self.config, 'metrics'):
-            self.flush_metrics(self.config.metrics['prefix'], metrics_file)
+            self.flush_metrics(self.config.metrics['prefix'], metrics_file, self.metrics_lock)
         logger.info('%s %s', self.counter, timer)
         metrics_file.close()
         return errors + self.counter.invalid
 
+    def validate(self, provider, paths, timer):
+        """ Validates files in parallel using all cores. Nothing is written to mongo """
+        Uploader.strategies = {provider: Strategy(self.config.upload[provider])}
+
+        def init(strategies):
+            Uploader.strategies = strategies
+
+        pool = Pool(processes=min(cpu_count(), len(paths)), initializer=init, initargs=(self.strategies,))
+        results = [pool.apply_async(validate_file, (provider, path, self.config.validation_samples)) for path in paths]
+        pool.close()
+        errors = 0
+        total_lines = 0
+        total_invalid = 0
+        for result in results:
+            path, err_code, lines, reasons, rendered, elapsed = result.get()
+            if err_code:
+                errors += 1
+                continue
+            invalid = sum(reasons.values())
+            total_lines += lines
+            total_invalid += invalid
+            logger.info('%s: %s lines, %s invalid (%.2f%%), %d lines/s', path, lines, invalid,
+                        invalid * 100 / lines if lines else 0, lines / elapsed if elapsed else 0)
+            for reason, amount in sorted(reasons.items(), key=lambda x: x[1], reverse=True):
+                logger.info('%s: invalid %s - %s lines', path, reason, amount)
+            for request in rendered:
+                logger.info('%s: sample - %s', path, request)
+        pool.join()
+        timer.stop()
+        elapsed = timer.finished_ts - timer.started_ts
+        logger.info('Validated %s files. Lines: total - %s, invalid - %s. %d lines/s. %s', len(paths) - errors,
+                    total_lines, total_invalid, total_lines / elapsed if elapsed else 0, timer)
+        return errors
+
     @staticmethod
     def wait_for_items(emitter_objects, timeout=10800, atleast_one=False):
         start_time = time.time()
         while time.time() - start_time < timeout:
-            results = [obj.items_ready.is_set() for obj in emitter_objects]
+            results = [obj.items_ready.is_set() or not obj.queue.empty() for obj in emitter_objects]
             if atleast_one and any(results) or all(results):
                 return True
             time.sleep(0.5)
         raise TimeoutError('Reached timeout while waiting for files.')
 
     def consume_queue(self, emitter_objects):
-        for obj in emitter_objects:  # check emitter queues and put objects to buffer
+        for obj in emitter_objects:  # check emitter queues and put objects to scheduler
+            tasks = list()
             while not obj.queue.empty():
-                segment_file = obj.queue.get()
+                task = obj.queue.get()
                 Uploader.shared_array[0] = (Uploader.shared_array[0] + 1) % 1000  # increase index pointer within 1000
                 if not Uploader.shared_array[0]:  # index pointer mustn't point to itself
                     Uploader.shared_array[0] += 1
                 Uploader.shared_array[Uploader.shared_array[0]] = 0  # init element
-                segment_file.shared_index = Uploader.shared_array[0]  # pass index to segment_file
-                for cl_name in segment_file.strategy.clusters:
-                    self.buffer[segment_file.provider][cl_name][1].append(segment_file)
-        for provider in self.config.providers:  # check buffer
-            for cl in cluster.Cluster.objects.keys():
-                if self.buffer[provider][cl][0] and self.buffer[provider][cl][1]:
-                    self.results.append(
-                        self.pool.apply_async(process_file, (cl, self.buffer[provider][cl][1].popleft())))
-                    self.buffer[provider][cl][0] = False
+                task.shared_index = Uploader.shared_array[0]  # pass index to segment_file
+                if isinstance(task.source, fs.StreamSegment):
+                    task.source.pending = len(obj.clusters)
+                tasks.append(task)
+            if obj.strategy.packing is not None:
+                tasks = PackTask.pack(tasks, obj.strategy.packing)
+            for task in tasks:
+                for cl_name in obj.clusters:
+                    self.scheduler.put(task, cl_name)
+        now = time.time()
+        for retry in [item for item in self.postponed if item[0] <= now]:
+            self.postponed.remove(retry)
+            self.scheduler.put(retry[1], retry[2])
+        unbalanced = set()  # clusters whose balancer hasn't been stopped
+        for item in self.scheduler.get():
+            if item.cluster in unbalanced or not self.hold_balancer(item.cluster):
+                unbalanced.add(item.cluster)
+                self.scheduler.done(item.provider, item.cluster, item.task.name)
+                self.postponed.append((time.time() + self.retry_interval, item.task, item.cluster))
+                continue
+            wait_time = int(item.wait_time)
+            queue_wait_metric = self.shared_metrics[item.provider][item.cluster]
+            queue_wait_metric[3] = max(queue_wait_metric[3], wait_time)
+            self.dispatched[(item.provider, item.cluster, item.task.name)] = item.task
+            worker = process_pack if isinstance(item.task, PackTask) else process_file
+            self.results.append(self.pool.apply_async(worker, (item.cluster, item.task, wait_time)))
+        for cl in self.balancer_leases:
+            self.release_balancer(cl)
+        self.build_indexes()
 
     def handle_result(self, result):
         """
-        :param result: tuple of segfile.name, err_code, segfile.counter, segfile.provider, cluster.name
+        :param result: tuple of segfile.name, err_code, segfile.counter, segfile.provider, cluster.name.
+        If err_code is PACKED, results of files of the pack are listed in place of counter and replies to requests
+        of the pack are counted by the sixth item
         """
+        self.scheduler.done(result[3], result[4], result[0])
+        task = self.dispatched.pop((result[3], result[4], result[0]), None)
+        if result[1] == PACKED:
+            tasks = dict((item.name, item) for item in task.tasks) if task else dict()
+            for item in result[2]:
+                self.handle_file_result(item, tasks.get(item[0]))
+            if result[5]:
+                self.counter.count_pack(result[3], result[4], result[5])
+                if result[5].staged and self.strategies[result[3]].staging_indexes:
+                    self.staged.add((result[3], result[4]))
+        else:
+            self.handle_file_result(result, task)
+
+    def handle_file_result(self, result, task):
         self.counter.count_result(result)
-        self.buffer[result[3]][result[4]][0] = True
+        if isinstance(result[2], SegfileCounter) and result[2].staged and self.strategies[result[3]].staging_indexes:
+            self.staged.add((result[3], result[4]))
+        if result[1] == POSTPONED and task:  # a file of a pack is retried alone
+            self.postponed.append((time.time() + self.retry_interval, task, result[4]))
+        elif task and isinstance(task.source, fs.StreamSegment):
+            task.source.finish()
+
+    def hold_balancer(self, cl):
+        """ Stops balancer of the cluster before the first writer starts if 'manage_balancer' is set for it.
+        Leases of other clusters are renewed while waiting for migrations
+        :returns False if the balancer hasn't been stopped, so files mustn't be uploaded to the cluster yet
+        """
+        lease = self.balancer_leases.get(cl)
+        if lease and not lease.held:
+            if not lease.acquire(self.renew_balancer_leases):
+                logger.error('Uploading to \'%s\' is postponed until its balancer is stopped.', cl)
+                return False
+        return True
+
+    def release_balancer(self, cl):
+        """ Starts balancer of the cluster when there are neither active writers nor queued files for it """
+        lease = self.balancer_leases.get(cl)
+        if lease and lease.held and self.scheduler.is_idle(cl):
+            lease.release()
+
+    def build_indexes(self):
+        """ Builds indexes after files of a provider have been staged and there are no queued files for the cluster """
+        for provider, cl in list(self.staged):
+            if self.scheduler.is_idle(cl):
+                self.staged.discard((provider, cl))
+                thread = threading.Thread(target=self.create_indexes, args=(cl, self.strategies[provider]))
+                thread.start()
+                self.index_builders.append(thread)
+
+    @staticmethod
+    def create_indexes(cl, strategy):
+        try:
+            cluster.Cluster.objects[cl].create_indexes(strategy)
+        except Exception as err:
+            logger.error('Cannot build indexes of %s.%s at \'%s\': %s', strategy.database, strategy.collection, cl,
+                         err)
+
+    def renew_balancer_leases(self):
+        """ Renews held leases, expired leases of other uploaders are removed in order to start the balancer """
+        for lease in self.balancer_leases.values():
+            if lease.held:
+                lease.renew()
+            else:
+                lease.expire()
 
     @staticmethod
-    def flush_metrics(prefix, metrics_file):
+    def flush_metrics(prefix, metrics_file, lock):
         out = []
         ts = int(time.time())
         for provider in Uploader.shared_metrics.keys():
             for cl in Uploader.shared_metrics[provider].keys():
                 mp = (('lines_processed', Uploader.shared_metrics[provider][cl][0]),
                       ('invalid', Uploader.shared_metrics[provider][cl][1]),
-                      ('uploaded', Uploader.shared_metrics[provider][cl][2]))
+                      ('uploaded', Uploader.shared_metrics[provider][cl][2]),
+                      ('queue_wait', Uploader.shared_metrics[provider][cl][3]))
                 for metric in mp:
-                    out.append('{}.{}.{}.{} {} {}\n'.format(prefix, provider, cl, metric[0], metric[1], ts))
+                    out.append(app.format_metric(prefix, (provider, cl, metric[0]), metric[1], ts))
                 for i in range(len(Uploader.shared_metrics[provider][cl])):  # reset counters
                     Uploader.shared_metrics[provider][cl][i] = 0
         logger.debug('Flushing %s metrics', len(out))
-        metrics_file.write(''.join(out))
+        with lock:
+            metrics_file.write(''.join(out))
 
 
-def process_file(cluster_name, segfile):
+def validate_file(provider, path, samples):
+    """ :return: (path, error_code, lines, map of reason to amount of invalid lines, rendered requests, seconds) """
+    started = time.time()
+    try:
+        segfile = SegmentFile(path, provider, Uploader.strategies[provider])
+        lines, reasons, rendered = segfile.validate(samples)
+    except Exception as err:  # a broken file is reported as invalid, the other files are validated anyway
+        logger.error('%s is invalid: %s: %s', path, type(err).__name__, err)
+        return path, 1, 0, dict(), list(), time.time() - started
+    return path, 0, lines, reasons, rendered, time.time() - started
+
+
+def process_file(cluster_name, task, wait_time=0):
     """
+    :param task: FileTask
+    :param wait_time: seconds the file has been waiting in queue
     :return: (error_code, counter)
     """
     cl = cluster.Cluster.objects[cluster_name]
     logger = logging.getLogger('worker')
-    logger.extra = {'provider': segfile.provider, 'segfile': segfile.name, 'cluster': cl.name}
+    logger.extra = {'provider': task.provider, 'segfile': task.name, 'cluster': cl.name}
+    try:
+        segfile = SegmentFile.from_task(task, Uploader.strategies[task.provider])
+    except (FileNotFoundError, WrongFileType) as err:
+        logger.error(err)
+        return task.name, 1, None, task.provider, cl.name
     segfile.logger = logger
+    segfile.cluster = cl.name
     segfile.shared_metrics = Uploader.shared_metrics[segfile.provider][cl.name]
+    if Uploader.coordination:
+        segfile.claim = Uploader.coordination
+        if not cl.claim_segfile(segfile):
+            logger.debug('The file is being uploaded by another uploader. Postponing.')
+            return segfile.name, POSTPONED, None, segfile.provider, cl.name
     try:
         cl.read_segfile_info(segfile)
     except InvalidSegmentFile as err:
         logger.error(err)
+        cl.release_segfile_claim(segfile)
         return segfile.name, 1, None, segfile.provider, cl.name
+    skipped = skip_segfile(cl, segfile, task, logger, wait_time)
+    if skipped:
+        return skipped
+    try:
+        cl.upload_segfile(segfile)
+    except InvalidSegmentFile as err:
+        logger.error(err)
+        return segfile.name, 1, segfile.counter, segfile.provider, cl.name
+    except cluster.LeaseLost as err:
+        logger.warning(err)
+        return segfile.name, POSTPONED, None, segfile.provider, cl.name
+    else:
+        segfile.processed = True
+    finally:
+        if segfile.snapshot:
+            segfile.snapshot.close(commit=segfile.processed and not segfile.invalid)
+        cl.save_segfile_info(segfile)
+        logger.info('Finished %s. %s %s', segfile.path, segfile.counter, segfile.timer)
+    return finish_segfile(cl, segfile, task)
+
+
+def process_pack(cluster_name, pack, wait_time=0):
+    """ Uploads small files of a pack by one stream of batches. Metadata of the files is read by one query and
+    saved by one bulk write
+    :param pack: PackTask
+    :param wait_time: seconds the pack has been waiting in queue
+    :return: (pack name, PACKED, list of results of its files as returned by process_file, provider, cluster name,
+    counter of replies to requests of the pack or None if nothing has been uploaded)
+    """
+    cl = cluster.Cluster.objects[cluster_name]
+    logger = logging.getLogger('worker')
+    logger.extra = {'provider': pack.provider, 'segfile': pack.name, 'cluster': cl.name}
+    results = dict()
+    segfiles = list()
+    for task in pack.tasks:
+        try:
+            segfile = SegmentFile.from_task(task, Uploader.strategies[task.provider])
+        except (FileNotFoundError, WrongFileType) as err:
+            logger.error(err)
+            results[task.name] = task.name, 1, None, task.provider, cl.name
+            continue
+        segfile.logger = logger
+        segfile.cluster = cl.name
+        segfile.shared_metrics = Uploader.shared_metrics[segfile.provider][cl.name]
+        if Uploader.coordination:
+            segfile.claim = Uploader.coordination
+            if not cl.claim_segfile(segfile):
+                logger.debug('File %s is being uploaded by another uploader. Postponing.', segfile.name)
+                results[task.name] = segfile.name, POSTPONED, None, segfile.provider, cl.name
+                continue
+        segfiles.append((segfile, task))
+    metadata = cl.read_segfiles_info([segfile for segfile, task in segfiles]) if segfiles else dict()
+    upload = list()
+    for segfile, task in segfiles:
+        logger.extra['segfile'] = segfile.name
+        try:
+            segfile.load_metadata(metadata.get(segfile.name))
+        except InvalidSegmentFile as err:
+            logger.error(err)
+            cl.release_segfile_claim(segfile)
+            results[task.name] = segfile.name, 1, None, segfile.provider, cl.name
+            continue
+        skipped = skip_segfile(cl, segfile, task, logger, wait_time)
+        if skipped:
+            results[task.name] = skipped
+        else:
+            upload.append((segfile, task))
+    logger.extra['segfile'] = pack.name
+    counter = None
+    if upload:
+        obj = SegmentPack(pack.name, [segfile for segfile, task in upload], logger)
+        try:
+            cl.upload_segfile(obj)
+        except cluster.LeaseLost as err:
+            logger.warning(err)
+            for segfile, task in upload:
+                results[task.name] = segfile.name, POSTPONED, None, segfile.provider, cl.name
+        else:
+            for segfile in obj.segfiles:
+                segfile.processed = segfile not in obj.stopped
+                segfile.pack = pack.name
+        finally:
+            counter = obj.counter
+            cl.save_segfiles_info(obj.segfiles, pack=obj)
+            for segfile in obj.segfiles:
+                logger.info('Finished %s. %s %s', segfile.path, segfile.counter, segfile.timer)
+            logger.info('Finished pack %s. %s', pack.name, obj.counter)
+        for segfile, task in upload:
+            if task.name not in results:
+                results[task.name] = finish_segfile(cl, segfile, task)
+    return pack.name, PACKED, [results[task.name] for task in pack.tasks], pack.provider, cl.name, counter
+
+
+def skip_segfile(cl, segfile, task, logger, wait_time=0):
+    """ Decides by loaded metadata whether the file is uploaded
+    :returns result of the skipped file or None if the file has to be uploaded
+    """
     if segfile.processed and not segfile.invalid and not segfile.strategy.force_reprocess:
         logger.debug('The file has already been uploaded. Skipping.')
+        cl.release_segfile_claim(segfile)
+        if task.index:
+            task.index.mark_done(segfile.path, cl.name)
         return segfile.name, 0, None, segfile.provider, cl.name
     if segfile.invalid and not segfile.strategy.reprocess_invalid and not segfile.strategy.force_reprocess:
         logger.debug('The file is invalid. Skipping.')
+        cl.release_segfile_claim(segfile)
         return segfile.name, 0, None, segfile.provider, cl.name
     if segfile.invalid:
         logger.info('The file was invalid. Reprocessing.')
@@ -731,15 +1854,18 @@ def process_file(cluster_name, segfile):
         logger.info('The file was uploaded successfully at %s. Reprocessing.',
                     time.strftime('%d %b %Y %H:%M', time.localtime(segfile.timer.finished_ts)))
     else:
-        logger.info('Starting uploading file \'%s\'.', segfile.path)
-    try:
-        cl.upload_segfile(segfile)
-    except InvalidSegmentFile as err:
-        logger.error(err)
-        return segfile.name, 1, segfile.counter, segfile.provider, cl.name
-    else:
-        segfile.processed = True
-    finally:
-        cl.save_segfile_info(segfile)
-        logger.info('Finished %s. %s %s', segfile.path, segfile.counter, segfile.timer)
+        logger.info('Starting uploading file \'%s\' after %s seconds in queue.', segfile.path, wait_time)
+    return None
+
+
+def finish_segfile(cl, segfile, task):
+    """ :returns result of the uploaded file """
+    if isinstance(task.source, fs.StreamSegment) and not segfile.invalid:
+        cl.save_stream_checkpoint(segfile)
+    if task.index and not segfile.invalid:
+        task.index.mark_done(segfile.path, cl.name)
     return segfile.name, 1 if segfile.invalid else 0, segfile.counter, segfile.provider, cl.name
+
+
+class MongoUploadCli(Uploader, app.AppCli):
+    SettingsClass = app.SettingCliUploader
@@ -7,7 +7,7 @@ with open(path.join(here, 'README.rst')) as f:
 
 setup(
     name='iow-mongo-tools',
-    version='0.7.6',
+    version='0.10.4',
     description='Various tools for maintenance mongo cluster',
     long_description=long_description,
     url='https://confluence.iponweb.net/display/OPS/iow-mongo-tools',
@@ -25,14 +25,21 @@ setup(
     keywords='mongo iow',
     packages=find_packages(),
     install_requires=['pymongo>=3.5.1', 'redis'],
+    extras_require={
+        's3': ['boto3'],
+        'arrow': ['pyarrow'],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+    },
     setup_requires=['pytest-runner'],
-    tests_require=['pytest', 'pyaml', 'mongomock'],
+    tests_require=['pytest', 'pyaml', 'mongomock', 'pyarrow'],
     entry_points={
         'console_scripts': [
             'mongo_check=iowmongotools:MongoCheckerCli.entry',
             'mongo_set=iowmongotools:MongoSetCli.entry',
             'mongo_clone=iowmongotools:MongoCloneCli.entry',
             'mongo_upload=iowmongotools:MongoUploadCli.entry',
+            'mongo_cleanup=iowmongotools:MongoCleanupCli.entry',
         ],
     },
 )
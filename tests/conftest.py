@@ -1,9 +1,10 @@
 # content of conftest.py
+import io
 import os
 import sys
 import pytest
 sys.modules['pymongo'] = __import__('mongomock')
-from iowmongotools import cluster
+from iowmongotools import cluster, fs
 import yaml
 
 @pytest.fixture(scope="module")
@@ -19,3 +20,36 @@ def local_cluster():
         local_cluster_instance._api.config[key].insert_many(cluster_config[key])
 
     return local_cluster_instance
+
+
+class FakeS3Client(object):
+    """ auxiliary stand-in of S3 serving objects from dict """
+    def __init__(self, objects=None, page_size=2):
+        self.objects = objects or dict()
+        self.page_size = page_size
+        self.ranges = list()
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', ContinuationToken=''):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix) and key > max(StartAfter,
+                                                                                            ContinuationToken))
+        response = {'Contents': [{'Key': key, 'Size': len(self.objects[key])} for key in keys[:self.page_size]],
+                    'IsTruncated': len(keys) > self.page_size}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = keys[self.page_size - 1]
+        return response
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[Key])}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        self.ranges.append((start, end))
+        return {'Body': io.BytesIO(self.objects[Key][start:end + 1])}
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    """ S3 stand-in used by all S3Source objects """
+    client = FakeS3Client()
+    monkeypatch.setattr(fs.S3Source, 'client_factory', staticmethod(lambda settings: client))
+    return client
@@ -230,4 +230,17 @@ def test_timer():
     timer.stop()
     assert int(timer.started_ts) == int(start_ts)
     assert int(timer.finished_ts) == int(finish_ts)
-    assert str(timer) == 'Processing time - 0 hours 0 minutes 0 seconds.'
\ No newline at end of file
+    assert str(timer) == 'Processing time - 0 hours 0 minutes 0 seconds.'
+
+def test_format_metric():
+    assert app.format_metric('mongo_check', ('gce-eu', 'project.cookies', 'chunks'), 5, 1550000000) == \
+           'mongo_check.gce-eu.project_cookies.chunks 5 1550000000\n'
+
+
+def test_cli_doesnt_import_uploader():
+    import subprocess
+    import sys
+    code = 'import sys, iowmongotools; print(sorted(m for m in ("iowmongotools.upload", "iowmongotools.fs", ' \
+           '"mimetypes") if m in sys.modules))'
+    output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+    assert output.strip() == '[]'
@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+import pytest
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from iowmongotools import cleanup
+
+
+def test_job_get_request():
+    with pytest.raises(AttributeError):
+        cleanup.Job('liveramp', {})
+    job = cleanup.Job('liveramp', {'collection': 'test.cleanup', 'fields': ['lvmp', 'a.b']})
+    assert job.get_request({'_id': 1, 'lvmp': {'s1': 200}}, 100) == (None, 0)
+    request, expired = job.get_request({'_id': 1, 'lvmp': {'s1': 50, 's2': 200}, 'a': {'b': {'s3': 100}}}, 100)
+    assert expired == 2
+    assert request == cleanup.UpdateOne({'_id': 1, 'lvmp.s1': 50, 'a.b.s3': 100},
+                                        {'$unset': {'lvmp.s1': '', 'a.b.s3': ''}})
+    request, expired = job.get_request({'_id': 1, 'lvmp': {'s1': 50}, 'a': {'b': {'s3': 100}}}, 100)
+    assert (request, expired) == (cleanup.DeleteOne({'_id': 1, 'lvmp': {'s1': 50}, 'a': {'b': {'s3': 100}}, '$expr': {
+        '$eq': [{'$size': {'$objectToArray': '$$ROOT'}}, 3]}}), 2)  # fields written after reading aren't deleted
+    request, expired = job.get_request({'_id': 1, 'lvmp': {'s1': 50}, 'user': 'x'}, 100)
+    assert request == cleanup.UpdateOne({'_id': 1, 'lvmp.s1': 50}, {'$unset': {'lvmp.s1': ''}})
+    with pytest.raises(AttributeError):
+        cleanup.Job('root', {'collection': 'test.cleanup'})
+    job = cleanup.Job('root', {'collection': 'test.cleanup', 'fields': [''], 'delete_empty': False})
+    assert job.projection is None
+    assert job.get_request({'_id': 1, 's1': 50, 'name': 'x', 'flag': True}, 100) == (
+        cleanup.UpdateOne({'_id': 1, 's1': 50}, {'$unset': {'s1': ''}}), 1)
+
+
+def test_range_find(local_cluster):
+    collection = local_cluster._api['test']['cleanup_find']
+    collection.insert_many([{'_id': i} for i in range(10)])
+    job = cleanup.Job('liveramp', {'collection': 'test.cleanup_find', 'fields': ['lvmp']})
+    key = {'_id': 1}
+    bounds = [({'_id': MinKey()}, {'_id': 3}), ({'_id': 3}, {'_id': 7}), ({'_id': 7}, {'_id': MaxKey()})]
+    found = [[doc['_id'] for doc in cleanup.Range(job, key, item, 'local').find(collection)] for item in bounds]
+    assert found == [[0, 1, 2], [3, 4, 5, 6], [7, 8, 9]]
+    assert len(list(cleanup.Range(job, None, (None, None), 'local').find(collection))) == 10
+    assert cleanup.Range(job, key, bounds[1], 'local').id == 'liveramp:{"_id": 3}'
+
+
+def test_clean_range(local_cluster):
+    collection = local_cluster._api['test']['cleanup']
+    collection.insert_many([{'_id': 1, 'lvmp': {'s1': 1, 's2': 2 ** 40}},
+                            {'_id': 2, 'lvmp': {'s1': 1}},
+                            {'_id': 3, 'lvmp': {'s2': 2 ** 40}}])
+    job = cleanup.Job('liveramp', {'collection': 'test.cleanup', 'fields': ['lvmp'], 'batch_size': 1})
+    obj = cleanup.Range(job, None, (None, None), local_cluster.name, dry=True)
+    local_cluster.clean_range(obj)
+    assert obj.counts == {'scanned': 3, 'unset': 2, 'updated': 0, 'deleted': 0}
+    assert collection.count_documents({}) == 3
+    obj = cleanup.Range(job, None, (None, None), local_cluster.name)
+    assert list(obj.get_batch(collection)) == [
+        [cleanup.UpdateOne({'_id': 1, 'lvmp.s1': 1}, {'$unset': {'lvmp.s1': ''}})],
+        [cleanup.DeleteOne({'_id': 2, 'lvmp': {'s1': 1}, '$expr': {
+            '$eq': [{'$size': {'$objectToArray': '$$ROOT'}}, 2]}})]]
+    obj.count_bulk_write_result(SimpleNamespace(acknowledged=True, modified_count=1, deleted_count=1))
+    obj.count_bulk_write_result(SimpleNamespace(acknowledged=False))
+    assert obj.counts == {'scanned': 3, 'unset': 2, 'updated': 1, 'deleted': 1}
+
+
+def test_cleanup_mark(local_cluster):
+    local_cluster.save_cleanup_mark('test', 'liveramp', {'_id': 3}, {'scanned': 3})
+    local_cluster.save_cleanup_mark('test', 'liveramp', {'_id': 7}, {'scanned': 2})
+    local_cluster.save_cleanup_mark('test', 'other', {'_id': 1}, {'scanned': 1})
+    assert local_cluster.read_cleanup_mark('test', 'liveramp') == {'_id': 7}
+    doc = local_cluster._api['test'][local_cluster.CLEANUP_PROGRESS_COLLECTION].find_one({'_id': 'liveramp'})
+    assert doc['scanned'] == 5
+    local_cluster.reset_cleanup_mark('test', 'liveramp')
+    assert local_cluster.read_cleanup_mark('test', 'liveramp') is None
+    assert local_cluster.read_cleanup_mark('test', 'other') == {'_id': 1}
+
+
+def test_resume_after_chunk_split(local_cluster, monkeypatch):
+    monkeypatch.setattr(cleanup.app.App, '__init__', lambda self: None)
+    cleaner = cleanup.Cleaner()
+    cleaner.config = SimpleNamespace(dry=False, restart=False)
+    job = cleanup.Job('liveramp', {'collection': 'test.cleanup_split', 'fields': ['lvmp']})
+    key = {'_id': 1}
+    chunks = [({'_id': MinKey()}, {'_id': 3}), ({'_id': 3}, {'_id': 7}), ({'_id': 7}, {'_id': MaxKey()})]
+    monkeypatch.setattr(local_cluster, 'get_chunk_ranges', lambda namespace: (key, chunks))
+    monkeypatch.setattr(local_cluster, 'clean_range', lambda obj: obj.counts.update(scanned=1))
+    ranges = cleaner.plan(local_cluster, job)
+    progress = cleanup.Progress(ranges)
+    assert cleaner.clean(local_cluster, ranges[2], progress) == 0
+    assert local_cluster.read_cleanup_mark('test', 'liveramp') is None  # the first range hasn't been cleaned yet
+    cleaner.clean(local_cluster, ranges[0], progress)
+    assert local_cluster.read_cleanup_mark('test', 'liveramp') == {'_id': 3}  # the run is interrupted here
+    # the cleaned chunk is split, the chunk containing the mark is the result of a merge
+    chunks[:] = [({'_id': MinKey()}, {'_id': 1}), ({'_id': 1}, {'_id': 5}), ({'_id': 5}, {'_id': MaxKey()})]
+    ranges = cleaner.plan(local_cluster, job)
+    assert [obj.bounds for obj in ranges] == [({'_id': 3}, {'_id': 5}), ({'_id': 5}, {'_id': MaxKey()})]
+    cleaner.clean(local_cluster, ranges[0], cleanup.Progress(ranges))
+    assert local_cluster.read_cleanup_mark('test', 'liveramp') == {'_id': 5}
+    assert cleanup.Progress.pending(key, chunks, {'other': 1}) == chunks  # a mark of another shard key is ignored
@@ -1,4 +1,10 @@
-from iowmongotools import cluster
+import datetime
+from types import SimpleNamespace
+import pytest
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from pymongo.errors import BulkWriteError
+from iowmongotools import cluster, upload
 
 sample_cluster_config = {
     'mongos': ['mongo-gce-or-1.project.iponweb.net:27017', 'mongo-gce-or-2.project.iponweb.net:27017',
@@ -104,3 +110,353 @@ def test_generate_commands():
 #     assert real_cluster.actual_config == {'collections': {}, 'databases': {}, 'mongos': [], 'shards': []}
 #     invoker.execute()
 #     assert real_cluster.actual_config == {'collections': {}, 'databases': {}, 'mongos': [], 'shards': []}
+
+
+def test_mongo_hash():
+    assert cluster.mongo_hash('cd59f2ca-5480-4fb9-b580-2e2f3194ce96') == cluster.mongo_hash(
+        'cd59f2ca-5480-4fb9-b580-2e2f3194ce96')
+    assert cluster.mongo_hash('a') != cluster.mongo_hash('b')
+    assert cluster.mongo_hash(1) != cluster.mongo_hash('1')
+    assert -2 ** 63 <= cluster.mongo_hash(2 ** 40) < 2 ** 63
+    with pytest.raises(ValueError):
+        cluster.mongo_hash(1.5)
+
+
+def test_chunk_map():
+    chunks = [{'min': {'_id': MinKey()}, 'shard': 's1'}, {'min': {'_id': 'h'}, 'shard': 's2'},
+              {'min': {'_id': 'p'}, 'shard': 's1'}]
+    chunk_map = cluster.ChunkMap({'_id': 1}, chunks)
+    assert chunk_map.route({'_id': 'a'}) == ('s1', ((15, 'a'),))
+    assert chunk_map.route({'_id': 'h'})[0] == 's2'
+    assert chunk_map.route({'_id': 'z'})[0] == 's1'
+    assert chunk_map.route({'uuid': 'z'}) == (None, ())
+    hashed_map = cluster.ChunkMap({'_id': 'hashed'}, [{'min': {'_id': MinKey()}, 'shard': 's1'},
+                                                      {'min': {'_id': 0}, 'shard': 's2'}])
+    key = cluster.mongo_hash('cd59f2ca-5480-4fb9-b580-2e2f3194ce96')
+    assert hashed_map.route({'_id': 'cd59f2ca-5480-4fb9-b580-2e2f3194ce96'}) == ('s1' if key < 0 else 's2',
+                                                                                 ((10, key),))
+
+
+def test_get_chunk_map(local_cluster):
+    local_cluster._api.config['chunks'].drop()
+    local_cluster._api.config['chunks'].insert_many([
+        {'ns': 'project.cookies', 'min': {'_id': MinKey()}, 'max': {'_id': 0}, 'shard': 'mongo-gce-or-1'},
+        {'ns': 'project.cookies', 'min': {'_id': 0}, 'max': {'_id': MaxKey()}, 'shard': 'mongo-gce-or-2'},
+        {'ns': 'project.uuidh', 'min': {'_id': MinKey()}, 'max': {'_id': MaxKey()}, 'shard': 'mongo-gce-or-3'}])
+    chunk_map = local_cluster.get_chunk_map('project.cookies')
+    assert chunk_map.shards == ['mongo-gce-or-1', 'mongo-gce-or-2']
+    assert chunk_map.hashed == [True]
+    assert local_cluster.get_chunk_map('project.sid_history') is None
+    assert local_cluster.get_chunk_map('project.unknown') is None
+    key, ranges = local_cluster.get_chunk_ranges('project.cookies')
+    assert key == {'_id': 'hashed'}
+    assert [(bounds[0]['_id'], bounds[1]['_id']) for bounds in ranges] == [(MinKey(), 0), (0, MaxKey())]
+    assert local_cluster.get_chunk_ranges('project.unknown') == (None, [(None, None)])
+
+
+def test_balancer_lease(local_cluster, monkeypatch):
+    monkeypatch.setattr(local_cluster, 'is_balancer_running', lambda: False)
+    settings = local_cluster._api.config['settings']
+    settings.drop()
+    lease1 = cluster.BalancerLease(local_cluster, 'host1.example.com:1', {'lease': '1m'})
+    lease2 = cluster.BalancerLease(local_cluster, 'host2:2')
+    assert lease1.acquire() is True
+    assert local_cluster.is_balancer_stopped()
+    views = [dict()]  # lease2 has read the leases before lease1 was taken
+    monkeypatch.setattr(lease2, 'expire', lambda: views.pop() if views else cluster.BalancerLease.expire(lease2))
+    assert lease2.acquire() is True
+    monkeypatch.undo()
+    monkeypatch.setattr(local_cluster, 'is_balancer_running', lambda: False)
+    # the balancer is stopped by now, but it's still restored as seen by the holder which has created the lease
+    assert settings.find_one({'_id': cluster.BalancerLease.LEASE_ID})['restore'] is True
+    lease1.release()
+    assert local_cluster.is_balancer_stopped()  # lease2 is still held
+    lease2.release()
+    assert not local_cluster.is_balancer_stopped()
+    assert settings.find_one({'_id': cluster.BalancerLease.LEASE_ID}) is None
+    # crashed holder
+    lease1.acquire()
+    settings.update_one({'_id': cluster.BalancerLease.LEASE_ID}, {'$set': {'owners.host1_example_com:1': 0}})
+    lease2.acquire()
+    lease2.release()
+    assert not local_cluster.is_balancer_stopped()
+    # crashed holder, the lease expires by periodic check of an uploader not holding it
+    lease1.acquire()
+    settings.update_one({'_id': cluster.BalancerLease.LEASE_ID}, {'$set': {'owners.host1_example_com:1': 0}})
+    assert lease2.expire() == {}
+    assert not local_cluster.is_balancer_stopped()
+    # balancer stopped by somebody else mustn't be started
+    local_cluster.stop_balancer()
+    lease2.acquire()
+    lease2.release()
+    assert local_cluster.is_balancer_stopped()
+    with pytest.raises(AttributeError):
+        cluster.BalancerLease(local_cluster, 'host3:3', {'lease': '10s'})  # shorter than renewal while waiting
+
+
+def test_balancer_lease_migrations(local_cluster, monkeypatch):
+    polls = list()
+    monkeypatch.setattr(local_cluster, 'is_balancer_running', lambda: len(polls) < 3)
+    monkeypatch.setattr(cluster, 'sleep', lambda seconds: polls.append(seconds))
+    settings = local_cluster._api.config['settings']
+    settings.drop()
+    local_cluster.start_balancer()
+    lease = cluster.BalancerLease(local_cluster, 'host1:1', {'lease': '1m', 'migration_timeout': '1h'})
+    renewals = list()
+    assert lease.acquire(lambda: renewals.append(lease.renew())) is True
+    assert len(renewals) == 3 and lease.held
+    lease.release()
+    # the lease has expired while waiting, so uploading mustn't start
+    polls.clear()
+
+    def expire():
+        settings.update_one({'_id': cluster.BalancerLease.LEASE_ID}, {'$set': {'owners.host1:1': 0}})
+
+    assert lease.acquire(expire) is False
+    assert not lease.held and not local_cluster.is_balancer_stopped()
+    # migration hasn't finished in time
+    monkeypatch.setattr(local_cluster, 'is_balancer_running', lambda: True)
+    lease.migration_timeout = 0
+    assert lease.acquire() is False
+    assert not lease.held and not local_cluster.is_balancer_stopped()
+
+
+def test_check_distribution(local_cluster, monkeypatch):
+    local_cluster._api.config['chunks'].drop()
+    local_cluster._api.config['chunks'].insert_many(
+        [{'ns': 'project.cookies', 'shard': 'mongo-gce-or-1', 'jumbo': True}] +
+        [{'ns': 'project.cookies', 'shard': 'mongo-gce-or-%s' % (i % 3 + 1)} for i in range(5)] +
+        [{'ns': 'project.uuidh', 'shard': 'mongo-gce-or-%s' % (i % 3 + 1)} for i in range(6)])
+    stats = {'project.cookies': {'shards': {'mongo-gce-or-1': {'size': 300, 'count': 3},
+                                            'mongo-gce-or-2': {'size': 100, 'count': 1}}},
+             'project.uuidh': {'shards': {'mongo-gce-or-%s' % i: {'size': 10, 'count': 1} for i in range(1, 4)}}}
+    monkeypatch.setattr(local_cluster, '_coll_stats', lambda namespace: stats[namespace])
+    distribution = local_cluster.distribution
+    assert distribution['project.cookies'] == {
+        'mongo-gce-or-1': {'chunks': 3, 'jumbo': 1, 'size': 300, 'count': 3},
+        'mongo-gce-or-2': {'chunks': 2, 'jumbo': 0, 'size': 100, 'count': 1},
+        'mongo-gce-or-3': {'chunks': 1, 'jumbo': 0, 'size': 0, 'count': 0}}
+    assert cluster.Cluster.imbalance([3, 2, 1]) == 1.5
+    assert cluster.Cluster.imbalance([0, 0]) == 1.0
+    ok, metrics = local_cluster.check_distribution()
+    assert ok is False
+    metrics = dict(metrics)
+    assert metrics[('local', 'project.cookies', 'size_imbalance')] == 2.25
+    assert metrics[('local', 'project.cookies', 'jumbo_chunks')] == 1
+    assert metrics[('local', 'project.uuidh', 'chunks_imbalance')] == 1.0
+    assert metrics[('local', 'project.uuidh', 'mongo-gce-or-2', 'size')] == 10
+    assert local_cluster.check_distribution(2, 2.5, 1)[0] is True
+
+
+def test_server_stats(monkeypatch):
+    class MockAdmin(object):
+        def command(self, name):
+            return {
+                'serverStatus': {'process': 'mongod', 'repl': {}, 'opcounters': {'insert': 1, 'update': 20},
+                                 'opLatencies': {'writes': {'latency': 4000, 'ops': 20}},
+                                 'globalLock': {'currentQueue': {'total': 3, 'readers': 1, 'writers': 2}},
+                                 'wiredTiger': {'cache': {'maximum bytes configured': 200,
+                                                          'bytes currently in the cache': 150,
+                                                          'tracked dirty bytes in the cache': 10}}},
+                'replSetGetStatus': {'members': [
+                    {'stateStr': 'PRIMARY', 'optimeDate': datetime.datetime(2019, 2, 13, 10, 0, 30)},
+                    {'stateStr': 'SECONDARY', 'optimeDate': datetime.datetime(2019, 2, 13, 10, 0, 20)},
+                    {'stateStr': 'SECONDARY', 'optimeDate': datetime.datetime(2019, 2, 13, 10, 0, 28)}]}}[name]
+
+    class MockClient(object):
+        admin = MockAdmin()
+
+    sample_cluster = cluster.Cluster('stats', {'mongos': ['mongos1:27017'], 'shards': ['rs0/shard1:27019,shard2:27019']})
+    assert sorted(sample_cluster.nodes.keys()) == ['mongos1:27017', 'rs0/shard1:27019,shard2:27019']
+    monkeypatch.setitem(sample_cluster.nodes, 'mongos1:27017', MockClient())
+    assert sample_cluster.server_stats('mongos1:27017') == {
+        ('opcounters', 'insert'): 1, ('opcounters', 'update'): 20, ('latency', 'writes', 'ops'): 20,
+        ('latency', 'writes', 'micros'): 4000, ('currentQueue', 'total'): 3, ('currentQueue', 'readers'): 1,
+        ('currentQueue', 'writers'): 2, ('cache', 'used_ratio'): 0.75, ('cache', 'dirty_ratio'): 0.05,
+        ('replication', 'lag'): 10}
+
+
+def test_write_raw_batch():
+    class FakeDatabase(object):
+        def __init__(self, reply):
+            self.reply = reply
+            self.commands = list()
+
+        def command(self, command):
+            self.commands.append(command)
+            return self.reply.pop(0) if isinstance(self.reply, list) else self.reply
+
+    class FakeCollection(object):
+        name = 'b'
+
+        def __init__(self, reply):
+            self.database = FakeDatabase(reply)
+
+    strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                                'update_one': {'filter': {'_id': '{{user_id}}'}, 'update': {}},
+                                'collection': 'test.b', 'write_mode': 'raw'})
+    statement = strategy.encode_statement({'_id': 'a'}, {'$set': {'x': 1}})
+    counter = upload.SegfileCounter()
+    collection = FakeCollection({'n': 2, 'nModified': 1, 'ok': 1})
+    assert cluster.Cluster.write_raw_batch(collection, [statement], {'w': 1}, counter) == 2
+    assert list(collection.database.commands[0].items()) == [('update', 'b'), ('updates', [statement]),
+                                                             ('ordered', False), ('writeConcern', {'w': 1})]
+    assert cluster.Cluster.write_raw_batch(collection, [statement], {'w': 0}, counter) == 0
+    with pytest.raises(BulkWriteError):
+        cluster.Cluster.write_raw_batch(FakeCollection({'n': 0, 'writeErrors': [{'index': 0, 'code': 11000}]}),
+                                        [statement], {}, counter)
+    # commands are split by size of statements and by amount of them
+    batch = [statement] * 7
+    size = len(statement.raw) + 3
+    assert [(offset, len(part)) for offset, part in cluster.Cluster.split_raw_batch(batch, (16384 + size * 3, 5))] == [
+        (0, 3), (3, 3), (6, 1)]
+    assert [len(part) for _, part in cluster.Cluster.split_raw_batch(batch, (16777216, 5))] == [5, 2]
+    collection = FakeCollection([{'n': 5, 'ok': 1}, {'n': 1, 'writeErrors': [{'index': 1, 'code': 11000}]}])
+    with pytest.raises(BulkWriteError) as err:
+        cluster.Cluster.write_raw_batch(collection, batch, {}, counter, (16777216, 5))
+    assert err.value.details['writeErrors'] == [{'index': 6, 'code': 11000}]  # index in the whole batch
+    collection = FakeCollection({'n': 2, 'ok': 1})
+    assert cluster.Cluster.write_raw_batch(collection, batch, {}, counter, (16777216, 5)) == 4
+    assert [len(command['updates']) for command in collection.database.commands] == [5, 2]
+
+
+def test_save_stream_checkpoint(local_cluster):
+    segment = SimpleNamespace(strategy=SimpleNamespace(database='test'), source=SimpleNamespace(stream='spark'),
+                              provider='liveramp', name='spark_1_000001', counter=SimpleNamespace(line_total=10))
+    local_cluster.save_stream_checkpoint(segment)
+    segment.name = 'spark_1_000002'
+    local_cluster.save_stream_checkpoint(segment)
+    checkpoint = local_cluster._api['test'][cluster.Cluster.SEGFILE_INFO_COLLECTION].find_one('spark')
+    assert (checkpoint['segments'], checkpoint['lines'], checkpoint['last_segment']) == (2, 20, 'spark_1_000002')
+
+
+@pytest.mark.parametrize('write_mode', ['bulk', 'raw'])
+def test_drop_unchanged(local_cluster, write_mode):
+    collection = local_cluster._api['test']['unchanged_' + write_mode]
+    collection.insert_many([{'_id': 'a', 'lvmp': {'s1': 1000}, 'other': 1},
+                            {'_id': 'b', 'lvmp': {'s1': 1000}},
+                            {'_id': 'c', 'lvmp': {'s1': 1000, 's2': 1000}}])
+    strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                                'update_one': {'filter': {'_id': '{{user_id}}'}, 'update': {}},
+                                'collection': 'test.unchanged', 'write_mode': write_mode,
+                                'skip_unchanged': {'tolerance': '1m', 'tolerant_fields': ['lvmp']}})
+    assert strategy.skip_unchanged == {'tolerance': 60, 'tolerant_fields': ['lvmp'], 'key': '_id'}
+    segfile = SimpleNamespace(strategy=strategy, counter=upload.SegfileCounter())
+    requests = [{'filter': {'_id': 'a'}, 'update': {'$set': {'lvmp.s1': 1030}}},  # within tolerance
+                {'filter': {'_id': 'b'}, 'update': {'$set': {'lvmp.s1': 1100}}},  # expiry moved
+                {'filter': {'_id': 'c'}, 'update': {'$set': {'lvmp': {'s1': 1000}}}},  # segment s2 is gone
+                {'filter': {'_id': 'c'}, 'update': {'$unset': {'lvmp.s3': ''}}},  # nothing to unset
+                {'filter': {'_id': 'd'}, 'update': {'$set': {'lvmp.s1': 1000}}},  # new document
+                {'filter': {'_id': 'a'}, 'update': {'$set': {'other': 2}}}]  # not tolerant field
+    batch = [request for item in requests for request in upload.SegmentFile.get_requests(segfile, item)]
+    assert cluster.Cluster.drop_unchanged(collection, batch, segfile) == [batch[1], batch[2], batch[4], batch[5]]
+    assert segfile.counter.unchanged == 2
+    segfile.counter.unchanged = 0
+    requests = [{'filter': {'_id': 'b'}, 'update': {'$set': {'lvmp.s1': 1}}},
+                {'filter': {'_id': 'b'}, 'update': {'$set': {'lvmp.s1': 1000}}},  # restores the value set before
+                {'filter': {'_id': 'b'}, 'update': {'$set': {'lvmp.s1': 1020}}},  # close to the previous request
+                {'filter': {'_id': 'a'}, 'update': {'$max': {'other': 500}}},
+                {'filter': {'_id': 'a'}, 'update': {'$max': {'other': 300}}}]  # lower than the previous request
+    batch = [request for item in requests for request in upload.SegmentFile.get_requests(segfile, item)]
+    assert cluster.Cluster.drop_unchanged(collection, batch, segfile) == [batch[0], batch[1], batch[3]]
+    assert segfile.counter.unchanged == 2
+
+
+def test_claim_segfile(local_cluster):
+    def segment(owner):
+        return SimpleNamespace(strategy=SimpleNamespace(database='test'), name='claimed_file',
+                               claim={'owner': owner, 'lease': 60}, dump_metadata=lambda: {'processed': True})
+
+    first, second = segment('host1:1'), segment('host2:1')
+    assert local_cluster.claim_segfile(first)
+    assert local_cluster.claim_segfile(first)  # the owner renews its claim
+    assert not local_cluster.claim_segfile(second)
+    collection = local_cluster._api['test'][cluster.Cluster.SEGFILE_INFO_COLLECTION]
+    collection.update_one({'_id': 'claimed_file'}, {'$set': {'lease.expires_ts': 0}})  # the first host died
+    assert local_cluster.claim_segfile(second)
+    with pytest.raises(cluster.LeaseLost):
+        local_cluster.renew_segfile_claim(first)
+    local_cluster.save_segfile_info(first)  # nothing is saved by the host which has lost its lease
+    assert collection.find_one('claimed_file')['lease']['owner'] == 'host2:1'
+    local_cluster.renew_segfile_claim(second)
+    local_cluster.save_segfile_info(second)
+    assert collection.find_one('claimed_file') == {'_id': 'claimed_file', 'processed': True}
+    assert local_cluster.claim_segfile(first)
+    local_cluster.release_segfile_claim(first)
+    assert 'lease' not in collection.find_one('claimed_file')
+
+
+def test_segfiles_of_pack(local_cluster):
+    segfiles = [SimpleNamespace(strategy=SimpleNamespace(database='test'), name=name,
+                                claim={'owner': 'host1:1', 'lease': 60}) for name in ('packed1', 'packed2')]
+    pack = SimpleNamespace(strategy=segfiles[0].strategy, name='packed1+1', claim=segfiles[0].claim, segfiles=segfiles)
+    assert all(local_cluster.claim_segfile(obj) for obj in segfiles)
+    assert sorted(local_cluster.read_segfiles_info(segfiles).keys()) == ['packed1', 'packed2']
+    local_cluster.renew_segfile_claim(pack)
+    local_cluster.release_segfile_claim(segfiles[1])
+    with pytest.raises(cluster.LeaseLost):
+        local_cluster.renew_segfile_claim(pack)
+
+
+def test_stage_segfile(local_cluster):
+    strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                                'update_one': {'filter': {'_id': '{{user_id}}'}, 'update': {}},
+                                'collection': 'test.staged', 'load_mode': 'staging',
+                                'staging_indexes': [{'lvmp.s1': 1}]})
+    # two lines of one key with different segments: as by update mode, the later map replaces the earlier one
+    segmented = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'},
+                                                                         {'segments': '^[a-z0-9,]+$'}]},
+                                 'update_one': {'filter': {'_id': '{{user_id}}'},
+                                                'update': {'$set': {'lvmp': '{{hash_of_segments}}'}}},
+                                 'collection': 'test.staged', 'load_mode': 'staging'})
+    staged = [segmented.get_staging_document(segmented.render({'user_id': 'a', 'segments': segments}))
+              for segments in ('s1', 's2')]
+    assert [doc['k'] for doc in staged] == [{'_id': 'a'}] * 2
+    assert [list(doc['d']['lvmp'].keys()) for doc in staged] == [['s1'], ['s2']]
+    assert [doc['d'] for doc in staged] == [segmented.render({'user_id': 'a', 'segments': segments})['update']['$set']
+                                            for segments in ('s1', 's2')]
+    for update in ({'$set': '{{hash_of_segments}}'}, {'$set': {'lvmp.s1': 1}}, {'$max': {'lvmp': 1}},
+                   [{'$set': {'lvmp': 1}}], {'$set': {'lvmp': 1}, '$unset': {'old': ''}}):
+        with pytest.raises(AttributeError):
+            upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                             'update_one': {'filter': {'_id': '{{user_id}}'}, 'update': update},
+                             'templates': {'hash_of_segments': {'path': 'lvmp'}},
+                             'collection': 'test.staged', 'load_mode': 'staging'})
+    assert strategy.get_merge_pipeline('staged')[-1] == {'$merge': {
+        'into': 'staged', 'on': ['_id'], 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}
+    strategy.upsert = True
+    assert strategy.get_merge_pipeline('staged')[-1]['$merge']['whenNotMatched'] == 'insert'
+    strategy.upsert = False
+    with pytest.raises(AttributeError):
+        upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                         'update_one': {'filter': {'_id': '{{user_id}}'}, 'update': {}},
+                         'collection': 'test.staged', 'load_mode': 'staging', 'write_mode': 'raw'})
+
+    class FakeCollection(object):
+        def __init__(self, name, database=None):
+            self.name = name
+            self.database = database
+            self.write_concern = None
+            self.calls = list()
+
+        def get_collection(self, name, write_concern=None):
+            self.staging = FakeCollection(name)
+            return self.staging
+
+        def __getattr__(self, method):
+            return lambda *args, **kwargs: self.calls.append((method, args, kwargs))
+
+    database = FakeCollection('test')
+    batches = [[{'k': {'_id': 'a'}, 'd': {}}] * 2, [{'k': {'_id': 'b'}, 'd': {}}]]
+    segfile = SimpleNamespace(strategy=strategy, name='file', provider='liveramp', claim=None,
+                              counter=upload.SegfileCounter(), shared_metrics=[0, 0, 0],
+                              get_batch=lambda: iter(batches), log=lambda level, message: None)
+    local_cluster.stage_segfile(segfile, FakeCollection('staged', database))
+    assert database.staging.name == 'staged.staging.file'
+    assert [call[0] for call in database.staging.calls] == ['drop', 'insert_many', 'insert_many', 'aggregate',
+                                                            'drop']
+    assert database.staging.calls[1] == ('insert_many', (batches[0],), {'ordered': False})
+    assert database.staging.calls[3][2] == {'allowDiskUse': True}
+    assert (segfile.counter.staged, segfile.shared_metrics[2]) == (3, 3)
+    local_cluster.create_indexes(strategy)
+    assert 'lvmp.s1_1' in local_cluster._api['test']['staged'].index_information()
@@ -1,7 +1,8 @@
+import os
 from iowmongotools import fs
 
 
-def test_localfsobserver_files(tmpdir):
+def test_localfsobserver_files(tmpdir, monkeypatch):
     sfiles = list()
     subdir = tmpdir.join('subdir')
     subdir.mkdir()
@@ -22,3 +23,107 @@ def test_localfsobserver_files(tmpdir):
     assert observer.files == abs_paths('2.log.gz', 'subdir/3.log.gz', '4.log.gz', 'subdir/subdir/4.log')
     observer = fs.LocalFilesObserver(fs.EventHandler(), {'path': tmpdir.realpath(), 'filename': '.*\.tgz$'})
     assert observer.files == abs_paths('1.tgz')
+    scanned = list()
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scanned.append(str(path)) or scandir(path))
+    assert observer.files == abs_paths('1.tgz')
+    assert scanned == [str(tmpdir.realpath())]  # subdirectories aren't walked unless 'recursive' is set
+
+
+def test_discovery_index(tmpdir):
+    sfile = tmpdir.join('1.tgz')
+    sfile.write('v')
+    path = str(sfile.realpath())
+    index = fs.DiscoveryIndex(str(tmpdir.join('index.sqlite')))
+    index.add(path, fs.DiscoveryIndex.signature(path))
+    index.mark_done(path, 'c1')
+    assert index.load(['c1', 'c2']) == {}
+    index.mark_done(path, 'c2')
+    assert index.load(['c1', 'c2']) == {path: fs.DiscoveryIndex.signature(path)}
+    sfile.write('vv')  # changed file is uploaded again
+    index.add(path, fs.DiscoveryIndex.signature(path))
+    assert index.load(['c1']) == {}
+    index.mark_done(path, 'c1')
+    assert index.prune({path}) == 0
+    observer = fs.LocalFilesObserver(fs.EventHandler(), {'path': tmpdir.realpath(), 'filename': r'.*\.tgz$'})
+    observer.completed = index.load(['c1'])
+    assert observer.get_new_files() == ()
+    observer.scanned = True
+    assert observer.completed == {}  # later scans don't check completed files
+    tmpdir.join('2.tgz').write('v')
+    assert observer.get_new_files() == [str(tmpdir.join('2.tgz').realpath())]
+    sfile.write('vvv')  # file changed before start is uploaded again
+    observer = fs.LocalFilesObserver(fs.EventHandler(), {'path': tmpdir.realpath(), 'filename': r'.*\.tgz$'})
+    observer.completed = index.load(['c1'])
+    assert path in observer.get_new_files()
+    assert index.prune(set()) == 1
+    assert index.load(['c1']) == {}
+    index.add_many([(path, fs.DiscoveryIndex.signature(path)), (str(tmpdir.join('2.tgz')), (1, 1, 1))])
+    index.mark_done(path, 'c1')
+    assert index.load(['c1']) == {path: fs.DiscoveryIndex.signature(path)}
+    assert observer.signature(path) == fs.DiscoveryIndex.signature(path)  # stat is taken from entry of the scan
+
+
+def test_localfsobserver_ready_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(fs.time, 'sleep', lambda seconds: None)
+    for name in ('1.tgz', '2.tgz'):
+        tmpdir.join(name).write('v')
+    observer = fs.LocalFilesObserver(fs.EventHandler(), {'path': tmpdir.realpath()})
+    paths = sorted(str(tmpdir.join(name)) for name in ('1.tgz', '2.tgz'))
+    assert list(observer.get_ready_files(paths)) == [[(paths[0], 1), (paths[1], 1)]]  # ready files of a check at once
+
+
+def test_s3_source(fake_s3):
+    client = fake_s3
+    client.objects.update({'a/1.tsv': b'0123456789abc', 'a/2.tsv': b'', 'a/3.log': b'1', 'b/1.tsv': b'1'})
+    source = fs.S3Source({'bucket': 'segments', 'part_size': 5, 'parallel_parts': 2})
+    assert list(source.list('a/')) == [('a/1.tsv', 13), ('a/2.tsv', 0), ('a/3.log', 1)]
+    assert list(source.list('a/', 'a/1.tsv')) == [('a/2.tsv', 0), ('a/3.log', 1)]
+    assert source.get_key(source.get_path('a/1.tsv')) == 'a/1.tsv'
+    with source.open('s3://segments/a/1.tsv') as stream:
+        assert stream.read() == b'0123456789abc'
+    assert sorted(client.ranges) == [(0, 4), (5, 9), (10, 12)]
+    with source.open('s3://segments/a/2.tsv', 0) as stream:
+        assert stream.read() == b''
+    observer = fs.S3FilesObserver(fs.EventHandler(), {'bucket': 'segments', 'prefix': 'a/', 'filename': r'.*\.tsv$',
+                                                      'polling_interval': 3600})
+    assert observer.files == {'s3://segments/a/1.tsv', 's3://segments/a/2.tsv'}
+    assert observer.last_key == 'a/3.log'
+    client.objects['a/4.tsv'] = b'1'
+    assert observer.files == {'s3://segments/a/4.tsv'}
+    assert observer.sizes == {'s3://segments/a/4.tsv': 1}
+
+
+class RecordingHandler(fs.EventHandler):
+    """ auxiliary handler keeping discovered segments """
+    def __init__(self):
+        super().__init__()
+        self.segments = list()
+
+    def on_file_discovered(self, path, size=None, fresh=False, index=None, source=None):
+        with source.open(path) as stream:
+            self.segments.append((path.rsplit('_', 1)[-1], size, stream.read()))
+
+
+def test_stream_observer(tmpdir):
+    stream_file = str(tmpdir.join('stream.fifo'))
+    os.mkfifo(stream_file)  # the observer process waits for a writer while the test reads another pipe
+    spool = tmpdir.mkdir('spool')
+    handler = RecordingHandler()
+    observer = fs.StreamObserver(handler, {'name': 'spark', 'path': stream_file, 'segment_lines': 2,
+                                           'segment_interval': 3600, 'spool': str(spool), 'max_segments': 3})
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'a\t1\nb\t2\nc\t3\nd\t4\ne\t5\nf')
+    os.close(write_fd)
+    observer.read(read_fd)
+    os.close(read_fd)
+    assert handler.segments == [('000001.tsv', 8, b'a\t1\nb\t2\n'), ('000002.tsv', 8, b'c\t3\nd\t4\n'),
+                                ('000003.tsv', 5, b'e\t5\nf')]
+    assert observer.spooled() == 3  # the next segment would wait for one of them to be uploaded
+    segment = fs.StreamSegment('spark', str(spool.join('spark_{}_000001.tsv'.format(observer.started))))
+    segment.pending = 2
+    assert segment.get_size('any') == 8
+    segment.finish()
+    assert observer.spooled() == 3
+    segment.finish()
+    assert observer.spooled() == 2
@@ -0,0 +1,109 @@
+from iowmongotools import scheduler
+import pytest
+
+
+class FakeTask(object):
+    """ auxiliary object having attributes of upload.FileTask used by schedulers """
+    def __init__(self, path, provider, size=0, fresh=False, ordering_key=None, max_parallel=1):
+        self.path = path
+        self.name = path
+        self.provider = provider
+        self.size = size
+        self.fresh = fresh
+        self.ordering_key = ordering_key
+        self.max_parallel = max_parallel
+
+
+def test_create_unknown_scheduler():
+    with pytest.raises(AttributeError):
+        scheduler.create({'name': 'random'}, ['p1'], ['c1'], 1)
+
+
+def test_fifo_scheduler():
+    sch = scheduler.create(None, ['p1', 'p2'], ['c1'], 4)
+    assert isinstance(sch, scheduler.FifoScheduler)
+    for i in range(3):
+        sch.put(FakeTask('p1_%s' % i, 'p1'), 'c1')
+    sch.put(FakeTask('p2_0', 'p2'), 'c1')
+    assert sorted(item.task.path for item in sch.get()) == ['p1_0', 'p2_0']
+    assert sch.get() == []
+    sch.done('p1', 'c1', 'p1_0')
+    assert [item.task.path for item in sch.get()] == ['p1_1']
+    assert not sch.is_idle('c1')
+    assert len(sch) == 1
+
+
+def test_fair_scheduler_weights():
+    sch = scheduler.create({'name': 'fair', 'weights': {'p1': 3}}, ['p1', 'p2'], ['c1', 'c2', 'c3', 'c4'], 4)
+    for cl in ['c1', 'c2', 'c3', 'c4']:
+        sch.put(FakeTask('p1_' + cl, 'p1'), cl)
+        sch.put(FakeTask('p2_' + cl, 'p2'), cl)
+    taken = sch.get()
+    assert len(taken) == 4
+    assert sorted(item.provider for item in taken) == ['p1', 'p1', 'p1', 'p2']
+
+
+def test_fair_scheduler_cluster_limit():
+    sch = scheduler.create({'name': 'fair', 'max_per_cluster': 1, 'cluster_limits': {'c2': 2}},
+                           ['p1', 'p2', 'p3'], ['c1', 'c2'], 10)
+    for provider in ['p1', 'p2', 'p3']:
+        sch.put(FakeTask(provider, provider), 'c1')
+        sch.put(FakeTask(provider, provider), 'c2')
+    taken = sch.get()
+    assert sorted(item.cluster for item in taken) == ['c1', 'c2', 'c2']
+    sch.done(taken[0].provider, taken[0].cluster, taken[0].task.name)
+    assert len(sch.get()) == 1
+
+
+def test_fair_scheduler_fresh_and_shortest_first():
+    sch = scheduler.create({'name': 'fair', 'shortest_first': True}, ['p1', 'p2'], ['c1'], 1)
+    sch.put(FakeTask('big', 'p1', 100), 'c1')
+    sch.put(FakeTask('small', 'p1', 10), 'c1')
+    sch.put(FakeTask('fresh', 'p2', 1000, fresh=True), 'c1')
+    order = list()
+    while len(sch):
+        item = sch.get()[0]
+        order.append(item.task.path)
+        assert item.wait_time >= 0
+        sch.done(item.provider, item.cluster, item.task.name)
+    assert order == ['fresh', 'small', 'big']
+    assert sch.is_idle('c1')
+
+
+@pytest.mark.parametrize('config', [None, {'name': 'fair'}])
+def test_parallel_files_of_provider(config):
+    sch = scheduler.create(config, ['p1'], ['c1'], 10)
+    for i in range(4):
+        sch.put(FakeTask('independent_%s' % i, 'p1', max_parallel=3), 'c1')
+    assert len(sch.get()) == 3
+    sch.done('p1', 'c1', 'independent_0')
+    assert [item.task.name for item in sch.get()] == ['independent_3']
+
+
+@pytest.mark.parametrize('config', [None, {'name': 'fair', 'shortest_first': True}])
+def test_ordering_key(config):
+    sch = scheduler.create(config, ['p1'], ['c1'], 10)
+    for name, key, size in (('a_1', 'a', 100), ('a_2', 'a', 1), ('b_1', 'b', 100), ('b_2', 'b', 1)):
+        sch.put(FakeTask(name, 'p1', size, ordering_key=key, max_parallel=4), 'c1')
+    assert sorted(item.task.name for item in sch.get()) == ['a_1', 'b_1']
+    assert sch.get() == []
+    sch.done('p1', 'c1', 'b_1')
+    assert [item.task.name for item in sch.get()] == ['b_2']
+
+
+@pytest.mark.parametrize('config', [None, {'name': 'fair'}])
+def test_in_flight_counts(config):
+    sch = scheduler.create(config, ['p1', 'p2'], ['c1', 'c2'], 10)
+    for i in range(1000):
+        sch.put(FakeTask('p1_%s' % i, 'p1', max_parallel=2), 'c1')
+    sch.put(FakeTask('p2_0', 'p2', max_parallel=2), 'c2')
+    sch.put(FakeTask('p2_0', 'p2', max_parallel=2), 'c2')  # retry of a file waits for the file being uploaded
+    assert sorted(item.task.name for item in sch.get()) == ['p1_0', 'p1_1', 'p2_0']
+    assert (len(sch), sch.in_flight, sch.in_flight_per_provider, sch.in_flight_per_cluster) == (
+        999, 3, {'p1': 2, 'p2': 1}, {'c1': 2, 'c2': 1})
+    sch.done('p2', 'c2', 'p2_0')
+    sch.done('p2', 'c2', 'unknown')
+    assert [item.task.name for item in sch.get()] == ['p2_0']
+    sch.done('p2', 'c2', 'p2_0')
+    assert sch.is_idle('c2') and not sch.is_idle('c1')
+    assert sch.in_flight_per_cluster == {'c1': 2, 'c2': 0}
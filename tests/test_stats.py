@@ -0,0 +1,22 @@
+from iowmongotools import stats
+
+
+def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
+    """ auxiliary comparing floats """
+    return abs(a - b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
+
+
+def test_server_stats_collector_derive():
+    collector = stats.ServerStatsCollector.__new__(stats.ServerStatsCollector)
+    collector._previous = dict()
+    server = {('opcounters', 'update'): 20, ('latency', 'writes', 'ops'): 20, ('latency', 'writes', 'micros'): 4000}
+    assert collector.derive('node', server) == {('opcounters', 'update'): 20, ('latency', 'writes'): 0}
+    server = {('opcounters', 'update'): 30, ('latency', 'writes', 'ops'): 30, ('latency', 'writes', 'micros'): 5000}
+    assert collector.derive('node', server) == {('opcounters', 'update'): 30, ('latency', 'writes'): 100}
+
+
+def test_inhibitor_get_timeout_avg_fraction():
+    assert stats.Inhibitor.get_timeout_avg_fraction([]) == 0
+    assert isclose(stats.Inhibitor.get_timeout_avg_fraction([[1, 2], [1, 4], [3, 4]]), 0.5)
+    assert isclose(stats.Inhibitor.get_timeout_avg_fraction([[2.0, 100], [1, 10.0]]), 0.06)
+    assert isclose(stats.Inhibitor.get_timeout_avg_fraction([[3, 10], [1, 0], [3, 5]]), 0.3)
@@ -34,3 +34,9 @@ def test_timestamp():
     template = templates.Timestamp()
     current_ts = int(time.time())
     assert template.apply(None) == current_ts
+
+
+def test_segments_max():
+    template = templates.SegmentsMax({'retention': '1D', 'path': 'lvmp'})
+    expiration_ts = int(time.time() + 86400)
+    assert template.apply({'segments': '1,2'}) == {'$max': {'lvmp.1': expiration_ts, 'lvmp.2': expiration_ts}}
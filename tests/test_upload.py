@@ -1,13 +1,20 @@
-from iowmongotools import upload
+from iowmongotools import upload, cluster, fs
+from bson.min_key import MinKey
+from bson import decode_all
 import pytest
 import time
 import os
+import gzip
+import bz2
+import lzma
+import mimetypes
 from copy import copy
+from types import SimpleNamespace
 
 
-def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
-    """ auxiliary comparing floats """
-    return abs(a - b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
+def decode(raw):
+    """ auxiliary decoding of one BSON document """
+    return decode_all(raw)[0]
 
 
 def test_strategy_without_defined_update():
@@ -41,6 +48,38 @@ def test_strategy_parse_output():
     assert str(excinfo.value) == 'Template \'something_odd\' is unknown.'
 
 
+def test_strategy_update_sections():
+    strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}, {'segments': '.*'}]},
+                                'update_one': {'filter': {'_id': '{{user_id}}'},
+                                               'update': [{'$set': {'updated': '{{timestamp}}'}}, '{{segments_max}}']},
+                                'templates': {'segments_max': {'path': 'lvmp'}},
+                                'collection': 'a.b', 'skip_unchanged': {'tolerance': 10, 'tolerant_fields': ['lvmp']}})
+    assert set(strategy.templates.keys()) == {'timestamp', 'segments_max'}
+    ts = int(time.time())
+    expiration_ts = int(time.time() + 2592000)
+    setter = strategy.render({'user_id': 'a', 'segments': 's1,s2'})
+    assert setter == {'filter': {'_id': 'a'}, 'update': {'$set': {'updated': ts},
+                                                         '$max': {'lvmp.s1': expiration_ts, 'lvmp.s2': expiration_ts}}}
+    segfile = upload.SegmentFile.__new__(upload.SegmentFile)
+    segfile.strategy = strategy
+    assert upload.SegmentFile.get_requests(segfile, setter) == [upload.UpdateOne(setter['filter'], setter['update'], False)]
+    assert upload.Strategy.merge_sections([{'$set': {'a': 1}}, {'$set': {'b': 2}, '$unset': {'c': ''}}]) == {
+        '$set': {'a': 1, 'b': 2}, '$unset': {'c': ''}}
+    update = {'$max': {'lvmp.s1': 100}}
+    assert not strategy.is_changing({'_id': 'a', 'lvmp': {'s1': 200}}, {'_id': 'a'}, update)  # newer one is kept
+    assert not strategy.is_changing({'_id': 'a', 'lvmp': {'s1': 95}}, {'_id': 'a'}, update)  # within tolerance
+    assert strategy.is_changing({'_id': 'a', 'lvmp': {'s1': 50}}, {'_id': 'a'}, update)
+    assert strategy.is_changing({'_id': 'a', 'lvmp': {}}, {'_id': 'a'}, update)
+    # tolerance is only for the listed fields, other numbers must be equal
+    assert strategy.is_changing({'_id': 'a', 'score': 95}, {'_id': 'a'}, {'$set': {'score': 100}})
+    assert strategy.is_changing({'_id': 'a', 'other': {'s1': 95}}, {'_id': 'a'}, {'$set': {'other': {'s1': 100}}})
+    assert not strategy.is_changing({'_id': 'a', 'lvmp': {'s1': 95}}, {'_id': 'a'}, {'$set': {'lvmp': {'s1': 100}}})
+    with pytest.raises(AttributeError):
+        upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                         'update_one': {'filter': {'_id': '{{user_id}}'}, 'update': {}},
+                         'collection': 'a.b', 'skip_unchanged': {'tolerance': 10}})
+
+
 def test_strategy_get_setter():
     sample_strategy = upload.Strategy({'input': {'text/tab-separated-values': [{
         'user_id': '^[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}$'},
@@ -148,6 +187,17 @@ def test_fileemmiter_sorter(tmpdir):
         list(map(os.path.basename, sort4.sort(sfiles.values())))
 
 
+def test_fileemmiter_sorter_ordering_key(tmpdir):
+    sfile = tmpdir.join('s12083479file_p2.tgz')
+    sfile.write('s')
+    sorter = upload.FileEmitter.Sorter({'file_path_regexp': r'^.*/([a-z])([0-9]+).*p([0-9])\..*$',
+                                        'order': ({'path.1': 'asc'},), 'ordering_key': ['path.0', 'path.2']})
+    assert sorter.get_ordering_key(str(sfile.realpath())) == ('s', '2')
+    assert upload.FileEmitter.Sorter({'file_path_regexp': '^.*', 'order': []}).get_ordering_key('any') is None
+    with pytest.raises(AttributeError):
+        upload.FileEmitter.Sorter({'file_path_regexp': '^.*', 'order': [], 'ordering_key': ['stat.st_size']})
+
+
 def test_counter():
     sample_counter = upload.Counter()
     for filename in ['file{}'.format(i) for i in range(10)]:
@@ -199,6 +249,18 @@ def test_counter():
         sample_counter.count_result(('file10', 0, copy(segfilecnt), 'liveramp', str(cluster)))
     assert str(
         sample_counter) == 'Total files: processed - 2, skipped - 4. Lines: total - 10, invalid - 0. Requests to mongo: matched - 20, modified - 20, upserted - 4.'
+    sample_counter = upload.Counter(window=2)
+    for filename in ['file{}'.format(i) for i in range(5)]:
+        segfilecnt = upload.SegfileCounter(line_total=3)
+        segfilecnt.matched = 3
+        sample_counter.count_result((filename, 0, segfilecnt, 'liveramp', 'c'))
+    sample_counter.count_result(('file4', 0, copy(segfilecnt), 'liveramp', 'c'))  # repeated result is ignored
+    assert list(sample_counter._recent.keys()) == ['file3', 'file4']
+    assert str(sample_counter) == 'Total files: processed - 5. Lines: total - 15, invalid - 0. Requests to mongo: matched - 15.'
+    packed = upload.SegfileCounter()
+    packed.matched = 4
+    sample_counter.count_pack('liveramp', 'c', packed)  # replies to a pack are added without counting files
+    assert str(sample_counter) == 'Total files: processed - 5. Lines: total - 15, invalid - 0. Requests to mongo: matched - 19.'
 
 
 def test_segment_file_tsv(tmpdir):
@@ -240,7 +302,7 @@ def test_segment_file_tsv(tmpdir):
                                        'counter': {'line_cur': 3455803, 'line_invalid': 1267, 'line_total': 0,
                                                    'matched': 0, 'modified': 0, 'upserted': 0}, 'invalid': True,
                                        'path': tsv_file.realpath(),
-                                       'processed': True, 'provider': 'liveramp',
+                                       'processed': True, 'provider': 'liveramp', 'quarantine': None,
                                        'timer': {'finished_ts': 1545821147.86029, 'started_ts': 1545820888.727645},
                                        'type': ('text/tab-separated-values', None)}
 
@@ -260,11 +322,327 @@ def test_file_emitter(tmpdir):
     file_emitter.on_file_discovered(str(csv_file.realpath()))
     assert not file_emitter.errors.is_set()
     assert file_emitter.items_ready.is_set()
-    assert isinstance(file_emitter.queue.get(), upload.SegmentFile)
+    task = file_emitter.queue.get()
+    assert isinstance(task, upload.FileTask)
+    assert (task.name, task.provider, task.size) == ('csv_file', 'liveramp', 1)
+    segfile = upload.SegmentFile.from_task(task, file_emitter.strategy)
+    assert (segfile.path, segfile.type[0]) == (task.path, 'text/csv')
+
+
+def test_consume_queue(tmpdir, local_cluster, monkeypatch):
+    tsv_file = tmpdir.join('queued.tsv')
+    tsv_file.write('a\nb')
+    file_emitter = upload.FileEmitter('liveramp', {'delivery': {'local': {'path': str(tmpdir)}},
+                                                   'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                                                   'update_one': {'filter': {'_id': '{{user_id}}'},
+                                                                  'update': {'$set': {'x': 1}}},
+                                                   'collection': 'test.queued'})
+    file_emitter.clusters = [local_cluster.name]
+    file_emitter.on_file_discovered(str(tsv_file.realpath()))
+    batches = list()
+
+    def upload_segfile(segfile):
+        batches.extend(segfile.get_batch())
+
+    class SyncPool(object):
+        """ auxiliary pool running tasks at once """
+        calls = list()
+
+        def apply_async(self, func, args):
+            self.calls.append((func, args))
+            return func(*args)
+
+    monkeypatch.setattr(local_cluster, 'upload_segfile', upload_segfile)
+    monkeypatch.setattr(upload.Uploader, 'strategies', {'liveramp': file_emitter.strategy})
+    monkeypatch.setattr(upload.Uploader, 'shared_metrics', {'liveramp': {local_cluster.name: [0, 0, 0, 0]}})
+    monkeypatch.setattr(upload.Uploader, 'shared_array', [0] * 1000)
+    monkeypatch.setattr(upload.app.App, '__init__', lambda self: None)  # settings aren't needed
+    uploader = upload.Uploader()
+    uploader.scheduler = upload.scheduler.create(None, ['liveramp'], [local_cluster.name], 1)
+    uploader.pool = SyncPool()
+    uploader.consume_queue([file_emitter])
+    (func, args), = SyncPool.calls
+    assert func is upload.process_file
+    assert isinstance(args[1], upload.FileTask) and args[1].name == 'queued'
+    name, code, counter, provider, cl = uploader.results[0]
+    assert (name, code, provider, cl) == ('queued', 0, 'liveramp', local_cluster.name)
+    assert counter.line_total == 2 and len(batches) == 1
+    uploader.counter = upload.Counter()
+    uploader.handle_result(uploader.results[0])
+    spool_file = tmpdir.mkdir('spool').join('spark_1_000001.tsv')
+    spool_file.write('c\n')
+    file_emitter.on_file_discovered('stream://spark/spark_1_000001.tsv', fresh=True,
+                                    source=fs.StreamSegment('spark', str(spool_file)))
+    uploader.consume_queue([file_emitter])
+    uploader.handle_result(uploader.results[1])
+    assert len(batches) == 2 and not spool_file.exists()  # spool file is removed after all clusters upload it
+    uploader.balancer_leases = {local_cluster.name: SimpleNamespace(held=False, acquire=lambda on_wait: False)}
+    file_emitter.on_file_discovered(str(tsv_file.realpath()))
+    uploader.consume_queue([file_emitter])
+    assert len(SyncPool.calls) == 2  # nothing is uploaded while the balancer isn't stopped
+    assert [item[1].name for item in uploader.postponed] == ['queued'] and uploader.scheduler.in_flight == 0
+
+
+def test_segment_file_sorted_batch(tmpdir):
+    tsv_file = tmpdir.join('tsv_file.tsv')
+    tsv_file.write('z\t1\nb\t2\nq\t3\nb\t4\na\t5\n')
+    sample_strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'},
+                                                                                {'segments': '^[0-9]$'}]},
+                                       'update_one': {'filter': {'_id': "{{user_id}}"},
+                                                      'update': {'$set': {'lvmp': '{{segments}}'}}},
+                                       'collection': 'a.b', 'batch_size': 2, 'shard_aware_window': 4})
+    segfile = upload.SegmentFile(str(tsv_file.realpath()), 'liveramp', sample_strategy)
+    chunk_map = cluster.ChunkMap({'_id': 1}, [{'min': {'_id': MinKey()}, 'shard': 's1'},
+                                              {'min': {'_id': 'p'}, 'shard': 's2'}])
+    batches = [[(op._filter['_id'], op._doc['$set']['lvmp']) for op in batch] for batch in
+               segfile.get_sorted_batch(chunk_map)]
+    assert batches == [[('b', '2'), ('b', '4')], [('q', '3'), ('z', '1')], [('a', '5')]]
+
+
+def test_segment_file_raw_write_mode(tmpdir):
+    tsv_file = tmpdir.join('tsv_file.tsv')
+    tsv_file.write('z\t1\nb\t2\n')
+    sample_strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'},
+                                                                                {'segments': '^[0-9]$'}]},
+                                       'update_one': {'filter': {'_id': "{{user_id}}"},
+                                                      'update': {'$set': {'lvmp': '{{segments}}'}}},
+                                       'collection': 'a.b', 'upsert': True, 'write_mode': 'raw'})
+    segfile = upload.SegmentFile(str(tsv_file.realpath()), 'liveramp', sample_strategy)
+    batch = next(segfile.get_batch())
+    assert [decode(statement.raw) for statement in batch] == [
+        {'q': {'_id': 'z'}, 'u': {'$set': {'lvmp': '1'}}, 'upsert': True},
+        {'q': {'_id': 'b'}, 'u': {'$set': {'lvmp': '2'}}, 'upsert': True}]
+    with pytest.raises(AttributeError):
+        upload.Strategy({'input': {'text/csv': {}}, 'update_one': {'filter': {}, 'update': {}},
+                         'collection': 'a.b', 'write_mode': 'fast'})
+
+
+def test_segment_file_validate(tmpdir):
+    tsv_file = tmpdir.join('tsv_file.tsv')
+    tsv_file.write('z\t1\nB\t2\nq\n\t3\na\t5\n')
+    sample_strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'},
+                                                                                {'segments': '^[0-9]$'}]},
+                                       'update_one': {'filter': {'_id': "{{user_id}}"},
+                                                      'update': {'$set': {'lvmp': '{{segments}}'}}},
+                                       'collection': 'a.b'})
+    segfile = upload.SegmentFile(str(tsv_file.realpath()), 'liveramp', sample_strategy)
+    lines, reasons, rendered = segfile.validate(samples=1)
+    assert lines == 5
+    assert reasons == {'column user_id': 2, 'amount of columns': 1}
+    assert rendered == ["filter: {'_id': 'z'}, update: {'$set': {'lvmp': '1'}}"]
+
+
+def test_validate_file(tmpdir, monkeypatch):
+    strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                                'update_one': {'filter': {'_id': '{{user_id}}'}, 'update': {'$set': {'x': 1}}},
+                                'collection': 'a.b'})
+    monkeypatch.setattr(upload.Uploader, 'strategies', {'liveramp': strategy})
+    tmpdir.join('valid.tsv').write('a\nb\n')
+    tmpdir.join('truncated.tsv.gz').write_binary(gzip.compress(b'a\nb\n')[:-10])
+    tmpdir.join('binary.tsv').write_binary(b'a\n\xff\xfe\n')
+    results = [upload.validate_file('liveramp', str(tmpdir.join(name)), 0)
+               for name in ('truncated.tsv.gz', 'binary.tsv', 'missing.tsv', 'valid.tsv')]
+    assert [result[1:3] for result in results] == [(1, 0), (1, 0), (1, 0), (0, 2)]
+
+
+def test_segment_file_quarantine(tmpdir):
+    tsv_file = tmpdir.join('tsv_file.tsv')
+    tsv_file.write('z\t1\nB\t2\nq\n')
+    sample_strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'},
+                                                                                {'segments': '^[0-9]$'}]},
+                                       'update_one': {'filter': {'_id': "{{user_id}}"},
+                                                      'update': {'$set': {'lvmp': '{{segments}}'}}},
+                                       'collection': 'a.b', 'quarantine': {'path': str(tmpdir.join('quarantine'))}})
+    segfile = upload.SegmentFile(str(tsv_file.realpath()), 'liveramp', sample_strategy)
+    assert len(list(segfile.get_batch())) == 1
+    assert segfile.quarantine == str(tmpdir.join('quarantine', 'liveramp.tsv_file.invalid.gz'))
+    assert segfile.dump_metadata()['quarantine'] == segfile.quarantine
+    with gzip.open(segfile.quarantine, 'rt') as f_in:
+        assert f_in.read() == '2\tuser_id\tB\t2\n3\t\tq\n'
+    assert os.listdir(str(tmpdir.join('quarantine'))) == ['liveramp.tsv_file.invalid.gz']
+    tsv_file.write('z\t1\n')
+    list(segfile.get_batch())
+    assert segfile.quarantine is None
+    assert os.listdir(str(tmpdir.join('quarantine'))) == []
+
+
+def test_segment_file_from_s3(fake_s3):
+    content = gzip.compress(b'z\t1\nb\t2\n')
+    fake_s3.objects['a/file.tsv.gz'] = content
+    source = fs.S3Source({'bucket': 'segments', 'part_size': 10})
+    sample_strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'},
+                                                                                {'segments': '^[0-9]$'}]},
+                                       'update_one': {'filter': {'_id': "{{user_id}}"},
+                                                      'update': {'$set': {'lvmp': '{{segments}}'}}},
+                                       'collection': 'a.b'})
+    task = upload.FileTask('s3://segments/a/file.tsv.gz', 'liveramp', sample_strategy, source=source)
+    assert (task.name, task.size) == ('file', len(content))
+    segfile = upload.SegmentFile.from_task(task, sample_strategy)
+    assert list(segfile.get_line()) == ['z\t1', 'b\t2']
+
+
+@pytest.mark.parametrize('extension, compress', [
+    ('', lambda data: data),
+    ('.gz', gzip.compress),
+    ('.bz2', bz2.compress),
+    ('.xz', lzma.compress),
+    ('.zst', lambda data: pytest.importorskip('zstandard').ZstdCompressor().compress(data)),
+    ('.lz4', lambda data: pytest.importorskip('lz4.frame').compress(data))
+])
+def test_segment_file_compressed(tmpdir, monkeypatch, extension, compress):
+    content = compress(b'z\t1\nb\t2\n')
+    segment_file = tmpdir.join('file.log' + extension)
+    segment_file.write_binary(content)
+    monkeypatch.setitem(mimetypes.types_map, '.log', 'text/tab-separated-values')  # as option mime_types_map does
+    sample_strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'},
+                                                                                {'segments': '^[0-9]$'}]},
+                                       'update_one': {'filter': {'_id': "{{user_id}}"},
+                                                      'update': {'$set': {'lvmp': '{{segments}}'}}},
+                                       'collection': 'a.b'})
+    segfile = upload.SegmentFile(str(segment_file), 'liveramp', sample_strategy)
+    assert segfile.type == ('text/tab-separated-values', mimetypes.encodings_map.get(extension))
+    assert list(segfile.get_line()) == ['z\t1', 'b\t2']
+    assert segfile.progress.consumed == len(content)
+
+
+@pytest.mark.parametrize('file_type', ['text/tab-separated-values', upload.PARQUET_TYPE])
+def test_segment_file_arrow_engine(tmpdir, file_type):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    rows = [('z', '1'), ('B', '2'), ('q', '33'), ('a', '5')]
+    if file_type == upload.PARQUET_TYPE:
+        path = str(tmpdir.join('file.parquet'))
+        pyarrow.parquet.write_table(pyarrow.table({'user_id': [row[0] for row in rows],
+                                                   'segments': [row[1] for row in rows]}), path)
+    else:
+        path = str(tmpdir.join('file.tsv'))
+        with open(path, 'w') as f_out:
+            f_out.write(''.join('\t'.join(row) + '\n' for row in rows) + 'x\n')
+    sample_strategy = upload.Strategy({'input': {file_type: [{'user_id': '^[a-z]$'}, {'segments': '^[0-9]$'}]},
+                                       'update_one': {'filter': {'_id': "{{user_id}}"},
+                                                      'update': {'$set': {'lvmp': '{{segments}}'}}},
+                                       'collection': 'a.b', 'engine': 'arrow'})
+    segfile = upload.SegmentFile(path, 'liveramp', sample_strategy)
+    batch = next(segfile.get_batch())
+    assert [(op._filter['_id'], op._doc['$set']['lvmp']) for op in batch] == [('z', '1'), ('a', '5')]
+    lines, reasons, rendered = segfile.validate()
+    expected = {'column user_id': 1, 'column segments': 1}
+    if file_type != upload.PARQUET_TYPE:
+        expected['amount of columns'] = 1
+    assert reasons == expected
+
+
+@pytest.mark.parametrize('fixed_line_size', [True, False])
+def test_arrow_engine_matches_python(tmpdir, fixed_line_size):
+    pytest.importorskip('pyarrow')
+    tsv_file = tmpdir.join('file.tsv')
+    tsv_file.write('y\t1\nb\nB\t2\nc\nq\t33\na\t5\nd\n')
+    results = list()
+    for engine in ('python', 'arrow'):
+        strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'},
+                                                                           {'segments': '^[0-9]?$'}]},
+                                    'update_one': {'filter': {'_id': "{{user_id}}"}, 'update': {'$set': {'x': 1}}},
+                                    'collection': 'a.b', 'engine': engine, 'fixed_line_size': fixed_line_size})
+        segfile = upload.SegmentFile(str(tsv_file.realpath()), 'liveramp', strategy)
+        results.append([(line, requests.column if isinstance(requests, upload.BadLine) else len(requests))
+                        for line, requests in segfile.iter_requests()])
+    assert results[0] == results[1]
+    assert [line for line, _ in results[1]] == ['y\t1', 'b', 'B\t2', 'c', 'q\t33', 'a\t5', 'd']
+
+
+def test_segfile_counter_update_reply():
+    counter = upload.SegfileCounter()
+    assert counter.count_update_reply({'n': 5, 'nModified': 2, 'upserted': [{'index': 0, '_id': 'a'}], 'ok': 1}) == 5
+    assert (counter.matched, counter.modified, counter.upserted) == (4, 2, 1)
+
+
+def test_segment_file_snapshot_diff(tmpdir):
+    sample_strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'},
+                                                                                {'segments': '^[0-9]$'}]},
+                                       'update_one': {'filter': {'_id': "{{user_id}}"},
+                                                      'update': {'$set': {'lvmp': '{{segments}}'}}},
+                                       'snapshot_diff': {'path': str(tmpdir.join('snapshots')), 'memory_lines': 2,
+                                                         'removed': {'filter': {'_id': '{{user_id}}'},
+                                                                     'update': {'$unset': {'lvmp': ''}}}},
+                                       'collection': 'a.b'})
+
+    def upload_snapshot(name, content, commit=True):
+        tsv_file = tmpdir.join(name)
+        tsv_file.write(content)
+        segfile = upload.SegmentFile(str(tsv_file), 'liveramp', sample_strategy)
+        segfile.cluster = 'local'
+        items = list(segfile.iter_requests())
+        segfile.snapshot.close(commit)
+        return [(line, requests if isinstance(requests, upload.BadLine) else [
+            (request._filter, request._doc) for request in requests]) for line, requests in items]
+
+    assert [line for line, requests in upload_snapshot('day1.tsv', 'c\t3\na\t1\nb\t2\n')] == ['a\t1', 'b\t2', 'c\t3']
+    assert upload_snapshot('day2.tsv', 'd\t4\nc\t5\na\t1\n', commit=False) == [
+        ('b', [({'_id': 'b'}, {'$unset': {'lvmp': ''}})]),
+        ('c\t5', [({'_id': 'c'}, {'$set': {'lvmp': '5'}})]),
+        ('d\t4', [({'_id': 'd'}, {'$set': {'lvmp': '4'}})])]
+    items = upload_snapshot('day2.tsv', 'd\t4\nc\t5\na\t1\nbad\n')  # the previous digest is kept if not committed
+    assert [line for line, requests in items] == ['bad', 'b', 'c\t5', 'd\t4']
+    assert isinstance(items[0][1], upload.BadLine)
+    assert upload_snapshot('day3.tsv', 'a\t1\nc\t5\nd\t4\n') == []
+    assert os.listdir(str(tmpdir.join('snapshots'))) == ['liveramp.local.digest']
+    with pytest.raises(AttributeError):
+        upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                         'update_one': {'filter': {'_id': "{{user_id}}"}, 'update': {}},
+                         'snapshot_diff': {'path': '/tmp', 'key': ['unknown']}, 'collection': 'a.b'})
+
+
+def test_pack_tasks(tmpdir):
+    strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                                'update_one': {'filter': {'_id': '{{user_id}}'}, 'update': {}},
+                                'collection': 'a.b', 'packing': {}})
+    tasks = list()
+    for name, size, key in (('a', 10, None), ('b', 10, None), ('c', 100, None), ('d', 10, None), ('e', 10, 'x'),
+                            ('f', 10, 'x'), ('g', 10, 'x')):
+        tmpdir.join(name + '.tsv').write('a' * size)
+        task = upload.FileTask(str(tmpdir.join(name + '.tsv')), 'liveramp', strategy)
+        task.ordering_key = key
+        tasks.append(task)
+    packed = upload.PackTask.pack(tasks, {'max_bytes': 30, 'max_files': 2})
+    assert [(item.name, item.size) for item in packed] == [('a+1', 20), ('c', 100), ('d', 10), ('e+1', 20), ('g', 10)]
+    assert [task.name for task in packed[0].tasks] == ['a', 'b']
+    assert packed[3].ordering_key == 'x'
+
+
+def test_process_pack(tmpdir, local_cluster, monkeypatch):
+    strategy = upload.Strategy({'input': {'text/tab-separated-values': [{'user_id': '^[a-z]$'}]},
+                                'update_one': {'filter': {'_id': '{{user_id}}'}, 'update': {'$set': {'x': 1}}},
+                                'collection': 'test.packed', 'packing': {}, 'batch_size': 4,
+                                'process_invalid_file_to_end': False, 'threshold_percent_invalid_lines_in_batch': 50})
+    tasks = list()
+    for name, lines in (('done', 'a'), ('first', 'a\nb\nc'), ('invalid', 'd\n1\n2\n3\n4\ne'), ('last', 'f\ng')):
+        tmpdir.join(name + '.tsv').write(lines)
+        tasks.append(upload.FileTask(str(tmpdir.join(name + '.tsv')), 'liveramp', strategy))
+    pack = upload.PackTask(tasks)
+    collection = local_cluster._api['test'][cluster.Cluster.SEGFILE_INFO_COLLECTION]
+    collection.insert_one({'_id': 'done', 'provider': 'liveramp', 'processed': True, 'invalid': False})
+    batches = list()
+    saved = list()
 
+    def upload_segfile(obj):
+        for batch in obj.get_batch():
+            batches.append([request._filter['_id'] for request in batch])
+            obj.counter.matched += len(batch)
 
-def test_inhibitor_get_timeout_avg_fraction():
-    assert upload.Inhibitor.get_timeout_avg_fraction([]) == 0
-    assert isclose(upload.Inhibitor.get_timeout_avg_fraction([[1, 2], [1, 4], [3, 4]]), 0.5)
-    assert isclose(upload.Inhibitor.get_timeout_avg_fraction([[2.0, 100], [1, 10.0]]), 0.06)
-    assert isclose(upload.Inhibitor.get_timeout_avg_fraction([[3, 10], [1, 0], [3, 5]]), 0.3)
+    monkeypatch.setattr(local_cluster, 'upload_segfile', upload_segfile)
+    monkeypatch.setattr(local_cluster, 'save_segfiles_info', lambda objects, pack: saved.extend(
+        obj.dump_metadata() for obj in [pack] + objects))
+    monkeypatch.setattr(upload.Uploader, 'strategies', {'liveramp': strategy})
+    monkeypatch.setattr(upload.Uploader, 'shared_metrics', {'liveramp': {'local': [0, 0, 0, 0]}})
+    name, code, results, provider, cl, counter = upload.process_pack('local', pack)
+    assert (name, code, provider, cl, counter.matched) == ('done+3', upload.PACKED, 'liveramp', 'local', 5)
+    assert [result[:2] for result in results] == [('done', 0), ('first', 0), ('invalid', 1), ('last', 0)]
+    assert results[0][2] is None
+    assert batches == [['a', 'b', 'c', 'f', 'g']]  # requests of the invalid file are dropped
+    assert saved[0] == {'_id': 'done+3', 'provider': 'liveramp', 'files': ['first', 'invalid', 'last'],
+                        'stopped': ['invalid'], 'counter': counter.__dict__}
+    assert counter.matched == 5  # replies to requests of the pack are counted by its record, not by its files
+    assert [(doc['_id'], doc['processed'], doc['pack']) for doc in saved[1:]] == [
+        ('first', True, 'done+3'), ('invalid', False, 'done+3'), ('last', True, 'done+3')]
+    assert [(doc['counter']['line_cur'], doc['counter']['line_invalid'], doc['counter']['matched'])
+            for doc in saved[1:]] == [(3, 0, 0), (4, 3, 0), (2, 0, 0)]